@@ -1,21 +1,128 @@
 #Main.py the main flask application for the rest stop API
-from flask import Flask, request, jsonify, render_template, send_from_directory
-from flask_cors import CORS
+import threading
 from functools import wraps
-from db_manager import DatabaseManager
 
-import jwt
+import base64
 import datetime
 import json
-from config import Config
+import mimetypes
+import os
+
+import click
+
+from flask import Blueprint, Flask, Response, current_app, request, jsonify, render_template, send_from_directory, url_for
+from flask_cors import CORS
+from werkzeug.local import LocalProxy
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import formats
+from jobs import job_handler
+from ratelimit import rate_limited, shed_under_load
+from replicas import mark_write, start_replicas
+
+# Routes live on a blueprint so the app (and its database) is only built by
+# create_app(); importing this module has no side effects.
+store = Blueprint('store', __name__, cli_group=None)
+
+# the DatabaseManager of the store (shards.py) handling the current request
+db = LocalProxy(lambda: current_app.extensions['db'])
+
+_schema_lock = threading.Lock()
+
+
+def create_app(config=None):
+    """Build the Flask application for the given config class (defaults to Config)."""
+    if config is None:
+        from config import Config
+        config = Config
+
+    import assets
+    import compression
+    import replicas
+    from media import MediaStore
+    from ratelimit import LoadShedder, TokenBuckets
+    from shards import ShardRouter, current_store
 
-app = Flask(__name__)
-app.config.from_object(Config)
-CORS(app) #Enable CORS for all routes
-db=DatabaseManager()
+    # static files go through static_files() below so hashed assets can be
+    # served pre-compressed with far-future caching
+    app = Flask(__name__, static_folder=None)
+    app.static_folder = 'static'
+    app.add_url_rule('/static/<path:filename>', endpoint='static', view_func=static_files)
+    app.config.from_object(config)
+    if app.config['PROXY_COUNT']:
+        # remote_addr (and so the per-ip rate limits) is the client, not the proxy
+        count = app.config['PROXY_COUNT']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=count, x_proto=count)
+    CORS(app) #Enable CORS for all routes
+    compression.init_app(app)
+    # one database (with its job queue, sessions and catalog cache) per
+    # store; these resolve to the store of the current request or job
+    ShardRouter(app.config).init_app(app)
+    app.extensions['db'] = LocalProxy(lambda: current_store().db)
+    app.extensions['jobs'] = LocalProxy(lambda: current_store().jobs)
+    app.extensions['sessions'] = LocalProxy(lambda: current_store().sessions)
+    app.extensions['catalog_cache'] = LocalProxy(lambda: current_store().catalog_cache)
+    app.extensions['asset_manifest'] = assets.load_manifest(app.static_folder)
+    app.extensions['media'] = MediaStore(app.config['MEDIA_ROOT'], app.config['MEDIA_WIDTHS'],
+                                         app.config['MEDIA_MAX_BYTES'])
+    app.extensions['rate_limiter'] = TokenBuckets(
+        app.config['RATE_LIMIT_STORAGE']
+        or os.path.splitext(app.config['DATABASE_NAME'])[0] + '-ratelimits.db',
+        max(period for limits in app.config['RATE_LIMITS'].values() for _, period in limits.values()))
+    LoadShedder(app.config['LOAD_SHED_LATENCY']).init_app(app)
+    replicas.init_app(app)
+    app.extensions['schema_ready'] = False
+    app.jinja_env.globals['asset_url'] = asset_url
+    app.before_request(ensure_schema)
+    app.register_blueprint(store)
+    return app
+
+
+def ensure_schema():
+    """Bring the schema up to date once, on the first request this process serves.
+
+    DatabaseManager.ensure_schema() checks PRAGMA user_version first, so after
+    the first worker of a deployment has migrated, the rest skip the DDL.
+    Background job workers are started here too, once the jobs table exists,
+    and the read replicas are first copied once the schema is current.
+    """
+    if current_app.extensions['schema_ready']:
+        return
+    with _schema_lock:
+        if not current_app.extensions['schema_ready']:
+            for location in current_app.extensions['shards'].stores.values():
+                location.db.ensure_schema()
+            start_replicas(current_app._get_current_object())
+            start_job_workers(current_app._get_current_object())
+            current_app.extensions['schema_ready'] = True
+
+
+def start_job_workers(app, count=None):
+    """Start job worker threads for this process (JOB_WORKERS per store by default)"""
+    from jobs import JobWorkers
+
+    count = app.config['JOB_WORKERS'] if count is None else count
+    if count <= 0:
+        return None
+    workers = []
+    for location in app.extensions['shards'].stores.values():
+        queue = location.jobs
+        queue.requeue_stale(app.config['JOB_STALE_TIMEOUT'])
+        queue.enqueue_unique('stock_snapshot', delay=seconds_until_midnight())
+        queue.enqueue_unique('compact_stock_movements', delay=seconds_until_midnight())
+        queue.enqueue_unique('purge_sessions', delay=seconds_until_midnight())
+        queue.enqueue_unique('prune_events', delay=seconds_until_midnight())
+        queue.enqueue_unique('expire_loyalty_points', delay=seconds_until_midnight())
+        queue.enqueue_unique('compact_catalog_changes', delay=seconds_until_midnight())
+        queue.enqueue_unique('refresh_related_products', delay=app.config['RELATED_REFRESH_INTERVAL'])
+        if app.config['BACKUP_NIGHTLY']:
+            queue.enqueue_unique('backup_database', delay=seconds_until_midnight())
+        location_workers = JobWorkers(app, queue, count, app.config['JOB_POLL_INTERVAL'])
+        location_workers.start()
+        workers.append(location_workers)
+    app.extensions['job_workers'] = workers
+    return workers
 
-#initialize the database
-db.init_db()
 
 def seed_products():
     """Seed initial products if none exist to help demo the app."""
@@ -30,7 +137,7 @@ def seed_products():
         count = 0
 
     if count and count > 0:
-        return
+        return 0
 
     from models.product import AthleticShoe, CasualShoe, FormalShoe
 
@@ -45,41 +152,452 @@ def seed_products():
 
     for s in samples:
         db.add_product(s)
+    return len(samples)
+
+
+@store.cli.command('seed-db')
+def seed_db_command():
+    """Create the schema if needed and load the demo catalog."""
+    db.ensure_schema()
+    added = seed_products()
+    print(f'Seeded {added} products.' if added else 'Products already present, nothing seeded.')
+
+
+@store.cli.command('build-assets')
+def build_assets_command():
+    """Content-hash and pre-compress static/ into static/dist/."""
+    import assets
+
+    manifest = assets.build(current_app.static_folder, log=print)
+    print(f'Built {len(manifest)} assets.')
+
+
+@store.cli.command('migrate')
+@click.option('--dry-run', is_flag=True, help='Only list pending migrations with time estimates.')
+def migrate_command(dry_run):
+    """Apply pending schema migrations."""
+    if dry_run:
+        report = db.plan_migrations()
+        if not report:
+            print('Database is up to date.')
+        for migration in report:
+            print(f"{migration['version']}: {migration['description']} "
+                  f"(~{migration['estimated_seconds']:.2f}s)")
+            for description, seconds in migration['steps']:
+                print(f'    {description} (~{seconds:.3f}s)')
+        return
+
+    applied = db.init_db()
+    print(f'Applied migrations: {applied}' if applied else 'Database is up to date.')
+
+
+_thumbnail_pool = None
+_thumbnail_pool_lock = threading.Lock()
+
+
+def thumbnail_pool():
+    """Process pool for image resizing, started on first use"""
+    global _thumbnail_pool
+    with _thumbnail_pool_lock:
+        if _thumbnail_pool is None:
+            from concurrent.futures import ProcessPoolExecutor
+            _thumbnail_pool = ProcessPoolExecutor(max_workers=current_app.config['MEDIA_WORKERS'])
+        return _thumbnail_pool
+
+
+@job_handler('seed_products')
+def seed_products_job(payload):
+    return {'added': seed_products()}
+
+
+@job_handler('thumbnails')
+def thumbnails_job(payload):
+    """Generate resized variants; the CPU work runs in the process pool"""
+    from media import generate_variants
+
+    media_store = current_app.extensions['media']
+    digest = payload['digest']
+    if media_store.variants_ready(digest):
+        return {'written': []}
+    written = thumbnail_pool().submit(generate_variants, *media_store.thumbnail_job(digest)).result()
+    return {'written': written}
+
+
+@job_handler('fetch_image')
+def fetch_image_job(payload):
+    """Download an image into the media store and optionally attach it to a product"""
+    media_store = current_app.extensions['media']
+    digest = media_store.fetch(payload['url'])
+    image_url = media_store.url(digest)
+    if payload.get('product_id'):
+        db.update_product_image(payload['product_id'], image_url)
+    thumbnails_job({'digest': digest})
+    return {'digest': digest, 'image': image_url}
+
+
+@job_handler('import_products')
+def import_products_job(payload):
+    """Bulk-create products from a list of create_shoe style dicts"""
+    added = []
+    errors = []
+    for index, data in enumerate(payload['products']):
+        try:
+            added.append(db.add_product(build_shoe(data)))
+        except (ValueError, KeyError, TypeError) as e:
+            errors.append({'index': index, 'error': str(e)})
+    return {'added': added, 'errors': errors}
+
+
+def seconds_until_midnight():
+    now = datetime.datetime.now()
+    tomorrow = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time())
+    return (tomorrow - now).total_seconds()
+
+
+@job_handler('stock_snapshot')
+def stock_snapshot_job(payload):
+    """Daily stock snapshot for trend queries; schedules the next day's run"""
+    today = datetime.date.today().isoformat()
+    count = db.take_stock_snapshot(today)
+    if not (payload or {}).get('once'):
+        # this job is still 'running', so queue the successor directly
+        current_app.extensions['jobs'].enqueue('stock_snapshot', delay=seconds_until_midnight())
+    return {'date': today, 'products': count}
+
+
+@job_handler('compact_stock_movements')
+def compact_stock_movements_job(payload):
+    """Nightly fold of old ledger entries into stock_balances"""
+    payload = payload or {}
+    folded = db.compact_stock_movements(
+        payload.get('older_than_days', current_app.config['LEDGER_RETENTION_DAYS']),
+        current_app.config['LEDGER_COMPACT_BATCH'])
+    if not payload.get('once'):
+        current_app.extensions['jobs'].enqueue('compact_stock_movements', delay=seconds_until_midnight())
+    return {'folded': folded}
+
+
+@job_handler('purge_sessions')
+def purge_sessions_job(payload):
+    """Nightly cleanup of expired and revoked sessions"""
+    count = current_app.extensions['sessions'].purge_expired()
+    if not (payload or {}).get('once'):
+        current_app.extensions['jobs'].enqueue('purge_sessions', delay=seconds_until_midnight())
+    return {'purged': count}
+
+
+@job_handler('prune_events')
+def prune_events_job(payload):
+    """Nightly cleanup of outbox events every consumer has acknowledged"""
+    count = db.prune_events(current_app.config['OUTBOX_RETENTION_DAYS'])
+    if not (payload or {}).get('once'):
+        current_app.extensions['jobs'].enqueue('prune_events', delay=seconds_until_midnight())
+    return {'pruned': count}
+
+
+@job_handler('expire_loyalty_points')
+def expire_loyalty_points_job(payload):
+    """Nightly expiry of loyalty points past their date"""
+    expired = db.expire_loyalty_points(current_app.config['LOYALTY_EXPIRY_BATCH'])
+    if not (payload or {}).get('once'):
+        current_app.extensions['jobs'].enqueue('expire_loyalty_points', delay=seconds_until_midnight())
+    return {'expired': expired}
+
+
+@job_handler('compact_catalog_changes')
+def compact_catalog_changes_job(payload):
+    """Nightly trim of the catalog change log behind /api/shoes/changes"""
+    removed = db.compact_catalog_changes(current_app.config['CATALOG_CHANGES_RETENTION_DAYS'])
+    if not (payload or {}).get('once'):
+        current_app.extensions['jobs'].enqueue('compact_catalog_changes', delay=seconds_until_midnight())
+    return {'removed': removed}
+
+
+@job_handler('refresh_related_products')
+def refresh_related_products_job(payload):
+    """Recompute "customers also bought" for products with new co-purchases"""
+    config = current_app.config
+    refreshed = db.refresh_related_products(config['RELATED_TOP_K'])
+    if not (payload or {}).get('once'):
+        current_app.extensions['jobs'].enqueue('refresh_related_products',
+                                               delay=config['RELATED_REFRESH_INTERVAL'])
+    return {'refreshed': refreshed}
+
+
+def backup_store(location):
+    """Hot backup of one store's database into BACKUP_DIR"""
+    from backups import backup_database
+
+    config = current_app.config
+    return backup_database(location.db.db_name, config['BACKUP_DIR'], location.id, config['BACKUP_PAGES'],
+                           config['BACKUP_SLEEP'], config['BACKUP_KEEP'], config['BACKUP_COMPRESS_LEVEL'])
+
+
+@job_handler('backup_database')
+def backup_database_job(payload):
+    """Nightly hot backup of the store database"""
+    from shards import current_store
+
+    report = backup_store(current_store())
+    if not (payload or {}).get('once'):
+        current_app.extensions['jobs'].enqueue('backup_database', delay=seconds_until_midnight())
+    return report
+
+
+@store.cli.command('run-jobs')
+@click.option('--workers', default=2, show_default=True, help='Worker threads in this process.')
+@click.option('--once', is_flag=True, help='Run the jobs that are due, then exit.')
+def run_jobs_command(workers, once):
+    """Work the background job queue."""
+    import time
+
+    app = current_app._get_current_object()
+    locations = app.extensions['shards'].stores.values()
+    for location in locations:
+        location.db.ensure_schema()
+    if once:
+        ran = 0
+        for location in locations:
+            while location.jobs.run_one(app, 'cli'):
+                ran += 1
+        print(f'Ran {ran} jobs.')
+        return
+
+    start_job_workers(app, workers)
+    print(f'Working the job queues of {len(locations)} store(s) with {workers} threads each, Ctrl+C to stop.')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for location_workers in app.extensions['job_workers']:
+            location_workers.stop()
+
+
+@store.cli.command('rebuild-recommendations')
+def rebuild_recommendations_command():
+    """Recount co-purchases from all orders and refresh related products."""
+    db.ensure_schema()
+    pairs = db.rebuild_co_purchases()
+    refreshed = db.refresh_related_products(current_app.config['RELATED_TOP_K'])
+    print(f'Counted {pairs} co-purchase pairs, refreshed {refreshed} products.')
+
+
+@store.cli.command('split-stores')
+@click.argument('targets', nargs=-1, required=True)
+@click.option('--users', 'users_csv', type=click.Path(exists=True),
+              help='CSV of user_id,store assigning customers to stores.')
+@click.option('--stock-store', help='Store that keeps the current stock (default: the first).')
+def split_stores_command(targets, users_csv, stock_store):
+    """Split the database into one file per store: STORE=PATH ...
+
+    Add the same mapping to STORES (and restart) to start serving them.
+    """
+    from shards import read_user_stores, split_database
+
+    try:
+        stores = dict(target.split('=', 1) for target in targets)
+    except ValueError:
+        raise click.BadParameter('targets look like downtown=stores/downtown.db')
+    try:
+        split_database(current_app.config['DATABASE_NAME'], stores,
+                       read_user_stores(users_csv) if users_csv else None, stock_store, log=print)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+
+@store.cli.command('backup')
+@click.option('--store', 'store_ids', multiple=True, help='Only back up this store (repeatable).')
+def backup_command(store_ids):
+    """Back up the store databases into BACKUP_DIR while the app runs."""
+    from backups import BackupError
+
+    shards = current_app.extensions['shards']
+    for store_id in store_ids or shards.stores:
+        if store_id not in shards.stores:
+            raise click.ClickException(f'Unknown store: {store_id}')
+        try:
+            report = backup_store(shards.get(store_id))
+        except BackupError as e:
+            raise click.ClickException(str(e))
+        megabytes = report['bytes'] / 1e6
+        print(f"{store_id}: {report['path']} ({megabytes:.1f} MB -> {report['compressed_bytes'] / 1e6:.1f} MB, "
+              f"copied at {megabytes / report['copy_seconds']:.0f} MB/s, "
+              f"compressed in {report['compress_seconds']:.1f}s)")
+
+
+@store.cli.command('restore')
+@click.argument('archive', type=click.Path(exists=True, dir_okay=False))
+@click.argument('target', type=click.Path())
+def restore_command(archive, target):
+    """Restore a backup ARCHIVE into a new database file TARGET.
+
+    Point DATABASE_NAME (or the store in STORES) at TARGET to use it.
+    """
+    from backups import BackupError, restore_backup
+
+    try:
+        report = restore_backup(archive, target)
+    except (BackupError, ValueError) as e:
+        raise click.ClickException(str(e))
+    print(f"Restored {report['bytes'] / 1e6:.1f} MB into {report['path']} in {report['seconds']:.1f}s.")
 
-# Seed once on startup
-seed_products()
+
+@store.cli.command('import-images')
+def import_images_command():
+    """Copy remote product images into the local media store."""
+    from media import MediaError, generate_variants
+
+    media_store = current_app.extensions['media']
+    for shoe in db.get_all_shoes():
+        if not shoe.image or not shoe.image.startswith(('http://', 'https://')):
+            continue
+        try:
+            digest = media_store.fetch(shoe.image)
+        except MediaError as e:
+            print(f'{shoe.id}: skipped ({e})')
+            continue
+        generate_variants(*media_store.thumbnail_job(digest))
+        db.update_product_image(shoe.id, media_store.url(digest))
+        print(f'{shoe.id}: {media_store.url(digest)}')
+
+
+@store.cli.command('import-users')
+@click.argument('csv_file', type=click.File())
+@click.option('--chunk-size', default=5000, show_default=True, help='Users per transaction.')
+def import_users_command(csv_file, chunk_size):
+    """Create accounts from a CSV with username,password[,email,role] columns."""
+    import csv
+    from itertools import islice
+    from models.user import Admin, User
+
+    def build(row):
+        if row.get('role') == 'admin':
+            return Admin(row['username'], row['password'], email=row.get('email') or None)
+        return User(row['username'], row['password'], email=row.get('email') or None)
+
+    rows = csv.DictReader(csv_file)
+    created = skipped = 0
+    while True:
+        chunk = [build(row) for row in islice(rows, chunk_size)]
+        if not chunk:
+            break
+        count, taken = db.create_users(chunk)
+        created += count
+        skipped += len(taken)
+        for username in taken:
+            print(f'skipped {username}: username taken')
+    print(f'Created {created} users, skipped {skipped}.')
 
 
 ### Frontend Routes ###
-@app.route('/')
+@store.route('/')
 def index():
-    """Serve the main frontend page."""
-    return render_template('index.html')
+    """Serve the main frontend page.
+
+    The page (with the first page of products inlined as JSON when
+    INLINE_CATALOG is on) is rendered once per catalog version and then
+    served from the catalog cache with an ETag.
+    """
+    from catalog_cache import send_entry
+
+    version = db.get_catalog_version()
+
+    def build():
+        initial_catalog = None
+        if current_app.config['INLINE_CATALOG']:
+            limit = current_app.config['INLINE_CATALOG_LIMIT']
+            # one extra row tells us whether the client still has to fetch the rest
+            shoes = db.get_all_shoes(limit=limit + 1)
+            initial_catalog = {
+                'shoes': [shoe.to_dict() for shoe in shoes[:limit]],
+                'complete': len(shoes) <= limit,
+                'version': version,
+            }
+        return render_template('index.html', initial_catalog=initial_catalog).encode()
+
+    entry = current_app.extensions['catalog_cache'].get(version, ('index',), build, mimetype='text/html')
+    return send_entry(entry)
 
-@app.route('/static/<path:filename>')
 def static_files(filename):
-    """Serve static files without hardcoded paths."""
-    return send_from_directory(app.static_folder, filename)
+    """Serve static files without hardcoded paths.
+
+    Files from the build-assets step are content-hashed, so they are cached
+    forever and sent pre-compressed when the client accepts it.
+    """
+    import assets
+    import compression
+
+    if not assets.is_hashed(filename):
+        return send_from_directory(current_app.static_folder, filename, max_age=0)
+
+    mimetype = mimetypes.guess_type(filename)[0]
+    encoding = compression.choose_encoding(request.headers.get('Accept-Encoding'))
+    suffix = {'br': '.br', 'gzip': '.gz'}.get(encoding)
+    if suffix and os.path.isfile(os.path.join(current_app.static_folder, filename + suffix)):
+        response = send_from_directory(current_app.static_folder, filename + suffix,
+                                       mimetype=mimetype, max_age=31536000)
+        response.headers['Content-Encoding'] = encoding
+    else:
+        response = send_from_directory(current_app.static_folder, filename,
+                                       mimetype=mimetype, max_age=31536000)
+    response.vary.add('Accept-Encoding')
+    response.cache_control.immutable = True
+    return response
+
+
+def asset_url(filename):
+    """URL for a static file, pointing at its hashed build when there is one"""
+    manifest = current_app.extensions['asset_manifest']
+    return url_for('static', filename=manifest.get(filename, filename))
+
+@store.route('/media/<digest>/<name>')
+def media_file(digest, name):
+    """Serve a stored image or one of its resized variants.
+
+    Files are content-addressed, so they are cached as immutable. A variant
+    that hasn't been generated (yet) falls back to the original, with a
+    short max-age so the real variant is picked up later.
+    """
+    media_store = current_app.extensions['media']
+    if len(digest) != 64 or any(c not in '0123456789abcdef' for c in digest):
+        return jsonify({'message': 'Not found'}), 404
+
+    directory = media_store.directory(digest)
+    if os.path.isfile(os.path.join(directory, name)):
+        response = send_from_directory(directory, name, max_age=31536000)
+        response.cache_control.immutable = True
+        return response
+
+    original = media_store.original(digest)
+    if not original:
+        return jsonify({'message': 'Not found'}), 404
+    return send_from_directory(directory, original, max_age=60)
 
 #authentication decorator
 def token_required(f):
+    """Check the access token; the view gets the user from its claims (no DB query)"""
     @wraps(f)
     def decorated(*args, **kwargs):
+        from sessions import TokenError
+
         token =  request.headers.get('Authorization')
 
         if not token:
             return jsonify({'message': 'Token is missing!'}), 401
-        
+
+        if token.startswith('Bearer '):
+            token = token[7:]
         try:
-            if token.startswith('Bearer '):
-                token = token[7:]
-            data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
-            current_user = db.get_user_by_id(data['user_id'])
-            if not current_user:
-                return jsonify({'message': 'User not found!'}), 401
-        except:
-            return jsonify({'message': 'Token is invalid!'}), 401
-        
+            claims = current_app.extensions['sessions'].verify(token)
+        except TokenError as e:
+            return jsonify({'message': f'Token is invalid! ({e})'}), 401
+
+        current_user = {
+            'id': claims['user_id'],
+            'username': claims['username'],
+            'role': claims['role'],
+            'session_id': claims['sid']
+        }
         return f(current_user, *args, **kwargs)
     return decorated
 
@@ -88,11 +606,16 @@ def admin_required(f):
     def decorated(current_user, *args, **kwargs):
         if current_user['role'] != 'admin':
             return jsonify({'message': 'Admin access required!'}), 403
+        if request.method != 'GET':
+            # the admin's next reads skip the replicas, so they see this change
+            mark_write()
         return f(current_user, *args, **kwargs)
     return decorated
 
 ### Authorization Routes ###
-@app.route('/api/register', methods=['POST'])
+@store.route('/api/register', methods=['POST'])
+@shed_under_load
+@rate_limited('register', 'ip')
 def register():
     """Register a new user."""
     from models.user import User, Admin
@@ -120,7 +643,9 @@ def register():
     else:
         return jsonify({'message': 'Username already exists'}), 400
     
-@app.route('/api/login', methods=['POST'])
+@store.route('/api/login', methods=['POST'])
+@shed_under_load
+@rate_limited('login', 'ip', 'username', failures_only=True)
 def login():
     """Authenticate user and return token"""
     data = request.get_json()
@@ -130,16 +655,12 @@ def login():
     user_data = db.authenticate_user(data['username'], data['password'])
 
     if user_data:
-        token = jwt.encode({
-            'user_id': user_data['id'],
-            'username': user_data['username'],
-            'role': user_data['role'],
-            'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=24)
-        }, app.config['SECRET_KEY'], algorithm="HS256")
-
+        tokens = current_app.extensions['sessions'].open(user_data)
         return jsonify({
             'message': 'Login successful!',
-            'token': token,
+            # 'token' is the access token, kept under its old name for clients
+            'token': tokens['access_token'],
+            **tokens,
             'user': {
                 'id': user_data['id'],
                 'username': user_data['username'],
@@ -147,66 +668,131 @@ def login():
             }
         }), 200
     else:
-        return jsonify({'message': 'Invalid credentials!'}), 401       
+        return jsonify({'message': 'Invalid credentials!'}), 401
+
+
+@store.route('/api/token/refresh', methods=['POST'])
+@rate_limited('refresh', 'ip')
+def refresh_token():
+    """Trade a refresh token for a new access token and a new refresh token"""
+    from sessions import TokenError
+
+    data = request.get_json() or {}
+    if not data.get('refresh_token'):
+        return jsonify({'message': 'refresh_token required'}), 400
+    try:
+        tokens = current_app.extensions['sessions'].refresh(data['refresh_token'])
+    except TokenError as e:
+        return jsonify({'message': str(e)}), 401
+    return jsonify({'token': tokens['access_token'], **tokens})
+
+
+@store.route('/api/logout', methods=['POST'])
+@token_required
+def logout(current_user):
+    """End this session; its access and refresh tokens stop working"""
+    current_app.extensions['sessions'].revoke(current_user['session_id'])
+    return jsonify({'message': 'Logged out'})
 
 
+@store.route('/api/admin/users/<int:user_id>/sessions', methods=['DELETE'])
+@token_required
+@admin_required
+def revoke_user_sessions(current_user, user_id):
+    """Sign a user out everywhere (takes effect within REVOCATION_SYNC_INTERVAL)"""
+    count = current_app.extensions['sessions'].revoke_user(user_id)
+    return jsonify({'message': f'Revoked {count} session(s)', 'revoked': count})
 
 
-@app.route('/shoes', methods=['GET'])
+@store.route('/api/shoes', methods=['GET'])
+@store.route('/shoes', methods=['GET'])
+@rate_limited('catalog', 'ip')
 def get_shoes():
-    """Get all the shoes in inventory"""
-    shoes = db.get_all_shoes()
-    return jsonify([shoe.to_dict() for shoe in shoes])
+    """Get all the shoes in inventory.
+
+    Optional query filters: category, brand, sport_type, style, material
+    (e.g. /shoes?category=athletic&sport_type=running).
+    Accept: application/msgpack gets the MessagePack table (formats.py).
+    """
+    from catalog_cache import send_entry
+    from db_manager import PRODUCT_FILTERS
+
+    filters = {name: request.args[name] for name in PRODUCT_FILTERS if request.args.get(name)}
+    mimetype = formats.choose_format()
+
+    def build():
+        return formats.encode_products(db.get_all_shoes(filters), mimetype)
+
+    key = ('shoes', tuple(sorted(filters.items())), mimetype)
+    version = db.get_catalog_version()
+    response = send_entry(current_app.extensions['catalog_cache'].get(version, key, build, mimetype))
+    # where to start /api/shoes/changes from (the body may be newer, never older)
+    response.headers['X-Catalog-Version'] = str(version)
+    return response
+
+
+@store.route('/api/shoes/changes', methods=['GET'])
+@rate_limited('catalog', 'ip')
+def catalog_changes():
+    """Shoes inserted, updated and deleted after catalog version ?since=.
+
+    "version" is where to start next time. With "reset": true the change
+    log can't answer and the client should reload /api/shoes instead.
+    """
+    from catalog_cache import send_entry
 
-@app.route('/api/shoes', methods=['POST'])
-@app.route('/shoes', methods=['POST'])
+    since = request.args.get('since', type=int)
+    if since is None:
+        return jsonify({'message': 'since must be a catalog version'}), 400
+    mimetype = formats.choose_format()
+
+    def build():
+        changes = db.get_catalog_changes(since, current_app.config['CATALOG_CHANGES_LIMIT'])
+        for kind in ('inserted', 'updated'):
+            changes[kind] = formats.product_list(changes[kind], mimetype)
+        return formats.encode(changes, mimetype)
+
+    entry = current_app.extensions['catalog_cache'].get(
+        db.get_catalog_version(), ('changes', since, mimetype), build, mimetype)
+    return send_entry(entry)
+
+
+@store.route('/api/shoes/live', methods=['GET'])
+@rate_limited('live', 'ip')
+def live_updates():
+    """Server-Sent Events stream of stock and price changes (see live.py).
+
+    Starts after catalog version ?since= (or Last-Event-ID when the browser
+    reconnects), otherwise from now.
+    """
+    from shards import current_store
+
+    since = request.headers.get('Last-Event-ID', request.args.get('since'))
+    try:
+        since = int(since) if since is not None else None
+    except ValueError:
+        return jsonify({'message': 'since must be a catalog version'}), 400
+
+    stream = current_store().live.stream(since, current_app.config['LIVE_UPDATES_HEARTBEAT'])
+    response = Response(stream, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # tell nginx not to buffer the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@store.route('/api/shoes', methods=['POST'])
+@store.route('/shoes', methods=['POST'])
 @token_required
 @admin_required
 def create_shoe(current_user):
     """add a new Shoe type to the inventory (Admin only)"""
-    from models.product import Shoe, AthleticShoe, CasualShoe, FormalShoe
-    
     data = request.get_json()
 
     if not data or not data.get('name') or not data.get('price'):
         return jsonify({'message': 'Name and price are required'}), 400
 
     try:
-        shoe_type = data.get('category', 'casual')
-        
-        # Create appropriate shoe type based on category
-        if shoe_type == 'athletic':
-            shoe = AthleticShoe(
-                name=data['name'],
-                brand=data.get('brand', 'Unknown'),
-                price=float(data['price']),
-                size=data.get('size', '10'),
-                stock=int(data.get('stock', 0)),
-                color=data.get('color', 'Black'),
-                sport_type=data.get('sport_type', 'general')
-            )
-        elif shoe_type == 'formal':
-            shoe = FormalShoe(
-                name=data['name'],
-                brand=data.get('brand', 'Unknown'),
-                price=float(data['price']),
-                size=data.get('size', '10'),
-                stock=int(data.get('stock', 0)),
-                color=data.get('color', 'Black'),
-                material=data.get('material', 'leather')
-            )
-        else:
-            shoe = CasualShoe(
-                name=data['name'],
-                brand=data.get('brand', 'Unknown'),
-                price=float(data['price']),
-                size=data.get('size', '10'),
-                stock=int(data.get('stock', 0)),
-                color=data.get('color', 'Black'),
-                style=data.get('style', 'sneaker')
-            )
-        
-        shoe_id = db.add_product(shoe)
+        shoe_id = db.add_product(build_shoe(data))
         
         if shoe_id:
             return jsonify({
@@ -220,5 +806,751 @@ def create_shoe(current_user):
         return jsonify({'message': f'Invalid data: {str(e)}'}), 400
 
 
+def build_shoe(data):
+    """Create the right Shoe subclass from request data (raises ValueError/KeyError).
+
+    A style with several sizes/colors is posted as
+    "variants": [{"size": "9", "color": "Black", "stock": 4}, ...];
+    otherwise size, color and stock describe its only variant.
+    """
+    from models.product import AthleticShoe, CasualShoe, FormalShoe, Shoe
+
+    shoe_type = data.get('category', 'casual')
+    variants = Shoe.variants_from_dict(data)
+    common = dict(
+        name=data['name'],
+        brand=data.get('brand', 'Unknown'),
+        price=float(data['price']),
+        size=data.get('size') or (variants[0].size if variants else '10'),
+        stock=int(data.get('stock', 0)),
+        color=data.get('color', 'Black'),
+        image=data.get('image'),
+        variants=variants
+    )
+
+    # Create appropriate shoe type based on category
+    if shoe_type == 'athletic':
+        return AthleticShoe(sport_type=data.get('sport_type', 'general'), **common)
+    elif shoe_type == 'formal':
+        return FormalShoe(material=data.get('material', 'leather'), **common)
+    else:
+        return CasualShoe(style=data.get('style', 'sneaker'), **common)
+
+
+def shoe_etag(shoe_id, version):
+    return f'shoe-{shoe_id}-v{version}'
+
+
+def expected_version(shoe_id):
+    """Version the client last saw: from If-Match (an ETag from GET) or body "version".
+
+    Returns None when the request has neither. A compressed GET's ETag
+    (shoe-1-v3-gzip) names the same version as the plain one.
+    """
+    import compression
+
+    tags = {compression.strip_encoding(tag) for tag in request.if_match.as_set()}
+    prefix = f'shoe-{shoe_id}-v'
+    for tag in tags:
+        if tag.startswith(prefix) and tag[len(prefix):].isdigit():
+            return int(tag[len(prefix):])
+    if tags:
+        # an ETag of something else can never match this shoe's version
+        return -1
+    version = (request.get_json(silent=True) or {}).get('version')
+    return int(version) if isinstance(version, int) else None
+
+
+def product_changes(data, require_all=False):
+    """Validate the editable fields in request data (raises ValueError)"""
+    from db_manager import EDITABLE_FIELDS
+
+    if require_all:
+        missing = [field for field in ('name', 'brand', 'price', 'stock') if field not in data]
+        if missing:
+            raise ValueError(f"missing {', '.join(missing)}")
+    changes = {field: data[field] for field in EDITABLE_FIELDS if field in data}
+    if 'price' in changes:
+        changes['price'] = float(changes['price'])
+        if changes['price'] < 0:
+            raise ValueError('price cannot be negative')
+    if 'stock' in changes:
+        changes['stock'] = int(changes['stock'])
+        if changes['stock'] < 0:
+            raise ValueError('stock cannot be negative')
+    for field in ('name', 'brand'):
+        if field in changes and not changes[field]:
+            raise ValueError(f'{field} cannot be empty')
+    if not changes:
+        raise ValueError('nothing to change')
+    return changes
+
+
+def conflict_response(conflict):
+    return jsonify({
+        'message': 'Changed by someone else; reload and try again',
+        'conflicts': conflict.conflicts
+    }), 409
+
+
+@store.route('/api/shoes/<int:shoe_id>', methods=['GET'])
+@rate_limited('catalog', 'ip')
+def get_shoe(shoe_id):
+    """One shoe; its ETag is what PUT/PATCH/DELETE expect in If-Match"""
+    shoe = db.get_shoe(shoe_id)
+    if not shoe:
+        return jsonify({'message': 'Shoe not found'}), 404
+    response = jsonify(shoe.to_dict())
+    response.set_etag(shoe_etag(shoe_id, shoe.version))
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@store.route('/api/shoes/<int:shoe_id>/related', methods=['GET'])
+@rate_limited('related', 'ip')
+def related_shoes(shoe_id):
+    """Customers also bought: up to ?limit= shoes (default 8).
+
+    Comes from the precomputed related_products table, which the
+    background job refreshes every RELATED_REFRESH_INTERVAL, so responses
+    may be cached for that long.
+    """
+    import hashlib
+
+    limit = max(1, min(request.args.get('limit', 8, type=int), 24))
+    shoes = db.get_related_products(shoe_id, limit)
+    if shoes is None:
+        return jsonify({'message': 'Shoe not found'}), 404
+    response = formats.respond_products(shoes)
+    # from what the cards show; the body itself carries a fresh created_at
+    state = ','.join(f'{shoe.id}:{shoe.version}:{shoe.effective_price}:{shoe.stock}' for shoe in shoes)
+    state += f';{response.mimetype}'
+    response.set_etag(hashlib.sha1(state.encode()).hexdigest()[:16])
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['RELATED_MAX_AGE']
+    return response.make_conditional(request)
+
+
+@store.route('/api/shoes/<int:shoe_id>', methods=['PUT', 'PATCH'])
+@token_required
+@admin_required
+def update_shoe(current_user, shoe_id):
+    """Update a shoe if nobody changed it since it was read.
+
+    Needs If-Match: <ETag from GET> or "version" in the body. PUT replaces
+    name, brand, price and stock (plus any other editable field given);
+    PATCH changes only the fields given. 409 with the current version if
+    the shoe changed in the meantime.
+    """
+    from db_manager import VersionConflict
+
+    version = expected_version(shoe_id)
+    if version is None:
+        return jsonify({'message': 'If-Match or version is required'}), 428
+    try:
+        changes = product_changes(request.get_json() or {}, require_all=request.method == 'PUT')
+        versions = db.update_products([(shoe_id, version, changes)], created_by=current_user['id'])
+    except VersionConflict as conflict:
+        if conflict.conflicts[0]['version'] is None:
+            return jsonify({'message': 'Shoe not found'}), 404
+        return conflict_response(conflict)
+    except (TypeError, ValueError) as e:
+        return jsonify({'message': f'Invalid data: {e}'}), 400
+
+    response = jsonify({'message': 'Shoe updated', 'version': versions[shoe_id]})
+    response.set_etag(shoe_etag(shoe_id, versions[shoe_id]))
+    return response
+
+
+@store.route('/api/shoes', methods=['PATCH'])
+@token_required
+@admin_required
+def update_shoes(current_user):
+    """Batch update, all or nothing:
+    {"changes": [{"id": 1, "version": 4, "price": 99.99}, {"id": 2, "version": 1, "stock": 0}]}
+    """
+    from db_manager import VersionConflict
+
+    items = (request.get_json() or {}).get('changes')
+    if not isinstance(items, list) or not items:
+        return jsonify({'message': 'A list of changes is required'}), 400
+    try:
+        updates = []
+        for item in items:
+            if not isinstance(item.get('id'), int) or not isinstance(item.get('version'), int):
+                raise ValueError('every change needs an integer id and version')
+            fields = {key: value for key, value in item.items() if key not in ('id', 'version')}
+            updates.append((item['id'], item['version'], product_changes(fields)))
+        versions = db.update_products(updates, created_by=current_user['id'])
+    except VersionConflict as conflict:
+        return conflict_response(conflict)
+    except (AttributeError, TypeError, ValueError) as e:
+        return jsonify({'message': f'Invalid data: {e}'}), 400
+
+    return jsonify({
+        'message': f'{len(versions)} shoe(s) updated',
+        'versions': {str(shoe_id): version for shoe_id, version in versions.items()}
+    })
+
+
+@store.route('/api/shoes/<int:shoe_id>', methods=['DELETE'])
+@token_required
+@admin_required
+def delete_shoe(current_user, shoe_id):
+    """Delete a shoe; needs If-Match or ?version= like updates"""
+    from db_manager import VersionConflict
+
+    version = expected_version(shoe_id)
+    if version is None:
+        version = request.args.get('version', type=int)
+    if version is None:
+        return jsonify({'message': 'If-Match or version is required'}), 428
+    try:
+        if not db.delete_product(shoe_id, version):
+            return jsonify({'message': 'Shoe not found'}), 404
+    except VersionConflict as conflict:
+        return conflict_response(conflict)
+    return jsonify({'message': 'Shoe deleted'})
+
+
+@store.route('/api/admin/media', methods=['POST'])
+@token_required
+@admin_required
+def upload_media(current_user):
+    """Store a product image (multipart 'image' file or JSON {'url': ...}).
+
+    Uploaded files are stored right away (201); URLs are fetched by a
+    background job (202). Resized WebP/JPEG variants are always generated in
+    the background. Pass product_id to point that product at the new image.
+    """
+    from media import MediaError
+
+    media_store = current_app.extensions['media']
+    queue = current_app.extensions['jobs']
+    data = request.get_json(silent=True) or request.form
+    try:
+        product_id = int(data['product_id']) if data.get('product_id') else None
+    except (TypeError, ValueError):
+        return jsonify({'message': 'product_id must be an integer'}), 400
+
+    upload = request.files.get('image')
+    if not upload:
+        if not data.get('url'):
+            return jsonify({'message': 'An image file or url is required'}), 400
+        job_id = queue.enqueue('fetch_image', {'url': data['url'], 'product_id': product_id})
+        return job_accepted(job_id)
+
+    try:
+        digest = media_store.save(upload.read(), upload.mimetype)
+    except MediaError as e:
+        return jsonify({'message': str(e)}), 400
+
+    queue.enqueue('thumbnails', {'digest': digest}, priority=5)
+    image_url = media_store.url(digest)
+
+    if product_id and not db.update_product_image(product_id, image_url):
+        return jsonify({'message': 'Product not found'}), 404
+
+    return jsonify({
+        'message': 'Image stored',
+        'digest': digest,
+        'image': image_url,
+        'widths': list(media_store.widths)
+    }), 201
+
+
+### Inventory Routes ###
+@store.route('/api/admin/reorder-report', methods=['GET'])
+@token_required
+@admin_required
+def reorder_report(current_user):
+    """Everything at or under its reorder point, with suggested order quantities"""
+    limit = request.args.get('limit', type=int)
+    items = db.get_low_stock(limit)
+    return jsonify({
+        'count': len(items),
+        'items': items,
+        'rules': db.get_reorder_rules()
+    })
+
+
+@store.route('/api/admin/reorder-rules/<category>', methods=['PUT'])
+@token_required
+@admin_required
+def set_reorder_rule(current_user, category):
+    """Set a category's reorder point: {"reorder_point": 10, "reorder_quantity": 20}"""
+    data = request.get_json() or {}
+    try:
+        reorder_point = int(data['reorder_point'])
+        reorder_quantity = int(data['reorder_quantity']) if data.get('reorder_quantity') is not None else None
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'message': 'An integer reorder_point is required'}), 400
+    if reorder_point < 0 or (reorder_quantity is not None and reorder_quantity < 0):
+        return jsonify({'message': 'Reorder values cannot be negative'}), 400
+
+    db.set_reorder_rule(category, reorder_point, reorder_quantity)
+    return jsonify({'message': 'Reorder rule saved', 'rules': db.get_reorder_rules()})
+
+
+@store.route('/api/admin/reorder-rules/<category>', methods=['DELETE'])
+@token_required
+@admin_required
+def delete_reorder_rule(current_user, category):
+    """Drop a category rule (its products go back to the default)"""
+    if not db.delete_reorder_rule(category):
+        return jsonify({'message': 'Rule not found'}), 404
+    return jsonify({'message': 'Reorder rule deleted'})
+
+
+@store.route('/api/admin/shoes/<int:shoe_id>/reorder-point', methods=['PUT'])
+@token_required
+@admin_required
+def set_shoe_reorder_point(current_user, shoe_id):
+    """Per-product override: {"reorder_point": 3}, or null to use the category rule"""
+    data = request.get_json() or {}
+    value = data.get('reorder_point')
+    try:
+        value = None if value is None else int(value)
+    except (TypeError, ValueError):
+        return jsonify({'message': 'reorder_point must be an integer or null'}), 400
+    if value is not None and value < 0:
+        return jsonify({'message': 'Reorder values cannot be negative'}), 400
+
+    if not db.set_product_reorder_point(shoe_id, value):
+        return jsonify({'message': 'Shoe not found'}), 404
+    return jsonify({'message': 'Reorder point saved'})
+
+
+@store.route('/api/admin/stock-snapshots', methods=['POST'])
+@token_required
+@admin_required
+def create_stock_snapshot(current_user):
+    """Take today's stock snapshot now (runs as a job)"""
+    job_id = current_app.extensions['jobs'].enqueue('stock_snapshot', {'once': True}, priority=5)
+    return job_accepted(job_id)
+
+
+@store.route('/api/admin/stock-snapshots/<int:shoe_id>', methods=['GET'])
+@token_required
+@admin_required
+def stock_trend(current_user, shoe_id):
+    """Daily stock history of one shoe for the last ?days=30"""
+    days = min(request.args.get('days', 30, type=int), 366)
+    since = (datetime.date.today() - datetime.timedelta(days=days)).isoformat()
+    return jsonify({'shoe_id': shoe_id, 'snapshots': db.get_stock_trend(shoe_id, since)})
+
+
+@store.route('/api/admin/shoes/<int:shoe_id>/variants', methods=['POST'])
+@token_required
+@admin_required
+def add_variant(current_user, shoe_id):
+    """Add a size/color to a style: {"size": "11", "color": "Black", "stock": 6}"""
+    data = request.get_json() or {}
+    try:
+        stock = int(data.get('stock', 0))
+        if not data.get('size') or stock < 0:
+            raise ValueError('a size and a non-negative stock are required')
+        variant_id = db.add_variant(shoe_id, data['size'], data.get('color', ''), stock,
+                                    created_by=current_user['id'])
+    except (TypeError, ValueError) as e:
+        return jsonify({'message': f'Invalid variant: {e}'}), 400
+    return jsonify({'message': 'Variant added', 'variant_id': variant_id}), 201
+
+
+@store.route('/api/admin/stock-movements', methods=['POST'])
+@token_required
+@admin_required
+def record_stock_movements(current_user):
+    """Receipts, sales, returns and adjustments.
+
+    Takes one movement {"product_id": 1, "kind": "receipt", "quantity": 10,
+    "reference": "PO-17"} or {"movements": [...]}, applied all-or-nothing.
+    """
+    data = request.get_json() or {}
+    movements = data['movements'] if isinstance(data.get('movements'), list) else [data]
+    try:
+        levels = db.record_stock_movements(movements, created_by=current_user['id'])
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'message': f'Movements rejected: {e}'}), 400
+    return jsonify({
+        'message': f'{len(movements)} movement(s) recorded',
+        'stock': {str(product_id): stock for product_id, stock in levels.items()}
+    }), 201
+
+
+@store.route('/api/admin/shoes/<int:shoe_id>/stock-movements', methods=['GET'])
+@token_required
+@admin_required
+def stock_movements(current_user, shoe_id):
+    """Recent ledger entries of one shoe, with a ledger/stock consistency check"""
+    audit = db.audit_stock(shoe_id)
+    if audit is None:
+        return jsonify({'message': 'Shoe not found'}), 404
+    limit = min(request.args.get('limit', 100, type=int), 1000)
+    return jsonify({
+        'shoe_id': shoe_id,
+        'audit': audit,
+        'movements': db.get_stock_movements(shoe_id, limit)
+    })
+
+
+### Order Routes ###
+def encode_cursor(cursor):
+    if cursor is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode().rstrip('=')
+
+
+def decode_cursor(value):
+    """(created_at, id) from a ?cursor= value; None for the first page"""
+    if not value:
+        return None
+    try:
+        created_at, order_id = json.loads(base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)))
+        return str(created_at), int(order_id)
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+
+
+def orders_page(**filters):
+    """Paginated order list response for the given filters and ?cursor=&limit="""
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    try:
+        after = decode_cursor(request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    orders, cursor = db.get_orders(after=after, limit=limit, **filters)
+    return formats.respond({
+        'orders': [order.to_dict() for order in orders],
+        'next_cursor': encode_cursor(cursor)
+    })
+
+
+@store.route('/api/orders', methods=['GET'])
+@token_required
+def list_orders(current_user):
+    """The current user's orders, newest first (?cursor= for the next page)"""
+    return orders_page(user_id=current_user['id'])
+
+
+@store.route('/api/admin/orders', methods=['GET'])
+@token_required
+@admin_required
+def list_all_orders(current_user):
+    """All orders; optional ?status=, ?user_id=, ?since= and ?until= (created_at range)"""
+    from models.order import ORDER_STATUSES
+
+    status = request.args.get('status')
+    if status and status not in ORDER_STATUSES:
+        return jsonify({'message': f'status must be one of {list(ORDER_STATUSES)}'}), 400
+    return orders_page(status=status, user_id=request.args.get('user_id', type=int),
+                       since=request.args.get('since'), until=request.args.get('until'))
+
+
+@store.route('/api/orders/<int:order_id>', methods=['GET'])
+@token_required
+def get_order(current_user, order_id):
+    order = db.get_order(order_id)
+    # someone else's order is reported as missing, not forbidden
+    if not order or (order.user_id != current_user['id'] and current_user['role'] != 'admin'):
+        return jsonify({'message': 'Order not found'}), 404
+    return formats.respond(order.to_dict())
+
+
+@store.route('/api/orders', methods=['POST'])
+@token_required
+def create_order(current_user):
+    """Place an order: {"items": [{"product_id": 1, "quantity": 2, "variant_id": 3}]}
+
+    Optional "redeem_points" pays part of it with loyalty points.
+    """
+    data = request.get_json() or {}
+    items = data.get('items')
+    if not isinstance(items, list):
+        return jsonify({'message': 'A list of items is required'}), 400
+    try:
+        order = db.create_order(current_user['id'], items, data.get('redeem_points', 0))
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'message': f'Order rejected: {e}'}), 400
+    return jsonify({'message': 'Order placed', 'order': order.to_dict()}), 201
+
+
+@store.route('/api/orders/<int:order_id>/cancel', methods=['POST'])
+@token_required
+def cancel_order(current_user, order_id):
+    """Cancel one of your own orders while it is still pending"""
+    moved, _ = db.transition_orders([order_id], 'cancelled', from_status='pending',
+                                    user_id=current_user['id'], created_by=current_user['id'])
+    if not moved:
+        order = db.get_order(order_id)
+        if not order or order.user_id != current_user['id']:
+            return jsonify({'message': 'Order not found'}), 404
+        return jsonify({'message': f'A {order.status} order can no longer be cancelled'}), 409
+    return jsonify({'message': 'Order cancelled', 'order': db.get_order(order_id).to_dict()})
+
+
+@store.route('/api/admin/orders/<int:order_id>/status', methods=['PUT'])
+@token_required
+@admin_required
+def set_order_status(current_user, order_id):
+    """Move one order along: {"status": "processing"}"""
+    status = (request.get_json() or {}).get('status')
+    try:
+        moved, _ = db.transition_orders([order_id], status, created_by=current_user['id'])
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    order = db.get_order(order_id)
+    if not order:
+        return jsonify({'message': 'Order not found'}), 404
+    if not moved:
+        return jsonify({'message': f'A {order.status} order cannot move to {status}'}), 409
+    return jsonify({'message': 'Order updated', 'order': order.to_dict()})
+
+
+@store.route('/api/admin/orders/status', methods=['POST'])
+@token_required
+@admin_required
+def bulk_order_status(current_user):
+    """Move many orders at once.
+
+    Either a list: {"status": "completed", "order_ids": [1, 2, 3]} (optional
+    "from" to only move orders in that status), or every order in a status:
+    {"from": "processing", "status": "completed", "until": "2024-06-01"}.
+    Orders that can't make the move are skipped and listed.
+    """
+    data = request.get_json() or {}
+    batch_size = current_app.config['ORDER_TRANSITION_BATCH']
+    try:
+        if 'order_ids' in data:
+            if not isinstance(data['order_ids'], list):
+                raise ValueError('order_ids must be a list')
+            moved, skipped = db.transition_orders(data['order_ids'], data.get('status'), data.get('from'),
+                                                  created_by=current_user['id'], batch_size=batch_size)
+            return jsonify({'moved': len(moved), 'skipped': skipped})
+        if not data.get('from'):
+            raise ValueError('order_ids or from is required')
+        moved = db.transition_orders_in_status(data['from'], data.get('status'), data.get('until'),
+                                               created_by=current_user['id'], batch_size=batch_size)
+    except (TypeError, ValueError) as e:
+        return jsonify({'message': str(e)}), 400
+    return jsonify({'moved': moved, 'skipped': []})
+
+
+### Event Outbox Routes ###
+@store.route('/api/admin/events', methods=['GET'])
+@token_required
+@admin_required
+def list_events(current_user):
+    """Outbox events in order, for consumers such as mailers and rollups.
+
+    ?consumer=name starts after that consumer's last acknowledged event
+    (POST it back to /api/admin/events/ack once handled); ?after=id starts
+    after an explicit id instead. Optional ?topic= and ?limit=.
+    """
+    consumer = request.args.get('consumer')
+    after = request.args.get('after', type=int)
+    if after is None:
+        after = db.get_consumer_offset(consumer) if consumer else 0
+    limit = max(1, min(request.args.get('limit', 100, type=int), 1000))
+    events = db.get_events(after, request.args.get('topic'), limit)
+    return jsonify({
+        'events': events,
+        'last_id': events[-1]['id'] if events else after
+    })
+
+
+@store.route('/api/admin/events/ack', methods=['POST'])
+@token_required
+@admin_required
+def ack_events(current_user):
+    """Acknowledge events: {"consumer": "emails", "last_id": 42}"""
+    data = request.get_json() or {}
+    try:
+        consumer = data['consumer']
+        last_id = int(data['last_id'])
+        if not isinstance(consumer, str) or not consumer:
+            raise ValueError('consumer must be a name')
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'message': f'Invalid acknowledgement: {e}'}), 400
+    return jsonify({'consumer': consumer, 'last_id': db.ack_events(consumer, last_id)})
+
+
+### Loyalty Routes ###
+@store.route('/api/loyalty', methods=['GET'])
+@token_required
+def get_loyalty(current_user):
+    """Points balance and what it is worth at checkout (?history=1 adds the ledger)"""
+    from db_manager import LOYALTY_POINT_VALUE
+
+    points = db.get_loyalty_balance(current_user['id'])
+    if points is None:
+        return jsonify({'message': 'User not found'}), 404
+    result = {'points': points, 'value': round(points * LOYALTY_POINT_VALUE, 2)}
+    if request.args.get('history'):
+        result['history'] = db.get_loyalty_history(current_user['id'])
+    return jsonify(result)
+
+
+### Promotion Routes ###
+@store.route('/api/admin/promotions', methods=['GET'])
+@token_required
+@admin_required
+def list_promotions(current_user):
+    return jsonify({'promotions': db.get_promotions()})
+
+
+@store.route('/api/admin/promotions', methods=['POST'])
+@token_required
+@admin_required
+def create_promotion(current_user):
+    """New promotion, e.g. {"name": "Spring", "percentage": 15, "category": "athletic"}.
+
+    Optional targets: category, brand and/or product_ids (a list of ids);
+    none at all makes it storewide. The catalog is repriced right away.
+    """
+    data = request.get_json() or {}
+    try:
+        percentage = float(data['percentage'])
+        product_ids = data.get('product_ids')
+        if product_ids is not None:
+            product_ids = [int(product_id) for product_id in product_ids]
+            if not product_ids:
+                raise ValueError('product_ids cannot be empty')
+        if not data.get('name') or not 0 < percentage <= 100:
+            raise ValueError('a name and a percentage between 0 and 100 are required')
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'message': f'Invalid promotion: {e}'}), 400
+
+    promotion_id, repriced = db.create_promotion(
+        data['name'], percentage, data.get('category'), data.get('brand'), product_ids)
+    return jsonify({'message': 'Promotion created', 'promotion_id': promotion_id,
+                    'repriced': repriced}), 201
+
+
+@store.route('/api/admin/promotions/<int:promotion_id>', methods=['PATCH'])
+@token_required
+@admin_required
+def update_promotion(current_user, promotion_id):
+    """Switch a promotion on or off: {"active": false}"""
+    data = request.get_json() or {}
+    if not isinstance(data.get('active'), bool):
+        return jsonify({'message': 'active must be true or false'}), 400
+    repriced = db.set_promotion_active(promotion_id, data['active'])
+    if repriced is None:
+        return jsonify({'message': 'Promotion not found'}), 404
+    return jsonify({'message': 'Promotion updated', 'repriced': repriced})
+
+
+@store.route('/api/admin/promotions/<int:promotion_id>', methods=['DELETE'])
+@token_required
+@admin_required
+def delete_promotion(current_user, promotion_id):
+    repriced = db.delete_promotion(promotion_id)
+    if repriced is None:
+        return jsonify({'message': 'Promotion not found'}), 404
+    return jsonify({'message': 'Promotion deleted', 'repriced': repriced})
+
+
+### Store Routes ###
+@store.route('/api/stores', methods=['GET'])
+def list_stores():
+    """Store ids a client can pass in X-Store-ID or ?store="""
+    shards = current_app.extensions['shards']
+    return jsonify({'stores': list(shards.stores), 'default': shards.default})
+
+
+@store.route('/api/admin/reports/sales', methods=['GET'])
+@token_required
+@admin_required
+def sales_report(current_user):
+    """Orders and revenue per status for every store and overall (?since=&until=)"""
+    from shards import sum_by_key
+
+    since = request.args.get('since')
+    until = request.args.get('until')
+    stores = current_app.extensions['shards'].fan_out(
+        lambda location: location.db.get_sales_summary(since, until))
+    return jsonify({'stores': stores, 'total': sum_by_key(stores)})
+
+
+@store.route('/api/admin/reports/low-stock', methods=['GET'])
+@token_required
+@admin_required
+def low_stock_report(current_user):
+    """Low-stock products of every store, biggest shortfall first (?limit=)"""
+    from shards import merge_sorted
+
+    limit = request.args.get('limit', 100, type=int)
+    stores = current_app.extensions['shards'].fan_out(lambda location: location.db.get_low_stock(limit))
+    return jsonify({'items': merge_sorted(stores, key=lambda item: item['shortfall'],
+                                          reverse=True, limit=limit)})
+
+
+### Background Job Routes ###
+def job_accepted(job_id):
+    """202 response pointing at the status endpoint of a queued job"""
+    response = jsonify({
+        'message': 'Job queued',
+        'job_id': job_id,
+        'status_url': url_for('store.get_job', job_id=job_id)
+    })
+    response.status_code = 202
+    response.headers['Location'] = url_for('store.get_job', job_id=job_id)
+    return response
+
+
+@store.route('/api/admin/jobs', methods=['GET'])
+@token_required
+@admin_required
+def list_jobs(current_user):
+    """Job counts per status plus the most recently updated jobs (?status=...)"""
+    queue = current_app.extensions['jobs']
+    status = request.args.get('status')
+    limit = min(int(request.args.get('limit', 50)), 500)
+    return jsonify({
+        'counts': queue.counts(),
+        'jobs': queue.recent(status, limit)
+    })
+
+
+@store.route('/api/admin/jobs/<int:job_id>', methods=['GET'])
+@token_required
+@admin_required
+def get_job(current_user, job_id):
+    """Status, result and last error of one job"""
+    job = current_app.extensions['jobs'].get(job_id)
+    if not job:
+        return jsonify({'message': 'Job not found'}), 404
+    return jsonify(job)
+
+
+@store.route('/api/admin/jobs', methods=['POST'])
+@token_required
+@admin_required
+def create_job(current_user):
+    """Queue a job of any registered kind: {"kind": ..., "payload": ..., "priority": 0}"""
+    data = request.get_json() or {}
+    try:
+        job_id = current_app.extensions['jobs'].enqueue(
+            data.get('kind'), data.get('payload'), priority=int(data.get('priority', 0)))
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    return job_accepted(job_id)
+
+
+@store.route('/api/admin/products/import', methods=['POST'])
+@token_required
+@admin_required
+def import_products(current_user):
+    """Bulk product import; returns 202 and runs as an 'import_products' job"""
+    data = request.get_json()
+    products = data.get('products') if isinstance(data, dict) else data
+    if not isinstance(products, list) or not products:
+        return jsonify({'message': 'A non-empty list of products is required'}), 400
+    job_id = current_app.extensions['jobs'].enqueue('import_products', {'products': products})
+    return job_accepted(job_id)
+
+
 if __name__ == '__main__':
+    app = create_app()
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,73 @@
+"""Static asset build step and lookup.
+
+`flask --app Main build-assets` copies every file in static/ to
+static/dist/<name>.<hash><ext> and writes .gz (and .br when the `brotli`
+package is installed) next to it. The manifest maps the source name to the
+hashed one. A hashed file never changes, so it can be served with
+`Cache-Control: immutable` and a one-year max-age.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import compression
+
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+
+# text assets worth pre-compressing; images are already compressed
+COMPRESSIBLE = ('.js', '.css', '.html', '.json', '.svg', '.txt')
+
+
+def build(static_folder, log=None):
+    """Hash, copy and pre-compress the static assets, returning the manifest"""
+    dist = os.path.join(static_folder, DIST_DIR)
+    if os.path.isdir(dist):
+        shutil.rmtree(dist)
+    os.makedirs(dist)
+
+    manifest = {}
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != dist]
+        for name in sorted(files):
+            source = os.path.join(root, name)
+            relative = os.path.relpath(source, static_folder).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                data = f.read()
+
+            stem, ext = os.path.splitext(relative)
+            hashed = f'{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}'
+            target = os.path.join(dist, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(data)
+
+            if ext in COMPRESSIBLE:
+                for encoding in compression.available_encodings():
+                    suffix = '.br' if encoding == 'br' else '.gz'
+                    with open(target + suffix, 'wb') as f:
+                        f.write(compression.compress(data, encoding, level=9))
+
+            manifest[relative] = f'{DIST_DIR}/{hashed}'
+            if log:
+                log(f'{relative} -> {manifest[relative]}')
+
+    with open(os.path.join(dist, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(static_folder):
+    """Read the manifest written by build(); empty if assets were never built"""
+    try:
+        with open(os.path.join(static_folder, DIST_DIR, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def is_hashed(filename):
+    """True for files under dist/, whose names change whenever their content does"""
+    return filename.startswith(DIST_DIR + '/')
@@ -0,0 +1,156 @@
+"""Hot backups of the store databases, and restores from them.
+
+    flask --app Main backup                  # every store into BACKUP_DIR
+    flask --app Main restore ARCHIVE NEW.db
+
+A backup is a point-in-time copy taken with SQLite's online backup API while
+the app keeps serving. The copy reads BACKUP_PAGES pages per step and sleeps
+BACKUP_SLEEP seconds between steps, so it never hogs the disk, and it reads
+them all from one snapshot of the WAL: writers carry on during the backup,
+and their commits neither show up in it nor make SQLite start over (which,
+without the snapshot, a paced copy of a busy database would do forever).
+
+The copy is checked with PRAGMA integrity_check before it is gzipped into
+<store>-<YYYYmmdd-HHMMSS>.db.gz; only the newest BACKUP_KEEP are kept.
+Restoring decompresses into a new file, checks it again and only then moves
+it into place, so a bad archive never replaces anything.
+"""
+
+import datetime
+import glob
+import gzip
+import os
+import shutil
+import sqlite3
+import time
+import zlib
+from urllib.parse import quote
+
+# bytes per read/write when (de)compressing
+CHUNK_SIZE = 1 << 20
+
+
+class BackupError(Exception):
+    """A backup or restore that failed its integrity check"""
+
+
+def copy_database(source, target_path, pages=-1, sleep=0.0, progress=None):
+    """Consistent copy of source's database (a connection) into target_path.
+
+    pages > 0 copies that many pages per step and sleeps between steps.
+    Every step reads from the same snapshot, taken when the copy starts.
+    progress(status, remaining, total) is called after each step.
+    """
+    pinned = not source.in_transaction
+    if pinned:
+        # a read transaction on the source pins the snapshot for all steps
+        source.execute('BEGIN')
+        source.execute('SELECT 1 FROM sqlite_master LIMIT 1').fetchall()
+
+    def step_done(status, remaining, total):
+        if progress:
+            progress(status, remaining, total)
+        # backup()'s own sleep argument only applies when a step hits a lock
+        if remaining and sleep:
+            time.sleep(sleep)
+
+    target = sqlite3.connect(target_path)
+    try:
+        source.backup(target, pages=pages, progress=step_done)
+        # the copy is a standalone file, not part of a WAL setup
+        target.execute('PRAGMA journal_mode = DELETE')
+    finally:
+        target.close()
+        if pinned:
+            source.rollback()
+
+
+def check_integrity(path):
+    """Raise BackupError unless PRAGMA integrity_check passes for path"""
+    conn = sqlite3.connect(f'file:{quote(path)}?mode=ro', uri=True)
+    try:
+        problems = [row[0] for row in conn.execute('PRAGMA integrity_check')]
+    except sqlite3.DatabaseError as e:
+        # damaged badly enough that the check itself can't run
+        problems = [str(e)]
+    finally:
+        conn.close()
+    if problems != ['ok']:
+        raise BackupError(f"{path} failed integrity check: {'; '.join(problems[:5])}")
+
+
+def backup_database(db_path, directory, name=None, pages=256, sleep=0.01, keep=None,
+                    compress_level=1, progress=None):
+    """Back up db_path into directory as <name>-<timestamp>.db.gz.
+
+    Returns {'path', 'bytes', 'compressed_bytes', 'copy_seconds',
+    'check_seconds', 'compress_seconds'}. Raises BackupError if the copy
+    is damaged.
+    """
+    name = name or os.path.splitext(os.path.basename(db_path))[0]
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    archive = os.path.join(directory, f'{name}-{stamp}.db.gz')
+    copy_path = os.path.join(directory, f'.{name}-{stamp}.db')
+
+    started = time.perf_counter()
+    source = sqlite3.connect(db_path)
+    try:
+        copy_database(source, copy_path, pages, sleep, progress)
+    finally:
+        source.close()
+    copied = time.perf_counter()
+    try:
+        check_integrity(copy_path)
+        checked = time.perf_counter()
+        with open(copy_path, 'rb') as src, gzip.open(archive + '.tmp', 'wb', compress_level) as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        os.replace(archive + '.tmp', archive)
+        size = os.path.getsize(copy_path)
+    finally:
+        for path in (copy_path, archive + '.tmp'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    if keep:
+        for old in list_backups(directory, name)[keep:]:
+            os.remove(old)
+    return {
+        'path': archive,
+        'bytes': size,
+        'compressed_bytes': os.path.getsize(archive),
+        'copy_seconds': copied - started,
+        'check_seconds': checked - copied,
+        'compress_seconds': time.perf_counter() - checked,
+    }
+
+
+def list_backups(directory, name):
+    """Archives of one database in directory, newest first"""
+    return sorted(glob.glob(os.path.join(glob.escape(directory), f'{glob.escape(name)}-*.db.gz')),
+                  reverse=True)
+
+
+def restore_backup(archive, target_path):
+    """Decompress archive into target_path, which must not exist yet.
+
+    Returns {'path', 'bytes', 'seconds'}; raises BackupError (and leaves
+    nothing behind) if the restored file fails the integrity check.
+    """
+    if os.path.exists(target_path):
+        raise ValueError(f'{target_path} already exists')
+    started = time.perf_counter()
+    partial = target_path + '.restoring'
+    try:
+        try:
+            with gzip.open(archive, 'rb') as src, open(partial, 'wb') as dst:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        except (gzip.BadGzipFile, EOFError, zlib.error) as e:
+            raise BackupError(f'{archive} is not a readable backup: {e}')
+        check_integrity(partial)
+        os.replace(partial, target_path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    return {'path': target_path, 'bytes': os.path.getsize(target_path),
+            'seconds': time.perf_counter() - started}
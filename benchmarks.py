@@ -0,0 +1,278 @@
+"""Benchmarks run against a throwaway database.
+
+    python benchmarks.py users --count 1000000
+    python benchmarks.py related --products 100000
+    python benchmarks.py backup --size-mb 1024
+    python benchmarks.py formats --products 5000
+
+Each one builds its own data in a temporary directory, so the store
+database is never touched.
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+
+from db_manager import DatabaseManager
+
+
+def median_us(func, args_list):
+    """Median microseconds of func(*args) over args_list"""
+    timings = []
+    for args in args_list:
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1e6
+
+
+def bench_users(count, lookups, chunk_size=10000):
+    from models.user import User
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(os.path.join(tmp, 'bench.db'))
+        db.init_db()
+
+        start = time.perf_counter()
+        for first in range(0, count, chunk_size):
+            db.create_users([User(f'user{n}', 'secret', email=f'user{n}@example.com')
+                             for n in range(first, min(first + chunk_size, count))])
+        elapsed = time.perf_counter() - start
+        print(f'create_users: {count} users in {elapsed:.1f}s ({count / elapsed:,.0f}/s)')
+
+        sample = [f'user{n}' for n in random.sample(range(count), min(lookups, count))]
+
+        def connect_only():
+            # every DatabaseManager call opens a connection; this is its floor
+            conn = db.get_connection()
+            conn.execute('SELECT 1 FROM users WHERE id = 1').fetchone()
+            conn.close()
+
+        def old_lookup(username):
+            # what get_user_by_username did before the repository
+            conn = db.get_connection()
+            conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
+            conn.close()
+
+        def cold_lookup(username):
+            db.users.ids.clear()
+            db.users.id_for(username)
+
+        def fill_cache():
+            for name in sample:
+                db.users.id_for(name)
+
+        results = [
+            ('connect + rowid lookup', None, connect_only, [()] * len(sample)),
+            ('SELECT * by username (old)', None, old_lookup, [(name,) for name in sample]),
+            ('id_for, cache cold', None, cold_lookup, [(name.upper(),) for name in sample]),
+            ('id_for, cache warm', fill_cache, db.users.id_for, [(name,) for name in sample]),
+            ('get_by_username', None, db.users.get_by_username, [(name,) for name in sample]),
+            ('authenticate', None, db.users.authenticate, [(name, 'secret') for name in sample]),
+            ('get_by_email', None, db.users.get_by_email, [(f'{name}@EXAMPLE.com',) for name in sample]),
+        ]
+        for name, setup, func, args_list in results:
+            if setup:
+                setup()
+            print(f'{name:<28} {median_us(func, args_list):8.1f} us median')
+
+
+def bench_related(products, orders, lookups):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(os.path.join(tmp, 'bench.db'))
+        db.init_db()
+        categories = ('athletic', 'casual', 'formal')
+        brands = [f'brand{n}' for n in range(200)]
+
+        conn = db.get_connection()
+        conn.executemany('''
+            INSERT INTO products (name, brand, price, size, stock, color, category, effective_price)
+            VALUES (?, ?, ?, '10', 10, 'Black', ?, ?)
+        ''', [(f'shoe{n}', random.choice(brands), price, random.choice(categories), price)
+              for n in range(products) for price in [round(random.uniform(20, 300), 2)]])
+        conn.commit()
+
+        # popular products show up in far more baskets than the long tail
+        start = time.perf_counter()
+        baskets = [[int(random.paretovariate(1.2)) % products + 1 for _ in range(random.randint(2, 5))]
+                   for _ in range(orders)]
+        db._count_co_purchases(conn, baskets)
+        conn.commit()
+        conn.close()
+        print(f'count co-purchases: {orders} orders in {time.perf_counter() - start:.1f}s')
+
+        start = time.perf_counter()
+        refreshed = db.refresh_related_products()
+        print(f'refresh_related_products: {refreshed} products in {time.perf_counter() - start:.1f}s')
+
+        conn = db.get_connection()
+        with_history = [row[0] for row in conn.execute('SELECT DISTINCT product_id FROM related_products')]
+        history_sample = [(product_id,) for product_id in random.sample(with_history, min(lookups, len(with_history)))]
+        new_sample = [(random.randint(1, products),) for _ in range(lookups)]
+
+        def neighbours(product_id):
+            conn.execute('SELECT related_id FROM related_products WHERE product_id = ? ORDER BY rank LIMIT 8',
+                         (product_id,)).fetchall()
+
+        def fallback(product_id):
+            product = conn.execute('SELECT id, category, brand, price FROM products WHERE id = ?',
+                                   (product_id,)).fetchone()
+            db._similar_product_ids(conn, product, 8, {product_id})
+
+        results = [
+            ('top-k query', neighbours, history_sample),
+            ('similarity fallback query', fallback, new_sample),
+            ('get_related_products', db.get_related_products, history_sample),
+            ('get_related_products (new)', db.get_related_products, new_sample),
+        ]
+        for name, func, args_list in results:
+            print(f'{name:<28} {median_us(func, args_list):8.1f} us median')
+        conn.close()
+
+
+def bench_backup(size_mb, pages, sleep):
+    from backups import backup_database, restore_backup
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(os.path.join(tmp, 'bench.db'), pool_size=4)
+        db.init_db()
+
+        # products with a ~1 KB attributes blob each, until the file is big enough
+        start = time.perf_counter()
+        conn = db.get_connection()
+        words = [f'word{n}' for n in range(5000)]
+        count = 0
+        while os.path.getsize(db.db_name) < size_mb * 1e6:
+            conn.executemany('''
+                INSERT INTO products (name, brand, price, size, stock, color, category, attributes, effective_price)
+                VALUES (?, 'brand', 50, '10', 10, 'Black', 'casual', ?, 50)
+            ''', [(f'shoe{n}', json.dumps({'notes': ' '.join(random.choices(words, k=120))}))
+                  for n in range(count, count + 10000)])
+            conn.commit()
+            count += 10000
+        conn.close()
+        size = os.path.getsize(db.db_name)
+        print(f'built {size / 1e6:.0f} MB, {count} products in {time.perf_counter() - start:.0f}s')
+
+        def request_latencies(seconds):
+            """Mixed traffic (9 reads : 1 stock write) for seconds; returns (time, ms) pairs"""
+            latencies = []
+            deadline = time.perf_counter() + seconds
+            while time.perf_counter() < deadline:
+                product_id = random.randint(1, count)
+                started = time.perf_counter()
+                if random.random() < 0.9:
+                    db.get_shoe(product_id)
+                else:
+                    conn = db.get_connection()
+                    conn.execute('UPDATE products SET stock = stock + 1 WHERE id = ?', (product_id,))
+                    conn.commit()
+                    conn.close()
+                latencies.append((started, (time.perf_counter() - started) * 1e3))
+            return latencies
+
+        def summary(latencies, since=0, until=float('inf')):
+            latencies = sorted(ms for started, ms in latencies if since <= started < until)
+            return (f'{len(latencies)} requests, p50 {latencies[len(latencies) // 2]:.2f} ms, '
+                    f'p99 {latencies[int(len(latencies) * 0.99)]:.2f} ms, max {latencies[-1]:.1f} ms')
+
+        print(f'idle:            {summary(request_latencies(5))}')
+        for label, step_pages, step_sleep in (('one step', -1, 0), (f'{pages} pages/step', pages, sleep)):
+            traffic = []
+            stop = threading.Event()
+
+            def load():
+                while not stop.is_set():
+                    traffic.extend(request_latencies(0.5))
+
+            loader = threading.Thread(target=load)
+            loader.start()
+            time.sleep(0.5)
+            started = time.perf_counter()
+            report = backup_database(db.db_name, os.path.join(tmp, 'backups'), 'bench', step_pages, step_sleep)
+            stop.set()
+            loader.join()
+            copied = started + report['copy_seconds']
+            checked = copied + report['check_seconds']
+            print(f"backup, {label}: copy {report['copy_seconds']:.1f}s "
+                  f"({report['bytes'] / 1e6 / report['copy_seconds']:.0f} MB/s), "
+                  f"check {report['check_seconds']:.1f}s, "
+                  f"gzip {report['compress_seconds']:.1f}s -> {report['compressed_bytes'] / 1e6:.0f} MB")
+            print(f'  during copy:   {summary(traffic, started, copied)}')
+            print(f'  during check:  {summary(traffic, copied, checked)}')
+            print(f'  during gzip:   {summary(traffic, checked)}')
+
+        restored = restore_backup(report['path'], os.path.join(tmp, 'restored.db'))
+        print(f"restore: {restored['bytes'] / 1e6:.0f} MB in {restored['seconds']:.1f}s "
+              f"({restored['bytes'] / 1e6 / restored['seconds']:.0f} MB/s)")
+
+
+def bench_formats(products, rounds):
+    import gzip
+
+    import formats
+    from models.product import AthleticShoe, CasualShoe, FormalShoe, ShoeVariant
+
+    if formats.msgpack is None:
+        print('msgpack is not installed (pip install msgpack)')
+        return
+    kinds = (lambda **kw: AthleticShoe(sport_type='running', **kw),
+             lambda **kw: CasualShoe(style='sneaker', **kw),
+             lambda **kw: FormalShoe(material='leather', **kw))
+    shoes = []
+    for n in range(products):
+        variants = [ShoeVariant(str(size), 'Black', random.randint(0, 9)) for size in range(7, 7 + random.randint(1, 6))]
+        shoe = random.choice(kinds)(name=f'Shoe {n}', brand=f'brand{n % 50}', price=round(random.uniform(20, 300), 2),
+                                    size=variants[0].size, product_id=n + 1, variants=variants)
+        shoes.append(shoe)
+    dicts = [shoe.to_dict() for shoe in shoes]
+
+    codecs = [
+        ('JSON objects', lambda: json.dumps(dicts).encode(), json.loads),
+        ('MessagePack table', lambda: formats.msgpack.packb(formats.product_table(dicts), use_bin_type=True),
+         formats.msgpack.unpackb),
+    ]
+    for name, encode, decode in codecs:
+        body = encode()
+        encode_ms = median_us(encode, [()] * rounds) / 1e3
+        decode_ms = median_us(decode, [(body,)] * rounds) / 1e3
+        print(f'{name:<18} {len(body) / 1e3:8.0f} KB ({len(gzip.compress(body)) / 1e3:6.0f} KB gzipped), '
+              f'encode {encode_ms:6.1f} ms, decode {decode_ms:6.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    users = commands.add_parser('users', help='user repository lookups and bulk creation')
+    users.add_argument('--count', type=int, default=1000000)
+    users.add_argument('--lookups', type=int, default=2000)
+    related = commands.add_parser('related', help='"customers also bought" lookups')
+    related.add_argument('--products', type=int, default=100000)
+    related.add_argument('--orders', type=int, default=200000)
+    related.add_argument('--lookups', type=int, default=2000)
+    backup = commands.add_parser('backup', help='hot backup throughput and its effect on request latency')
+    backup.add_argument('--size-mb', type=int, default=1024)
+    backup.add_argument('--pages', type=int, default=256)
+    backup.add_argument('--sleep', type=float, default=0.01)
+    formats_parser = commands.add_parser('formats', help='JSON vs MessagePack size and speed for the catalog')
+    formats_parser.add_argument('--products', type=int, default=5000)
+    formats_parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.command == 'users':
+        bench_users(args.count, args.lookups)
+    elif args.command == 'related':
+        bench_related(args.products, args.orders, args.lookups)
+    elif args.command == 'backup':
+        bench_backup(args.size_mb, args.pages, args.sleep)
+    elif args.command == 'formats':
+        bench_formats(args.products, args.rounds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""In-process cache of encoded catalog responses.
+
+Entries are keyed by catalog version, so a products change (which bumps the
+version through a trigger) makes every older entry unreachable, and only
+the newest few versions are kept. Each entry keeps its compressed bodies
+next to the raw bytes, so the catalog is compressed once per version and
+encoding rather than once per request.
+"""
+
+import hashlib
+import threading
+
+from flask import current_app, make_response, request
+
+import compression
+
+
+class CacheEntry:
+    """Raw body of one catalog response plus its compressed variants"""
+
+    def __init__(self, body, mimetype):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = hashlib.sha1(body).hexdigest()[:16]
+        self._encoded = {}
+        self._lock = threading.Lock()
+
+    def encoded(self, encoding, level=6):
+        """Body for the given content-coding, compressed on first use"""
+        if not encoding:
+            return self.body
+        with self._lock:
+            if encoding not in self._encoded:
+                self._encoded[encoding] = compression.compress(self.body, encoding, level)
+            return self._encoded[encoding]
+
+
+class CatalogCache:
+    """Catalog responses for the newest catalog versions.
+
+    More than one version is kept because with replicas an admin reading
+    the primary and shoppers reading a replica see different versions at
+    the same time; keeping only one would throw the entries away on
+    nearly every request while they alternate.
+    """
+
+    def __init__(self, max_entries=128, max_versions=2):
+        self.max_entries = max_entries
+        self.max_versions = max_versions
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, version, key, build, mimetype='application/json'):
+        """Return the entry for (version, key), calling build() on a miss"""
+        with self._lock:
+            entries = self._versions.setdefault(version, {})
+            while len(self._versions) > self.max_versions:
+                # versions only grow, so the smallest is the stalest
+                del self._versions[min(self._versions)]
+            entry = entries.get(key)
+        if entry is not None:
+            return entry
+
+        entry = CacheEntry(build(), mimetype)
+        with self._lock:
+            entries = self._versions.get(version)
+            if entries is not None and len(entries) < self.max_entries:
+                entries[key] = entry
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._versions = {}
+
+
+def send_entry(entry):
+    """Build a response for a cache entry.
+
+    Honors If-None-Match and picks a pre-compressed body that matches
+    Accept-Encoding, so the compression middleware has nothing left to do.
+    """
+    encoding = None
+    if len(entry.body) >= current_app.config['COMPRESS_MIN_SIZE']:
+        encoding = compression.choose_encoding(request.headers.get('Accept-Encoding'))
+
+    response = make_response(entry.encoded(encoding, current_app.config['COMPRESS_LEVEL']))
+    response.mimetype = entry.mimetype
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    if entry.mimetype != 'text/html':
+        # API bodies come as JSON or MessagePack (formats.py)
+        response.vary.add('Accept')
+    # one ETag per representation, as required when the encoding varies
+    response.set_etag(f'{entry.etag}-{encoding}' if encoding else entry.etag)
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
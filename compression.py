@@ -0,0 +1,95 @@
+"""Response compression for D-Money's Shoe World.
+
+gzip always works; Brotli is used when the optional `brotli` package is
+installed and the client asks for it.
+"""
+
+import gzip
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+
+def available_encodings():
+    """Encodings this server can produce, best first"""
+    return ('br', 'gzip') if brotli else ('gzip',)
+
+
+def choose_encoding(accept_encoding):
+    """Pick the best encoding the client accepts, or None for identity"""
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    for encoding in available_encodings():
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def compress(data, encoding, level=6):
+    """Compress bytes with the given content-coding"""
+    if encoding == 'br':
+        return brotli.compress(data, quality=min(level, 11))
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    return data
+
+
+def should_compress(response):
+    """Check size threshold, content type allowlist and the response state"""
+    config = current_app.config
+    if response.direct_passthrough or response.status_code < 200 or response.status_code >= 300:
+        return False
+    if 'Content-Encoding' in response.headers:
+        return False
+    if response.mimetype not in config['COMPRESS_MIMETYPES']:
+        return False
+    return (response.content_length or 0) >= config['COMPRESS_MIN_SIZE']
+
+
+def compress_response(response):
+    """after_request hook compressing eligible responses on the fly"""
+    response.vary.add('Accept-Encoding')
+    if not should_compress(response):
+        return response
+
+    encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+    if not encoding:
+        return response
+
+    response.set_data(compress(response.get_data(), encoding, current_app.config['COMPRESS_LEVEL']))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        # a strong ETag names one exact body, so the compressed body gets its
+        # own (as catalog_cache.send_entry does); the view's conditional check
+        # compared the old one, so redo it
+        response.set_etag(f'{etag}-{encoding}')
+        if request.if_none_match:
+            return response.make_conditional(request)
+    return response
+
+
+def strip_encoding(etag):
+    """The ETag of the uncompressed body, for an ETag with an encoding suffix"""
+    for encoding in ('br', 'gzip'):
+        if etag.endswith(f'-{encoding}'):
+            return etag[:-len(encoding) - 1]
+    return etag
+
+
+def init_app(app):
+    """Register the compression hook on the app"""
+    app.after_request(compress_response)
@@ -8,4 +8,110 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
     # Store DB file alongside the project (not a hardcoded absolute path)
     DATABASE_NAME = str(BASE_DIR / 'shoe_store_inventory.db')
-    DEBUG = os.environ.get('DEBUG', 'False').lower() == 'true'
\ No newline at end of file
+    DEBUG = os.environ.get('DEBUG', 'False').lower() == 'true'
+
+    # Store locations (shards.py): store id -> database file, one write lock
+    # each. Empty means a single store, DEFAULT_STORE, in DATABASE_NAME.
+    STORES = {}
+    DEFAULT_STORE = 'main'
+    DB_POOL_SIZE = 8  # idle connections kept open per store database
+
+    # Read replicas (replicas.py): copies per store database that serve the
+    # catalog listing and reports; 0 reads everything from the primary.
+    # Refreshed every REPLICA_REFRESH_INTERVAL seconds if anything changed,
+    # or after REPLICA_REFRESH_WRITES commits; admins read their own writes
+    # from the primary for REPLICA_READ_YOUR_WRITES seconds.
+    REPLICAS = int(os.environ.get('REPLICAS', 0))
+    REPLICA_DIR = None  # default: a temporary directory per process
+    REPLICA_REFRESH_INTERVAL = 30
+    REPLICA_REFRESH_WRITES = 1000
+    REPLICA_READ_YOUR_WRITES = 60
+
+    # Response compression (compression.py)
+    COMPRESS_MIN_SIZE = 500  # bytes; smaller bodies are sent as-is
+    COMPRESS_LEVEL = 6
+    COMPRESS_MIMETYPES = [
+        'application/json', 'application/msgpack', 'application/x-msgpack',
+        'application/vnd.msgpack', 'text/html', 'text/css', 'text/plain',
+        'application/javascript', 'text/javascript', 'image/svg+xml',
+    ]
+
+    # Inline the first page of the catalog into index.html (saves a round trip)
+    INLINE_CATALOG = os.environ.get('INLINE_CATALOG', 'True').lower() == 'true'
+    INLINE_CATALOG_LIMIT = 24
+
+    # Product image store (media.py); resizing needs the optional Pillow package
+    MEDIA_ROOT = os.environ.get('MEDIA_ROOT') or str(BASE_DIR / 'media')
+    MEDIA_WIDTHS = (200, 400, 800)
+    MEDIA_MAX_BYTES = 10 * 1024 * 1024
+    MEDIA_WORKERS = 2  # processes used for thumbnail generation
+
+    # Background jobs (jobs.py); 0 threads = only `flask --app Main run-jobs` works the queue
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+    JOB_POLL_INTERVAL = 1.0  # seconds between polls when the queue is empty
+    JOB_STALE_TIMEOUT = 600  # 'running' jobs untouched this long are requeued
+
+    # Stock ledger: movements older than this are folded into stock_balances
+    LEDGER_RETENTION_DAYS = 90
+    LEDGER_COMPACT_BATCH = 1000
+
+    # Bulk order status changes: orders per UPDATE (and per transaction)
+    ORDER_TRANSITION_BATCH = 500
+    # Outbox events every consumer has acknowledged are deleted after this long
+    OUTBOX_RETENTION_DAYS = 7
+
+    # Loyalty points: lots expired per transaction by the nightly job
+    LOYALTY_EXPIRY_BATCH = 1000
+
+    # "Customers also bought": neighbours kept per product, how often the
+    # job recomputes them, and how long clients may cache the answer
+    RELATED_TOP_K = 12
+    RELATED_REFRESH_INTERVAL = 600
+    RELATED_MAX_AGE = 600
+
+    # Hot backups (backups.py): pages copied per step and the pause between
+    # steps (1 MB, then 10 ms), how many archives to keep per store, and the
+    # gzip level (1 is several times faster than 6 for ~20% more bytes)
+    BACKUP_DIR = os.environ.get('BACKUP_DIR') or str(BASE_DIR / 'backups')
+    BACKUP_NIGHTLY = os.environ.get('BACKUP_NIGHTLY', 'False').lower() == 'true'
+    BACKUP_PAGES = 256
+    BACKUP_SLEEP = 0.01
+    BACKUP_KEEP = 7
+    BACKUP_COMPRESS_LEVEL = 1
+
+    # Delta catalog sync (/api/shoes/changes): more changed products than
+    # this and the client reloads everything; the log keeps this many days
+    CATALOG_CHANGES_LIMIT = 1000
+    CATALOG_CHANGES_RETENTION_DAYS = 30
+
+    # Live stock/price updates (GET /api/shoes/live, Server-Sent Events)
+    LIVE_UPDATES_POLL_INTERVAL = 0.5  # seconds between change log polls, per store
+    LIVE_UPDATES_HEARTBEAT = 15  # seconds between keep-alive comments on an idle stream
+    LIVE_UPDATES_BUFFER = 1000  # recent events kept for clients that reconnect
+
+    # Login sessions (sessions.py): access tokens are checked without a DB
+    # query; revocations reach every process within REVOCATION_SYNC_INTERVAL
+    ACCESS_TOKEN_TTL = 15 * 60
+    REFRESH_TOKEN_TTL = 14 * 24 * 3600
+    REVOCATION_SYNC_INTERVAL = 2.0
+
+    # Rate limits (ratelimit.py): scope -> {key: (capacity, seconds to refill)}
+    RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'True').lower() == 'true'
+    RATE_LIMIT_STORAGE = None  # SQLite file shared by workers; default <database>-ratelimits.db
+    RATE_LIMITS = {
+        'login': {'ip': (20, 60), 'username': (5, 60)},
+        'register': {'ip': (5, 600)},
+        'refresh': {'ip': (60, 60)},
+        'catalog': {'ip': (300, 60)},
+        # the storefront fetches these per product card as they scroll into view
+        'related': {'ip': (1200, 60)},
+        'live': {'ip': (30, 60)},
+    }
+    # Proxies in front of the app (nginx, a load balancer) whose
+    # X-Forwarded-For/-Proto are trusted. Behind one, leave this at 0 and
+    # every client has the proxy's address, so they all share one bucket.
+    PROXY_COUNT = int(os.environ.get('PROXY_COUNT', 0))
+    # Load shedding: above this queue/request latency (seconds) sheddable
+    # routes answer 503 so the catalog keeps its capacity
+    LOAD_SHED_LATENCY = 0.5
+    LOAD_SHED_RETRY_AFTER = 5
@@ -1,117 +1,220 @@
 import sqlite3
 import json
+import logging
+import threading
+import contextvars
+from urllib.parse import quote
 from config import Config
+import migrations
+from users import UserRepository
+
+logger = logging.getLogger(__name__)
+
+# The schema version a fully migrated database reports in PRAGMA user_version
+SCHEMA_VERSION = migrations.LATEST_VERSION
+
+# Subclass attributes stored in their own columns instead of the attributes JSON
+TYPED_ATTRIBUTES = ('sport_type', 'style', 'material')
+
+# Columns the product listing can be filtered on
+PRODUCT_FILTERS = ('category', 'brand') + TYPED_ATTRIBUTES
+
+# Reorder point for products with no override and no category rule
+DEFAULT_REORDER_POINT = 5
+
+# Product columns an admin can change through the update routes
+EDITABLE_FIELDS = ('name', 'brand', 'price', 'color', 'image', 'stock') + TYPED_ATTRIBUTES
+
+# Ledger movement kinds and the sign their quantity is stored with
+# (adjustments keep whatever sign they are given)
+MOVEMENT_SIGNS = {'receipt': 1, 'return': 1, 'sale': -1, 'adjustment': None}
+
+# Loyalty points earned per dollar of a completed order, what one point is
+# worth at checkout, and how long earned points last
+LOYALTY_POINTS_PER_DOLLAR = 1
+LOYALTY_POINT_VALUE = 0.01
+LOYALTY_POINTS_LIFETIME_DAYS = 365
+
+# Products of an order counted for co-purchases (pairs grow quadratically)
+MAX_BASKET_PAIRS = 50
+
+# Set for work that has to see its own writes: reads skip the replicas
+read_primary = contextvars.ContextVar('read_primary', default=False)
+
+class VersionConflict(Exception):
+    """A compare-and-swap write found products changed (or deleted) since read.
+
+    conflicts is a list of {'id': ..., 'version': current version or None}.
+    """
+
+    def __init__(self, conflicts):
+        super().__init__(f'{len(conflicts)} product(s) were changed by someone else')
+        self.conflicts = conflicts
+
+
+class PooledConnection(sqlite3.Connection):
+    """A connection whose close() hands it back to its ConnectionPool"""
+
+    pool = None
+    checked_out = False
+
+    def commit(self):
+        if self.in_transaction and self.pool is not None:
+            self.pool.commits += 1
+        super().commit()
+
+    def close(self):
+        if self.pool is None:
+            super().close()
+        elif self.checked_out:
+            self.checked_out = False
+            self.pool.release(self)
+
+
+class ConnectionPool:
+    """Up to size idle connections to one database file, reused across requests.
+
+    Opening a SQLite connection means parsing the whole schema again on its
+    first statement, which costs more than most of our queries. Callers use
+    connections exactly as before: close() returns one to the pool, rolled
+    back and reset, or really closes it when the pool is full.
+
+    A read_only pool opens the file with mode=ro (replicas). commits counts
+    the write transactions committed through the pool.
+    """
+
+    def __init__(self, path, size=8, timeout=10, read_only=False):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.read_only = read_only
+        self.commits = 0
+        self.retired = False
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def connect(self):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            # handed from thread to thread, but only ever used by one at a time
+            if self.read_only:
+                target, uri = f'file:{quote(self.path)}?mode=ro', True
+            else:
+                target, uri = self.path, False
+            conn = sqlite3.connect(target, timeout=self.timeout, check_same_thread=False,
+                                   factory=PooledConnection, uri=uri)
+            conn.pool = self
+        conn.checked_out = True
+        return conn
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            # undo what callers may have changed (migrations switch to autocommit)
+            conn.isolation_level = ''
+            conn.row_factory = None
+        except sqlite3.Error:
+            sqlite3.Connection.close(conn)
+            return
+        with self._lock:
+            if len(self._idle) < self.size and not self.retired:
+                self._idle.append(conn)
+                return
+        sqlite3.Connection.close(conn)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            sqlite3.Connection.close(conn)
+
+    def retire(self):
+        """Close idle connections; the ones still out are closed when returned"""
+        self.retired = True
+        self.close_all()
+
 
 class DatabaseManager:
     """This class manages all the database operations for my store"""
 
-    def __init__(self):
-        self.db_name = Config.DATABASE_NAME
+    def __init__(self, db_name=None, pool_size=0):
+        self.db_name = db_name or Config.DATABASE_NAME
+        self.users = UserRepository(self)
+        self.pool = ConnectionPool(self.db_name, pool_size) if pool_size else None
+        # a ReplicaSet (replicas.py) when catalog reads go to read-only copies
+        self.replicas = None
 
     def get_connection(self):
         """get the database connected"""
-        conn = sqlite3.connect(self.db_name, timeout=10)
+        if self.pool is not None:
+            conn = self.pool.connect()
+        else:
+            conn = sqlite3.connect(self.db_name, timeout=10)
         conn.row_factory = sqlite3.Row
         return conn
+
+    def get_read_connection(self):
+        """Connection for catalog listings and reports: a replica if there is one.
+
+        Replicas lag the primary by up to a refresh, so anything that reads
+        back what it just wrote sets read_primary (or uses get_connection).
+        """
+        if self.replicas is not None and not read_primary.get():
+            conn = self.replicas.get_connection()
+            if conn is not None:
+                return conn
+        return self.get_connection()
     
-    def init_db(self):
-        """Initialize the database tables"""
+    def get_schema_version(self):
+        """Read the schema version stamped in PRAGMA user_version"""
         conn = self.get_connection()
-        cursor = conn.cursor()
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        conn.close()
+        return version
 
-        # Users table
+    def ensure_schema(self):
+        """Run init_db() only when the database is behind SCHEMA_VERSION.
 
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                email TEXT,
-                role TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-        
-        # Products Table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS products (
-                       id INTEGER PRIMARY KEY AUTOINCREMENT,
-                       name TEXT NOT NULL,
-                       brand TEXT NOT NULL,
-                       price REAL NOT NULL,
-                       size TEXT NOT NULL,
-                       stock INTEGER NOT NULL,
-                       color TEXT,
-                       category TEXT NOT NULL,
-                       attributes TEXT,
-                       image TEXT,
-                       created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                       )
-                       ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS orders(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                total REAL NOT NULL,
-                status TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(user_id) REFERENCES users(id)
-                )
-            ''')
-        
-        conn.commit()
+        Returns True if any migration had to be applied.
+        """
+        if self.get_schema_version() >= SCHEMA_VERSION:
+            return False
+        self.init_db()
+        return True
+
+    def init_db(self):
+        """Initialize the database tables by applying every pending migration"""
+        conn = self.get_connection()
+        applied = migrations.migrate(conn)
         conn.close()
+        return applied
+
+    def plan_migrations(self):
+        """Dry run: pending migrations with estimated durations, nothing applied"""
+        conn = self.get_connection()
+        report = migrations.plan(conn)
+        conn.close()
+        return report
 
     ### USER OPERATIONS ###
 
     def create_user(self, user):
-        """Create a new user"""
-        try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
+        """Create a new user; None if the username (in any case) is taken"""
+        return self.users.create(user)
 
-            cursor.execute('''
-                INSERT INTO users (username, password_hash, email, role)
-                VALUES (?, ?, ?, ?)
-            ''', (user.username, user.password_hash, user.email, user.role))
+    def create_users(self, users):
+        """Bulk-create users; returns (created count, skipped usernames)"""
+        return self.users.create_many(users)
 
-            user_id = cursor.lastrowid
-            conn.commit()
-            conn.close()
-            return user_id
-        except sqlite3.IntegrityError:
-            return None
     def get_user_by_id(self, user_id):
         """Get the user by unique ID"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute('SELECT * FROM users WHERE id = ?', (user_id,))
-        row = cursor.fetchone()
-        conn.close()
-
-        if row:
-            return dict(row)
-        return None
+        return self.users.get(user_id)
 
     def authenticate_user(self, username, password):
         """Authenticate user and return user data"""
-        from models.user import User
-
-        conn = self.get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
-        row = cursor.fetchone()
-        conn.close()
-
-        if row:
-            user_dict = dict(row)
-            user = User.from_dict(user_dict)
-            if user.verify_password(password):
-                return user_dict
-        
-        return None
+        return self.users.authenticate(username, password)
 
     ### PRODUCT OPERATIONS ###
 
@@ -120,54 +223,1329 @@ class DatabaseManager:
         conn = self.get_connection()
         cursor = conn.cursor()
 
-        # Serialize attributes dictionary to JSON string
-        attributes = json.dumps(product.get_attributes())
+        # Typed attributes get their own indexed columns; anything else the
+        # product reports is kept in the attributes JSON
+        extra = product.get_attributes()
+        typed = [extra.pop(column, None) for column in TYPED_ATTRIBUTES]
+        attributes = json.dumps(extra) if extra else None
         image = product.image if hasattr(product, 'image') else None
 
         cursor.execute('''
-            INSERT INTO products (name, brand, price, size, stock, color, category, attributes, image)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (product.name, product.brand, product.price, product.size, 
-              product.stock, product.color, product.category, attributes, image))
+            INSERT INTO products (name, brand, price, size, stock, color, category, attributes, image,
+                                  sport_type, style, material, reorder_point)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,
+                    COALESCE((SELECT reorder_point FROM reorder_rules WHERE category = ?), ?))
+        ''', (product.name, product.brand, product.price, product.size,
+              product.stock, product.color, product.category, attributes, image, *typed,
+              product.category, DEFAULT_REORDER_POINT))
 
         product_id = cursor.lastrowid
+        for variant in product.variants:
+            cursor.execute('''
+                INSERT INTO product_variants (product_id, size, color, stock)
+                VALUES (?, ?, ?, ?)
+            ''', (product_id, variant.size, variant.color or '', variant.stock))
+            if variant.stock:
+                # the opening stock goes through the ledger like any other receipt
+                cursor.execute('''
+                    INSERT INTO stock_movements (product_id, variant_id, kind, quantity, reference)
+                    VALUES (?, ?, 'receipt', ?, 'initial stock')
+                ''', (product_id, cursor.lastrowid, variant.stock))
+        self.refresh_effective_prices(conn, [product_id])
         conn.commit()
         conn.close()
         return product_id
 
-    def get_all_shoes(self):
-        """Get all shoes from the inventory"""
-        from models.product import Shoe
-        
-        conn = self.get_connection()
+    def get_all_shoes(self, filters=None, limit=None):
+        """Get all shoes from the inventory, optionally filtered.
+
+        filters maps any of PRODUCT_FILTERS to a value; every filter is an
+        indexed equality match done by SQLite, not in Python. limit caps the
+        number of rows (first page, in id order).
+        """
+        clauses = []
+        params = []
+        for column, value in (filters or {}).items():
+            if column in PRODUCT_FILTERS and value:
+                clauses.append(f'{column} = ?')
+                params.append(value)
+        conn = self.get_read_connection()
+        try:
+            return self._select_shoes(clauses, params, limit, conn)
+        finally:
+            conn.close()
+
+    def get_shoe(self, product_id):
+        """One shoe with its variants, or None"""
+        shoes = self._select_shoes(['id = ?'], [product_id])
+        return shoes[0] if shoes else None
+
+    def _select_shoes(self, clauses, params, limit=None, conn=None):
+        from models.product import shoe_from_dict
+
+        # sizes and colors come along as one JSON array per style, read
+        # through the (product_id, size, color) index, so the result has one
+        # row per style however many variants there are
+        query = '''
+            SELECT p.*,
+                   (SELECT json_group_array(json_object('id', v.id, 'size', v.size,
+                                                        'color', v.color, 'stock', v.stock))
+                    FROM product_variants v WHERE v.product_id = p.id) AS variants
+            FROM products p'''
+        if clauses:
+            query += f" WHERE {' AND '.join(clauses)}"
+        query += ' ORDER BY id'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(int(limit))
+
+        own_conn = conn is None
+        if own_conn:
+            conn = self.get_connection()
         cursor = conn.cursor()
 
-        cursor.execute('SELECT * FROM products')
+        cursor.execute(query, params)
         rows = cursor.fetchall()
-        conn.close()
+        if own_conn:
+            conn.close()
 
         shoes = []
         for row in rows:
             shoe_dict = dict(row)
             if shoe_dict.get('attributes'):
                 shoe_dict['attributes'] = json.loads(shoe_dict['attributes'])
-            shoe = Shoe.from_dict(shoe_dict)
-            # Ensure image is set from database
-            if 'image' in shoe_dict and shoe_dict['image']:
-                shoe._image = shoe_dict['image']
-            shoes.append(shoe)
+            shoes.append(shoe_from_dict(shoe_dict))
         
         return shoes
 
-    def get_user_by_username(self, username):
-        """Get user by username"""
+    def add_variant(self, product_id, size, color='', stock=0, created_by=None):
+        """Add a size/color to an existing style; returns the variant id.
+
+        Initial stock is booked as a ledger receipt and added to the style's
+        total. Raises ValueError for an unknown style or an existing variant.
+        """
+        conn = self.get_connection()
+        try:
+            try:
+                variant_id = conn.execute('''
+                    INSERT INTO product_variants (product_id, size, color, stock)
+                    SELECT id, ?, ?, 0 FROM products WHERE id = ?
+                ''', (str(size), color or '', product_id)).lastrowid
+            except sqlite3.IntegrityError:
+                raise ValueError(f'Size {size} {color} already exists')
+            if not conn.execute('SELECT changes()').fetchone()[0]:
+                raise ValueError(f'Unknown product: {product_id}')
+            if stock:
+                self.record_stock_movements([{
+                    'product_id': product_id, 'variant_id': variant_id,
+                    'kind': 'receipt', 'quantity': stock, 'reference': 'initial stock'
+                }], created_by=created_by, conn=conn)
+            conn.commit()
+            return variant_id
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def update_products(self, updates, created_by=None):
+        """Compare-and-swap updates of one or more products in one transaction.
+
+        updates is a list of (product_id, expected_version, changes) where
+        changes maps EDITABLE_FIELDS to new values. Each row is only written
+        if its version still matches; otherwise nothing is written and
+        VersionConflict is raised. A stock change is booked in the ledger as
+        an adjustment (only allowed for single-variant styles).
+
+        Returns {product_id: new version}.
+        """
+        conn = self.get_connection()
+        try:
+            # take the write lock up front so read-compare-write is atomic
+            conn.execute('BEGIN IMMEDIATE')
+            versions = {}
+            conflicts = []
+            movements = []
+            for product_id, expected_version, changes in updates:
+                unknown = set(changes) - set(EDITABLE_FIELDS)
+                if unknown:
+                    raise ValueError(f"Fields can't be changed: {', '.join(sorted(unknown))}")
+                current = conn.execute('SELECT version, stock FROM products WHERE id = ?',
+                                       (product_id,)).fetchone()
+                if current is None or current['version'] != expected_version:
+                    conflicts.append({'id': product_id, 'version': current['version'] if current else None})
+                    continue
+
+                assignments = ''.join(f'{column} = ?, ' for column in changes)
+                versions[product_id] = conn.execute(f'''
+                    UPDATE products SET {assignments}version = version + 1
+                    WHERE id = ? AND version = ?
+                    RETURNING version
+                ''', (*changes.values(), product_id, expected_version)).fetchone()[0]
+
+                delta = changes['stock'] - current['stock'] if 'stock' in changes else 0
+                if delta:
+                    variants = conn.execute('SELECT id FROM product_variants WHERE product_id = ?',
+                                            (product_id,)).fetchall()
+                    if len(variants) > 1:
+                        raise ValueError(f'Product {product_id} has several sizes; change stock per variant')
+                    variant_id = variants[0][0] if variants else None
+                    if variant_id is not None:
+                        conn.execute('UPDATE product_variants SET stock = ? WHERE id = ?',
+                                     (changes['stock'], variant_id))
+                    movements.append((product_id, variant_id, 'adjustment', delta, 'product update', created_by))
+
+            if conflicts:
+                raise VersionConflict(conflicts)
+            repriced = [product_id for product_id, _, changes in updates
+                        if {'price', 'brand'} & set(changes)]
+            if repriced:
+                self.refresh_effective_prices(conn, repriced)
+            conn.executemany('''
+                INSERT INTO stock_movements (product_id, variant_id, kind, quantity, reference, created_by)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', movements)
+            conn.commit()
+            return versions
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def delete_product(self, product_id, expected_version):
+        """Delete a product if its version still matches.
+
+        Returns False if it doesn't exist, raises VersionConflict if it was
+        changed. Ledger entries and snapshots are kept as history.
+        """
+        conn = self.get_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            deleted = conn.execute('DELETE FROM products WHERE id = ? AND version = ?',
+                                   (product_id, expected_version)).rowcount
+            if not deleted:
+                row = conn.execute('SELECT version FROM products WHERE id = ?', (product_id,)).fetchone()
+                if row is None:
+                    return False
+                raise VersionConflict([{'id': product_id, 'version': row[0]}])
+            conn.execute('DELETE FROM product_variants WHERE product_id = ?', (product_id,))
+            conn.commit()
+            return True
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            # also ends the transaction when nothing was deleted
+            conn.close()
+
+    def update_product_image(self, product_id, image):
+        """Point a product at a new image URL; False if the product doesn't exist"""
         conn = self.get_connection()
         cursor = conn.cursor()
 
-        cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
-        row = cursor.fetchone()
+        cursor.execute('UPDATE products SET image = ? WHERE id = ?', (image, product_id))
+        updated = cursor.rowcount > 0
+        conn.commit()
+        conn.close()
+        return updated
+
+    def get_catalog_version(self):
+        """Current catalog version; triggers bump it on every products change.
+
+        Read from the same place as get_all_shoes, so a listing cached under
+        this version really is that version.
+        """
+        conn = self.get_read_connection()
+        row = conn.execute('SELECT version FROM catalog_version WHERE id = 1').fetchone()
+        conn.close()
+        return row[0] if row else 0
+
+    def get_catalog_changes(self, since, limit=1000):
+        """What changed in the catalog after version since.
+
+        Returns {'version', 'reset', 'inserted', 'updated', 'deleted'}:
+        shoes created after since, other shoes changed after since, and ids
+        of deleted shoes. reset means the log can't answer (since is older
+        than what it keeps, from another database, or over limit products
+        changed) and the client should reload the whole catalog.
+        """
+        conn = self.get_read_connection()
+        try:
+            # one snapshot for the version and the rows
+            conn.execute('BEGIN')
+            version, floor = conn.execute(
+                'SELECT version, changes_since FROM catalog_version WHERE id = 1').fetchone()
+            changes = {'version': version, 'reset': False, 'inserted': [], 'updated': [], 'deleted': []}
+            if not floor <= since <= version:
+                changes['reset'] = True
+                return changes
+            rows = conn.execute('''
+                SELECT product_id, created_version, deleted FROM catalog_changes
+                WHERE version > ? ORDER BY product_id LIMIT ?
+            ''', (since, limit + 1)).fetchall()
+            if len(rows) > limit:
+                changes['reset'] = True
+                return changes
+
+            changed = [row['product_id'] for row in rows if not row['deleted']]
+            created = {row['product_id'] for row in rows if row['created_version'] > since}
+            shoes = self._select_shoes([f"id IN ({','.join('?' * len(changed))})"], changed,
+                                       conn=conn) if changed else []
+            for shoe in shoes:
+                changes['inserted' if shoe.id in created else 'updated'].append(shoe)
+            changes['deleted'] = [row['product_id'] for row in rows if row['deleted']]
+            return changes
+        finally:
+            conn.close()
+
+    def compact_catalog_changes(self, older_than_days=30):
+        """Forget changes older than the cutoff; returns how many rows went.
+
+        Clients that last synced before the newest forgotten change get a
+        reset instead of a delta.
+        """
+        conn = self.get_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            floor = conn.execute('''
+                SELECT MAX(version) FROM catalog_changes
+                WHERE changed_at < CAST(strftime('%s', 'now', ?) AS INTEGER)
+            ''', (f'{-int(older_than_days)} days',)).fetchone()[0]
+            if floor is None:
+                conn.rollback()
+                return 0
+            removed = conn.execute('DELETE FROM catalog_changes WHERE version <= ?', (floor,)).rowcount
+            conn.execute('UPDATE catalog_version SET changes_since = MAX(changes_since, ?) WHERE id = 1',
+                         (floor,))
+            conn.commit()
+            return removed
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def get_user_by_username(self, username):
+        """Get user by username (case-insensitive)"""
+        return self.users.get_by_username(username)
+
+    ### INVENTORY OPERATIONS ###
+
+    def get_low_stock(self, limit=None):
+        """Products at or under their reorder point, biggest shortfall first.
+
+        Served by the partial index idx_products_low_stock, which only holds
+        those rows, so the cost grows with the number of low-stock products
+        rather than with the catalog. SQLite keeps the index current on
+        every stock change.
+        """
+        query = '''
+            SELECT p.id, p.name, p.brand, p.category, p.size, p.color, p.stock,
+                   p.reorder_point, p.reorder_point - p.stock AS shortfall,
+                   COALESCE(r.reorder_quantity, p.reorder_point * 2) AS reorder_quantity
+            FROM products p INDEXED BY idx_products_low_stock
+            LEFT JOIN reorder_rules r ON r.category = p.category
+            WHERE p.stock <= p.reorder_point
+            ORDER BY shortfall DESC, p.id
+        '''
+        params = ()
+        if limit is not None:
+            query += ' LIMIT ?'
+            params = (int(limit),)
+
+        conn = self.get_read_connection()
+        rows = conn.execute(query, params).fetchall()
+        conn.close()
+
+        report = []
+        for row in rows:
+            item = dict(row)
+            # enough to get back over the reorder point plus one reorder batch
+            item['suggested_order'] = item['shortfall'] + item['reorder_quantity']
+            report.append(item)
+        return report
+
+    def get_reorder_rules(self):
+        """Per-category reorder settings"""
+        conn = self.get_connection()
+        rows = conn.execute('SELECT * FROM reorder_rules ORDER BY category').fetchall()
+        conn.close()
+        return [dict(row) for row in rows]
+
+    def set_reorder_rule(self, category, reorder_point, reorder_quantity=None):
+        """Create or change a category rule and re-resolve that category's products"""
+        if reorder_quantity is None:
+            reorder_quantity = reorder_point * 2
+        conn = self.get_connection()
+        conn.execute('''
+            INSERT INTO reorder_rules (category, reorder_point, reorder_quantity) VALUES (?, ?, ?)
+            ON CONFLICT(category) DO UPDATE SET reorder_point = excluded.reorder_point,
+                                                reorder_quantity = excluded.reorder_quantity
+        ''', (category, int(reorder_point), int(reorder_quantity)))
+        self._resolve_reorder_points(conn, 'category = ?', (category,))
+        conn.commit()
+        conn.close()
+
+    def delete_reorder_rule(self, category):
+        """Remove a category rule; its products fall back to the default"""
+        conn = self.get_connection()
+        deleted = conn.execute('DELETE FROM reorder_rules WHERE category = ?', (category,)).rowcount
+        self._resolve_reorder_points(conn, 'category = ?', (category,))
+        conn.commit()
+        conn.close()
+        return deleted > 0
+
+    def set_product_reorder_point(self, product_id, reorder_point):
+        """Set (or with None, clear) a product's own reorder point"""
+        conn = self.get_connection()
+        updated = conn.execute('UPDATE products SET reorder_override = ? WHERE id = ?',
+                               (reorder_point, product_id)).rowcount
+        self._resolve_reorder_points(conn, 'id = ?', (product_id,))
+        conn.commit()
+        conn.close()
+        return updated > 0
+
+    def _resolve_reorder_points(self, conn, where, params):
+        """Recompute the effective reorder_point for the matching products"""
+        conn.execute(f'''
+            UPDATE products SET reorder_point = COALESCE(
+                reorder_override,
+                (SELECT r.reorder_point FROM reorder_rules r WHERE r.category = products.category),
+                ?)
+            WHERE {where}
+        ''', (DEFAULT_REORDER_POINT, *params))
+
+    def take_stock_snapshot(self, snapshot_date):
+        """Record every product's stock for a day (re-running replaces that day)"""
+        conn = self.get_connection()
+        cursor = conn.execute('''
+            INSERT OR REPLACE INTO stock_snapshots (snapshot_date, product_id, stock, reorder_point)
+            SELECT ?, id, stock, reorder_point FROM products
+        ''', (snapshot_date,))
+        count = cursor.rowcount
+        conn.commit()
+        conn.close()
+        return count
+
+    def get_stock_trend(self, product_id, since_date):
+        """Daily snapshots for one product from since_date on (oldest first)"""
+        conn = self.get_read_connection()
+        rows = conn.execute('''
+            SELECT snapshot_date, stock, reorder_point FROM stock_snapshots
+            WHERE product_id = ? AND snapshot_date >= ?
+            ORDER BY snapshot_date
+        ''', (product_id, since_date)).fetchall()
+        conn.close()
+        return [dict(row) for row in rows]
+
+    ### STOCK LEDGER ###
+
+    def record_stock_movements(self, movements, created_by=None, conn=None):
+        """Append movements to the ledger and apply them to products.stock.
+
+        movements is a list of dicts with product_id, kind, quantity and
+        optional variant_id and reference. variant_id may be left out for a
+        style that has only one size/color. Everything is written in one
+        transaction with batched inserts and one UPDATE per variant and per
+        product; if any of them would go below zero (or doesn't exist)
+        nothing is written and ValueError is raised. Pass conn to join a
+        transaction the caller already holds.
+
+        Returns {product_id: new stock}.
+        """
+        parsed = []
+        for movement in movements:
+            kind = movement.get('kind')
+            if kind not in MOVEMENT_SIGNS:
+                raise ValueError(f'Unknown movement kind: {kind}')
+            quantity = int(movement['quantity'])
+            sign = MOVEMENT_SIGNS[kind]
+            if sign is not None:
+                quantity = sign * abs(quantity)
+            variant_id = movement.get('variant_id')
+            parsed.append((int(movement['product_id']), None if variant_id is None else int(variant_id),
+                           kind, quantity, movement.get('reference')))
+
+        own_conn = conn is None
+        if own_conn:
+            conn = self.get_connection()
+        try:
+            parsed = self._resolve_variants(conn, parsed)
+            rows = []
+            deltas = {}
+            variant_deltas = {}
+            for product_id, variant_id, kind, quantity, reference in parsed:
+                rows.append((product_id, variant_id, kind, quantity, reference, created_by))
+                deltas[product_id] = deltas.get(product_id, 0) + quantity
+                if variant_id is not None:
+                    key = (product_id, variant_id)
+                    variant_deltas[key] = variant_deltas.get(key, 0) + quantity
+
+            conn.executemany('''
+                INSERT INTO stock_movements (product_id, variant_id, kind, quantity, reference, created_by)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', rows)
+
+            for (product_id, variant_id), delta in variant_deltas.items():
+                updated = conn.execute('''
+                    UPDATE product_variants SET stock = stock + ?
+                    WHERE id = ? AND product_id = ? AND stock + ? >= 0
+                ''', (delta, variant_id, product_id, delta)).rowcount
+                if not updated:
+                    raise ValueError(f'Insufficient stock or unknown variant: {variant_id}')
+
+            levels = {}
+            for product_id, delta in deltas.items():
+                row = conn.execute('''
+                    UPDATE products SET stock = stock + ?
+                    WHERE id = ? AND stock + ? >= 0
+                    RETURNING stock
+                ''', (delta, product_id, delta)).fetchone()
+                if row is None:
+                    raise ValueError(f'Insufficient stock or unknown product: {product_id}')
+                levels[product_id] = row[0]
+            if own_conn:
+                conn.commit()
+            return levels
+        except Exception:
+            if own_conn:
+                conn.rollback()
+            raise
+        finally:
+            if own_conn:
+                conn.close()
+
+    def _resolve_variants(self, conn, movements):
+        """Fill in the variant of movements that left it out.
+
+        Only possible for styles with exactly one variant; styles with none
+        (rows that predate variants) keep variant_id None.
+        """
+        missing = {movement[0] for movement in movements if movement[1] is None}
+        if not missing:
+            return movements
+        placeholders = ','.join('?' * len(missing))
+        only = {}
+        for product_id, variant_id, count in conn.execute(f'''
+                SELECT product_id, MIN(id), COUNT(*) FROM product_variants
+                WHERE product_id IN ({placeholders}) GROUP BY product_id
+                ''', tuple(missing)):
+            if count > 1:
+                raise ValueError(f'variant_id is required for product {product_id}')
+            only[product_id] = variant_id
+        return [(product_id, only.get(product_id) if variant_id is None else variant_id, *rest)
+                for product_id, variant_id, *rest in movements]
+
+    def get_stock_movements(self, product_id, limit=100):
+        """Most recent ledger entries for one product"""
+        conn = self.get_connection()
+        rows = conn.execute('''
+            SELECT * FROM stock_movements WHERE product_id = ?
+            ORDER BY id DESC LIMIT ?
+        ''', (product_id, limit)).fetchall()
+        conn.close()
+        return [dict(row) for row in rows]
+
+    def audit_stock(self, product_id):
+        """Compare products.stock with compacted balance + remaining ledger"""
+        conn = self.get_connection()
+        row = conn.execute('''
+            SELECT p.stock,
+                   COALESCE((SELECT quantity FROM stock_balances WHERE product_id = p.id), 0)
+                 + COALESCE((SELECT SUM(quantity) FROM stock_movements WHERE product_id = p.id), 0)
+            FROM products p WHERE p.id = ?
+        ''', (product_id,)).fetchone()
+        conn.close()
+        if not row:
+            return None
+        return {'stock': row[0], 'ledger': row[1], 'consistent': row[0] == row[1]}
+
+    def compact_stock_movements(self, older_than_days=30, batch_size=1000):
+        """Fold old movements into stock_balances and delete them.
+
+        Works through the ledger in id order, one short transaction per
+        batch, so compaction never holds the write lock for long. Returns the
+        number of movements folded.
+        """
+        conn = self.get_connection()
+        folded = 0
+        try:
+            while True:
+                rows = conn.execute('''
+                    SELECT id, product_id, quantity FROM stock_movements
+                    WHERE created_at < datetime('now', ?)
+                    ORDER BY id LIMIT ?
+                ''', (f'{-int(older_than_days)} days', batch_size)).fetchall()
+                if not rows:
+                    break
+
+                totals = {}
+                for movement_id, product_id, quantity in rows:
+                    total = totals.setdefault(product_id, [0, 0, 0])
+                    total[0] += quantity
+                    total[1] = max(total[1], movement_id)
+                    total[2] += 1
+
+                conn.executemany('''
+                    INSERT INTO stock_balances (product_id, quantity, through_id, movements)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(product_id) DO UPDATE SET
+                        quantity = quantity + excluded.quantity,
+                        through_id = MAX(through_id, excluded.through_id),
+                        movements = movements + excluded.movements,
+                        updated_at = CURRENT_TIMESTAMP
+                ''', [(product_id, *total) for product_id, total in totals.items()])
+                conn.executemany('DELETE FROM stock_movements WHERE id = ?',
+                                 [(row[0],) for row in rows])
+                conn.commit()
+                folded += len(rows)
+                if len(rows) < batch_size:
+                    break
+        finally:
+            conn.close()
+        return folded
+
+    ### ORDER OPERATIONS ###
+
+    def create_order(self, user_id, items, redeem_points=0):
+        """Place an order at current effective prices and take its stock.
+
+        items is a list of {"product_id", "quantity"} dicts, with variant_id
+        for styles that come in several sizes. redeem_points loyalty points
+        come off the total at LOYALTY_POINT_VALUE each. The order, its
+        items, the ledger sales and the points are written in one
+        transaction; ValueError (nothing written) for unknown products, not
+        enough stock or not enough points. Returns the Order.
+        """
+        if not items:
+            raise ValueError('An order needs at least one item')
+        redeem_points = int(redeem_points or 0)
+        if redeem_points < 0:
+            raise ValueError('Points to redeem cannot be negative')
+        lines = []
+        for item in items:
+            quantity = int(item['quantity'])
+            if quantity <= 0:
+                raise ValueError('Quantities must be positive')
+            variant_id = item.get('variant_id')
+            lines.append((int(item['product_id']), None if variant_id is None else int(variant_id), quantity))
+
+        conn = self.get_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            product_ids = sorted({product_id for product_id, _, _ in lines})
+            products = {row['id']: row for row in conn.execute(f'''
+                SELECT id, name, effective_price FROM products
+                WHERE id IN ({','.join('?' * len(product_ids))})
+            ''', product_ids)}
+            missing = [product_id for product_id in product_ids if product_id not in products]
+            if missing:
+                raise ValueError(f'Unknown product: {missing[0]}')
+            # record which size was sold even when the style only has one
+            lines = self._resolve_variants(conn, lines)
+
+            total = sum(products[product_id]['effective_price'] * quantity for product_id, _, quantity in lines)
+            if redeem_points * LOYALTY_POINT_VALUE > total:
+                raise ValueError('Cannot redeem more points than the order is worth')
+            total = round(total - redeem_points * LOYALTY_POINT_VALUE, 2)
+            order_id = conn.execute("INSERT INTO orders (user_id, total, status) VALUES (?, ?, 'pending')",
+                                    (user_id, total)).lastrowid
+            conn.executemany('''
+                INSERT INTO order_items (order_id, product_id, variant_id, product_name, quantity, price)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [(order_id, product_id, variant_id, products[product_id]['name'], quantity,
+                   products[product_id]['effective_price'])
+                  for product_id, variant_id, quantity in lines])
+            self.record_stock_movements([
+                {'product_id': product_id, 'variant_id': variant_id, 'kind': 'sale',
+                 'quantity': quantity, 'reference': f'order {order_id}'}
+                for product_id, variant_id, quantity in lines
+            ], created_by=user_id, conn=conn)
+            if redeem_points:
+                self._redeem_points(conn, user_id, redeem_points, order_id)
+            self._count_co_purchases(conn, [[product_id for product_id, _, _ in lines]])
+            self.publish_events(conn, [('order.created', order_id, {
+                'order_id': order_id, 'user_id': user_id, 'total': total, 'status': 'pending'})])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return self.get_order(order_id)
+
+    def get_order(self, order_id):
+        """One order with its items, or None"""
+        orders = self._orders_with_items(['id = ?'], [order_id], limit=1)
+        return orders[0] if orders else None
+
+    def get_orders(self, user_id=None, status=None, since=None, until=None, after=None, limit=20):
+        """A page of orders, newest first, and the cursor of the last one.
+
+        Keyset pagination: after is the (created_at, id) of the last order
+        of the previous page, so every page is one index range scan no
+        matter how deep it is. since/until bound created_at (until is
+        exclusive). Returns (orders, cursor or None when this is the end).
+        """
+        clauses = []
+        params = []
+        for clause, value in (('user_id = ?', user_id), ('status = ?', status),
+                              ('created_at >= ?', since), ('created_at < ?', until)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        if after is not None:
+            clauses.append('(created_at, id) < (?, ?)')
+            params.extend(after)
+
+        # one extra row says whether there is another page
+        orders = self._orders_with_items(clauses, params, limit + 1)
+        if len(orders) <= limit:
+            return orders, None
+        orders = orders[:limit]
+        last = orders[-1]
+        return orders, (last.created_at.strftime('%Y-%m-%d %H:%M:%S'), last.id)
+
+    def get_sales_summary(self, since=None, until=None):
+        """Orders and revenue per status, placed in [since, until).
+
+        Read from idx_orders_created, which carries status and total, so
+        the table itself is never touched.
+        """
+        clauses = []
+        params = []
+        for clause, value in (('created_at >= ?', since), ('created_at < ?', until)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        conn = self.get_read_connection()
+        rows = conn.execute(f'''
+            SELECT status, COUNT(*) AS orders, ROUND(SUM(total), 2) AS revenue
+            FROM orders INDEXED BY idx_orders_created {where}
+            GROUP BY status
+        ''', params).fetchall()
+        conn.close()
+        return {row['status']: {'orders': row['orders'], 'revenue': row['revenue']} for row in rows}
+
+    def _orders_with_items(self, clauses, params, limit):
+        from models.order import Order
+
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        conn = self.get_connection()
+        rows = conn.execute(f'''
+            SELECT id, user_id, total, status, created_at FROM orders {where}
+            ORDER BY created_at DESC, id DESC LIMIT ?
+        ''', (*params, limit)).fetchall()
+
+        # the items of the whole page in one query, not one per order
+        items = {}
+        if rows:
+            order_ids = [row['id'] for row in rows]
+            for item in conn.execute(f'''
+                    SELECT * FROM order_items
+                    WHERE order_id IN ({','.join('?' * len(order_ids))})
+                    ORDER BY order_id, id
+                    ''', order_ids):
+                items.setdefault(item['order_id'], []).append(dict(item))
+        conn.close()
+
+        orders = []
+        for row in rows:
+            data = dict(row)
+            data['updated_at'] = data['created_at']
+            data['items'] = items.get(row['id'], [])
+            orders.append(Order.from_dict(data))
+        return orders
+
+    def transition_orders(self, order_ids, status, from_status=None, user_id=None,
+                          created_by=None, batch_size=500):
+        """Move orders to a new status, batch by batch.
+
+        Each batch is one transaction: a read of the current statuses, one
+        UPDATE for every order in it that may make the move (see
+        ORDER_TRANSITIONS), an outbox event per order moved and, for
+        cancellations, the stock going back on the shelf. Orders that can't
+        move (wrong status, not from_status, not user_id's, or unknown) are
+        skipped, not errors. Returns (moved ids, skipped ids).
+        """
+        from models.order import ORDER_STATUSES, statuses_leading_to
+
+        if status not in ORDER_STATUSES:
+            raise ValueError(f'Status must be one of {list(ORDER_STATUSES)}')
+        sources = statuses_leading_to(status)
+        if from_status is not None:
+            if from_status not in sources:
+                raise ValueError(f'Orders cannot move from {from_status} to {status}')
+            sources = (from_status,)
+        order_ids = list(dict.fromkeys(int(order_id) for order_id in order_ids))
+
+        moved = []
+        conn = self.get_connection()
+        try:
+            for first in range(0, len(order_ids), batch_size):
+                batch = order_ids[first:first + batch_size]
+                conn.execute('BEGIN IMMEDIATE')
+                rows = conn.execute(f'''
+                    SELECT id, user_id, total, status FROM orders
+                    WHERE id IN ({','.join('?' * len(batch))})
+                ''', batch).fetchall()
+                rows = [row for row in rows
+                        if row['status'] in sources and (user_id is None or row['user_id'] == user_id)]
+                if not rows:
+                    conn.rollback()
+                    continue
+                ids = [row['id'] for row in rows]
+                conn.execute(f'''
+                    UPDATE orders SET status = ?
+                    WHERE id IN ({','.join('?' * len(ids))})
+                ''', (status, *ids))
+                if status == 'cancelled':
+                    self._restock_orders(conn, ids, created_by)
+                    self._refund_points(conn, ids)
+                    self._count_co_purchases(conn, self._order_baskets(conn, ids), -1)
+                elif status == 'completed':
+                    self._earn_points(conn, rows)
+                self.publish_events(conn, [('order.status_changed', row['id'], {
+                    'order_id': row['id'], 'user_id': row['user_id'], 'total': row['total'],
+                    'from': row['status'], 'to': status}) for row in rows])
+                conn.commit()
+                moved.extend(ids)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        moved_set = set(moved)
+        return moved, [order_id for order_id in order_ids if order_id not in moved_set]
+
+    def transition_orders_in_status(self, from_status, status, until=None, created_by=None, batch_size=500):
+        """Move every order in from_status (placed before until, if given).
+
+        Walks the orders in id order a batch at a time, so a fulfilment run
+        over thousands of orders never holds the write lock for long.
+        Returns the number of orders moved.
+        """
+        from models.order import statuses_leading_to
+
+        if from_status not in statuses_leading_to(status):
+            raise ValueError(f'Orders cannot move from {from_status} to {status}')
+        clauses = ['status = ?', 'id > ?']
+        if until is not None:
+            clauses.append('created_at < ?')
+        count = 0
+        last_id = 0
+        while True:
+            params = [from_status, last_id] + ([until] if until is not None else [])
+            conn = self.get_connection()
+            ids = [row[0] for row in conn.execute(f'''
+                SELECT id FROM orders WHERE {' AND '.join(clauses)}
+                ORDER BY id LIMIT ?
+            ''', (*params, batch_size))]
+            conn.close()
+            if not ids:
+                return count
+            moved, _ = self.transition_orders(ids, status, from_status=from_status,
+                                              created_by=created_by, batch_size=batch_size)
+            count += len(moved)
+            last_id = ids[-1]
+
+    def _restock_orders(self, conn, order_ids, created_by=None):
+        """Book the items of cancelled orders back in as returns.
+
+        Items whose product or variant has been deleted since are skipped
+        (and logged): there is no stock left to put them back into.
+        """
+        rows = conn.execute(f'''
+            SELECT oi.order_id, oi.product_id, oi.variant_id, oi.quantity,
+                   EXISTS (SELECT 1 FROM products p WHERE p.id = oi.product_id)
+                   AND (oi.variant_id IS NULL OR EXISTS (SELECT 1 FROM product_variants v
+                                                        WHERE v.id = oi.variant_id)) AS in_catalog
+            FROM order_items oi
+            WHERE oi.order_id IN ({','.join('?' * len(order_ids))})
+        ''', order_ids).fetchall()
+        items = [row for row in rows if row['in_catalog']]
+        for row in rows:
+            if not row['in_catalog']:
+                logger.warning('Not restocking %s x product %s (variant %s) of cancelled order %s: '
+                               'no longer in the catalog', row['quantity'], row['product_id'],
+                               row['variant_id'], row['order_id'])
+        if items:
+            self.record_stock_movements([
+                {'product_id': item['product_id'], 'variant_id': item['variant_id'], 'kind': 'return',
+                 'quantity': item['quantity'], 'reference': f"order {item['order_id']} cancelled"}
+                for item in items
+            ], created_by=created_by, conn=conn)
+
+    ### OUTBOX ###
+
+    def publish_events(self, conn, events):
+        """Add (topic, key, payload) events to the outbox in conn's transaction"""
+        conn.executemany('INSERT INTO outbox (topic, key, payload) VALUES (?, ?, ?)',
+                         [(topic, str(key), json.dumps(payload)) for topic, key, payload in events])
+
+    def get_events(self, after=0, topic=None, limit=100):
+        """Outbox events with id > after, oldest first"""
+        clauses = ['id > ?']
+        params = [after]
+        if topic is not None:
+            clauses.append('topic = ?')
+            params.append(topic)
+        conn = self.get_connection()
+        rows = conn.execute(f'''
+            SELECT * FROM outbox WHERE {' AND '.join(clauses)}
+            ORDER BY id LIMIT ?
+        ''', (*params, limit)).fetchall()
+        conn.close()
+        events = []
+        for row in rows:
+            event = dict(row)
+            event['payload'] = json.loads(event['payload'])
+            events.append(event)
+        return events
+
+    def get_consumer_offset(self, consumer):
+        """Id of the last event a consumer acknowledged (0 if none)"""
+        conn = self.get_connection()
+        row = conn.execute('SELECT last_id FROM outbox_offsets WHERE consumer = ?', (consumer,)).fetchone()
+        conn.close()
+        return row[0] if row else 0
+
+    def ack_events(self, consumer, last_id):
+        """Record that a consumer has handled every event up to last_id.
+
+        Offsets only move forward, so a late or repeated ack is harmless.
+        Returns the stored offset.
+        """
+        conn = self.get_connection()
+        offset = conn.execute('''
+            INSERT INTO outbox_offsets (consumer, last_id) VALUES (?, ?)
+            ON CONFLICT(consumer) DO UPDATE SET
+                last_id = MAX(last_id, excluded.last_id),
+                updated_at = CURRENT_TIMESTAMP
+            RETURNING last_id
+        ''', (consumer, int(last_id))).fetchone()[0]
+        conn.commit()
+        conn.close()
+        return offset
+
+    def prune_events(self, older_than_days=7):
+        """Delete old events that every known consumer has acknowledged"""
+        conn = self.get_connection()
+        count = conn.execute('''
+            DELETE FROM outbox
+            WHERE created_at < datetime('now', ?)
+              AND id <= (SELECT COALESCE(MIN(last_id), 0) FROM outbox_offsets)
+        ''', (f'{-int(older_than_days)} days',)).rowcount
+        conn.commit()
+        conn.close()
+        return count
+
+    ### LOYALTY POINTS ###
+
+    def get_loyalty_balance(self, user_id):
+        """Current points of a user: one primary key read, the ledger isn't summed"""
+        conn = self.get_connection()
+        row = conn.execute('SELECT loyalty_points FROM users WHERE id = ?', (user_id,)).fetchone()
+        conn.close()
+        return row[0] if row else None
+
+    def get_loyalty_history(self, user_id, limit=50):
+        """Most recent ledger entries of a user"""
+        conn = self.get_connection()
+        rows = conn.execute('''
+            SELECT id, kind, points, remaining, expires_at, order_id, created_at
+            FROM loyalty_points WHERE user_id = ?
+            ORDER BY id DESC LIMIT ?
+        ''', (user_id, limit)).fetchall()
         conn.close()
+        return [dict(row) for row in rows]
+
+    def audit_loyalty(self, user_id):
+        """Compare the cached balance with the ledger and the unspent lots"""
+        conn = self.get_connection()
+        row = conn.execute('''
+            SELECT u.loyalty_points,
+                   (SELECT COALESCE(SUM(points), 0) FROM loyalty_points WHERE user_id = u.id),
+                   (SELECT COALESCE(SUM(remaining), 0) FROM loyalty_points WHERE user_id = u.id AND remaining > 0)
+            FROM users u WHERE u.id = ?
+        ''', (user_id,)).fetchone()
+        conn.close()
+        if not row:
+            return None
+        return {'balance': row[0], 'ledger': row[1], 'unspent': row[2],
+                'consistent': row[0] == row[1] == row[2]}
+
+    def _credit_points(self, conn, kind, credits):
+        """Add (user_id, points, order_id) lots that expire after the lifetime"""
+        credits = [credit for credit in credits if credit[1] > 0]
+        if not credits:
+            return
+        conn.executemany(f'''
+            INSERT INTO loyalty_points (user_id, kind, points, remaining, expires_at, order_id)
+            VALUES (?, '{kind}', ?, ?, datetime('now', '+{LOYALTY_POINTS_LIFETIME_DAYS} days'), ?)
+        ''', [(user_id, points, points, order_id) for user_id, points, order_id in credits])
+        self._adjust_balances(conn, [(user_id, points) for user_id, points, _ in credits])
+
+    def _adjust_balances(self, conn, changes):
+        totals = {}
+        for user_id, points in changes:
+            totals[user_id] = totals.get(user_id, 0) + points
+        conn.executemany('UPDATE users SET loyalty_points = loyalty_points + ? WHERE id = ?',
+                         [(points, user_id) for user_id, points in totals.items()])
+
+    def _earn_points(self, conn, orders):
+        """Credit completed orders, LOYALTY_POINTS_PER_DOLLAR of their total"""
+        self._credit_points(conn, 'earn', [(order['user_id'], int(order['total'] * LOYALTY_POINTS_PER_DOLLAR),
+                                            order['id']) for order in orders])
+
+    def _refund_points(self, conn, order_ids):
+        """Give back the points cancelled orders were paid with, as fresh lots"""
+        self._credit_points(conn, 'refund', [tuple(row) for row in conn.execute(f'''
+            SELECT user_id, -points, order_id FROM loyalty_points
+            WHERE kind = 'redeem' AND order_id IN ({','.join('?' * len(order_ids))})
+        ''', order_ids)])
+
+    def _redeem_points(self, conn, user_id, points, order_id):
+        """Spend points on an order, oldest-expiring lots first; ValueError if short"""
+        row = conn.execute('''
+            UPDATE users SET loyalty_points = loyalty_points - ?
+            WHERE id = ? AND loyalty_points >= ?
+            RETURNING loyalty_points
+        ''', (points, user_id, points)).fetchone()
+        if row is None:
+            raise ValueError('Not enough loyalty points')
+        spent = []
+        left = points
+        for lot_id, remaining in conn.execute('''
+                SELECT id, remaining FROM loyalty_points
+                WHERE user_id = ? AND remaining > 0
+                ORDER BY expires_at, id
+                ''', (user_id,)):
+            take = min(left, remaining)
+            spent.append((take, lot_id))
+            left -= take
+            if not left:
+                break
+        conn.executemany('UPDATE loyalty_points SET remaining = remaining - ? WHERE id = ?', spent)
+        conn.execute('''
+            INSERT INTO loyalty_points (user_id, kind, points, order_id) VALUES (?, 'redeem', ?, ?)
+        ''', (user_id, -points, order_id))
+
+    def expire_loyalty_points(self, batch_size=1000):
+        """Expire the unspent points of lots past their date.
+
+        Works through the expiring-lots index one batch per transaction, so
+        checkouts are never held up for long. Returns the points expired.
+        """
+        conn = self.get_connection()
+        expired = 0
+        try:
+            while True:
+                conn.execute('BEGIN IMMEDIATE')
+                lots = conn.execute('''
+                    SELECT id, user_id, remaining FROM loyalty_points
+                    WHERE remaining > 0 AND expires_at <= datetime('now')
+                    ORDER BY expires_at LIMIT ?
+                ''', (batch_size,)).fetchall()
+                if not lots:
+                    conn.rollback()
+                    break
+                conn.executemany('UPDATE loyalty_points SET remaining = 0 WHERE id = ?',
+                                 [(lot['id'],) for lot in lots])
+                conn.executemany('''
+                    INSERT INTO loyalty_points (user_id, kind, points) VALUES (?, 'expire', ?)
+                ''', [(lot['user_id'], -lot['remaining']) for lot in lots])
+                self._adjust_balances(conn, [(lot['user_id'], -lot['remaining']) for lot in lots])
+                conn.commit()
+                expired += sum(lot['remaining'] for lot in lots)
+                if len(lots) < batch_size:
+                    break
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return expired
+
+    ### RECOMMENDATIONS ###
+
+    def _order_baskets(self, conn, order_ids):
+        """Product ids of each order, one list per order"""
+        baskets = {}
+        for order_id, product_id in conn.execute(f'''
+                SELECT order_id, product_id FROM order_items
+                WHERE order_id IN ({','.join('?' * len(order_ids))})
+                ''', order_ids):
+            baskets.setdefault(order_id, []).append(product_id)
+        return list(baskets.values())
+
+    def _count_co_purchases(self, conn, baskets, sign=1):
+        """Add (sign=-1: take back) every pair of products bought together.
+
+        Only the touched cells of the matrix are written, and the products
+        involved are queued for refresh_related_products.
+        """
+        pairs = {}
+        for basket in baskets:
+            # pairs grow with the square of the basket; huge orders say little
+            product_ids = sorted(set(basket))[:MAX_BASKET_PAIRS]
+            for product_id in product_ids:
+                for other_id in product_ids:
+                    if product_id != other_id:
+                        pairs[(product_id, other_id)] = pairs.get((product_id, other_id), 0) + sign
+        if not pairs:
+            return
+        conn.executemany('''
+            INSERT INTO co_purchases (product_id, other_id, count) VALUES (?, ?, ?)
+            ON CONFLICT(product_id, other_id) DO UPDATE SET count = count + excluded.count
+        ''', [(product_id, other_id, count) for (product_id, other_id), count in pairs.items()])
+        conn.executemany('INSERT OR IGNORE INTO related_stale (product_id) VALUES (?)',
+                         [(product_id,) for product_id in {pair[0] for pair in pairs}])
+
+    def rebuild_co_purchases(self):
+        """Recount the whole matrix from order history (all but cancelled orders)"""
+        conn = self.get_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM co_purchases')
+            conn.execute('''
+                INSERT INTO co_purchases (product_id, other_id, count)
+                SELECT a.product_id, b.product_id, COUNT(DISTINCT a.order_id)
+                FROM order_items a
+                JOIN order_items b ON b.order_id = a.order_id AND b.product_id != a.product_id
+                JOIN orders o ON o.id = a.order_id AND o.status != 'cancelled'
+                GROUP BY a.product_id, b.product_id
+            ''')
+            conn.execute('DELETE FROM related_products')
+            conn.execute('INSERT OR IGNORE INTO related_stale SELECT DISTINCT product_id FROM co_purchases')
+            pairs = conn.execute('SELECT COUNT(*) FROM co_purchases').fetchone()[0]
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return pairs
+
+    def refresh_related_products(self, top_k=10, batch_size=500):
+        """Recompute the top_k neighbours of products whose counts changed.
+
+        One short transaction per batch of stale products; each batch is a
+        single ranked INSERT ... SELECT over their rows of the matrix.
+        Returns the number of products refreshed.
+        """
+        conn = self.get_connection()
+        refreshed = 0
+        try:
+            while True:
+                conn.execute('BEGIN IMMEDIATE')
+                ids = [row[0] for row in conn.execute('SELECT product_id FROM related_stale LIMIT ?',
+                                                      (batch_size,))]
+                if not ids:
+                    conn.rollback()
+                    break
+                placeholders = ','.join('?' * len(ids))
+                conn.execute(f'DELETE FROM co_purchases WHERE product_id IN ({placeholders}) AND count <= 0', ids)
+                conn.execute(f'DELETE FROM related_products WHERE product_id IN ({placeholders})', ids)
+                conn.execute(f'''
+                    INSERT INTO related_products (product_id, rank, related_id, score)
+                    SELECT product_id, rank, other_id, count FROM (
+                        SELECT c.product_id, c.other_id, c.count,
+                               ROW_NUMBER() OVER (PARTITION BY c.product_id
+                                                  ORDER BY c.count DESC, c.other_id) AS rank
+                        FROM co_purchases c JOIN products p ON p.id = c.other_id
+                        WHERE c.product_id IN ({placeholders})
+                    ) WHERE rank <= ?
+                ''', (*ids, top_k))
+                conn.execute(f'DELETE FROM related_stale WHERE product_id IN ({placeholders})', ids)
+                conn.commit()
+                refreshed += len(ids)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return refreshed
+
+    def get_related_products(self, product_id, limit=8):
+        """Shoes bought together with this one, best first, or None if unknown.
+
+        Reads the precomputed neighbours; when there are fewer than limit
+        (a new or rarely bought shoe) the rest are the closest in price of
+        the same brand and category, then of the same category.
+        """
+        conn = self.get_read_connection()
+        try:
+            product = conn.execute('SELECT id, category, brand, price FROM products WHERE id = ?',
+                                   (product_id,)).fetchone()
+            if product is None:
+                return None
+            ids = [row[0] for row in conn.execute('''
+                SELECT related_id FROM related_products WHERE product_id = ?
+                ORDER BY rank LIMIT ?
+            ''', (product_id, limit))]
+            if len(ids) < limit:
+                ids += self._similar_product_ids(conn, product, limit - len(ids), {product_id, *ids})
+            shoes = {shoe.id: shoe for shoe in self._select_shoes(
+                [f"id IN ({','.join('?' * len(ids))})"], ids, conn=conn)} if ids else {}
+        finally:
+            conn.close()
+        return [shoes[shoe_id] for shoe_id in ids if shoe_id in shoes]
+
+    def _similar_product_ids(self, conn, product, count, exclude):
+        """Ids of up to count products nearest in price within the same brand+category, then category"""
+        found = []
+        for clause, params in (('category = ? AND brand = ?', (product['category'], product['brand'])),
+                               ('category = ?', (product['category'],))):
+            # the nearest prices lie on either side of this one in the index
+            window = count + len(exclude) + len(found)
+            nearest = conn.execute(f'''
+                SELECT * FROM (SELECT id, price FROM products WHERE {clause} AND price >= ?
+                               ORDER BY price LIMIT ?)
+                UNION ALL
+                SELECT * FROM (SELECT id, price FROM products WHERE {clause} AND price < ?
+                               ORDER BY price DESC LIMIT ?)
+            ''', (*params, product['price'], window, *params, product['price'], window)).fetchall()
+            nearest.sort(key=lambda row: (abs(row[1] - product['price']), row[0]))
+            for row in nearest:
+                if row[0] not in exclude and row[0] not in found:
+                    found.append(row[0])
+                    if len(found) == count:
+                        return found
+        return found
+
+    ### PROMOTIONS ###
+
+    def refresh_effective_prices(self, conn=None, product_ids=None):
+        """Recompute products.effective_price from the active promotions.
+
+        One UPDATE over the whole catalog (or just product_ids): the best
+        matching promotion per product is found with a join, and the
+        subclass discount policies are applied as a CASE on category, so
+        listings only ever read the stored column. Rows whose price doesn't
+        change aren't written. Returns the number of products repriced.
+        """
+        scope = ''
+        params = []
+        if product_ids is not None:
+            if not product_ids:
+                return 0
+            scope = f"WHERE p.id IN ({','.join('?' * len(product_ids))})"
+            params = list(product_ids)
+
+        own_conn = conn is None
+        if own_conn:
+            conn = self.get_connection()
+        cursor = conn.execute(f'''
+            UPDATE products SET effective_price = priced.new_price
+            FROM (
+                SELECT id, ROUND(CASE WHEN percentage IS NULL THEN price
+                                      ELSE {discounted_price_sql('price', 'percentage', 'category')}
+                                 END, 2) AS new_price
+                FROM (
+                    SELECT p.id, p.price, p.category, MAX(pr.percentage) AS percentage
+                    FROM products p
+                    LEFT JOIN promotions pr
+                        ON pr.active
+                       AND (pr.category IS NULL OR pr.category = p.category)
+                       AND (pr.brand IS NULL OR pr.brand = p.brand)
+                       AND (NOT pr.product_scoped OR EXISTS (
+                                SELECT 1 FROM promotion_products pp
+                                WHERE pp.promotion_id = pr.id AND pp.product_id = p.id))
+                    {scope}
+                    GROUP BY p.id
+                )
+            ) AS priced
+            WHERE products.id = priced.id AND products.effective_price IS NOT priced.new_price
+        ''', params)
+        count = cursor.rowcount
+        if own_conn:
+            conn.commit()
+            conn.close()
+        return count
+
+    def get_promotions(self):
+        conn = self.get_connection()
+        rows = conn.execute('''
+            SELECT pr.*, (SELECT json_group_array(product_id) FROM promotion_products
+                          WHERE promotion_id = pr.id) AS product_ids
+            FROM promotions pr ORDER BY pr.id
+        ''').fetchall()
+        conn.close()
+        promotions = []
+        for row in rows:
+            promotion = dict(row)
+            promotion['active'] = bool(promotion['active'])
+            promotion['product_ids'] = json.loads(promotion['product_ids']) if promotion['product_scoped'] else None
+            del promotion['product_scoped']
+            promotions.append(promotion)
+        return promotions
+
+    def create_promotion(self, name, percentage, category=None, brand=None, product_ids=None):
+        """Add a promotion and reprice the catalog in the same transaction.
+
+        Targets combine: category and brand narrow each other, and a list of
+        product_ids limits it to those products. No targets means storewide.
+        Returns (promotion id, number of products repriced).
+        """
+        conn = self.get_connection()
+        try:
+            promotion_id = conn.execute('''
+                INSERT INTO promotions (name, percentage, category, brand, product_scoped)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (name, percentage, category, brand, product_ids is not None)).lastrowid
+            if product_ids:
+                conn.executemany('INSERT OR IGNORE INTO promotion_products VALUES (?, ?)',
+                                 [(promotion_id, product_id) for product_id in product_ids])
+            repriced = self.refresh_effective_prices(conn)
+            conn.commit()
+            return promotion_id, repriced
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def set_promotion_active(self, promotion_id, active):
+        """Switch a promotion on or off; returns products repriced, None if unknown"""
+        conn = self.get_connection()
+        try:
+            updated = conn.execute('UPDATE promotions SET active = ? WHERE id = ?',
+                                   (bool(active), promotion_id)).rowcount
+            repriced = self.refresh_effective_prices(conn) if updated else None
+            conn.commit()
+            return repriced
+        finally:
+            conn.close()
+
+    def delete_promotion(self, promotion_id):
+        """Remove a promotion; returns products repriced, None if unknown"""
+        conn = self.get_connection()
+        try:
+            deleted = conn.execute('DELETE FROM promotions WHERE id = ?', (promotion_id,)).rowcount
+            if not deleted:
+                return None
+            conn.execute('DELETE FROM promotion_products WHERE promotion_id = ?', (promotion_id,))
+            repriced = self.refresh_effective_prices(conn)
+            conn.commit()
+            return repriced
+        finally:
+            conn.close()
+
+
+def discounted_price_sql(price, percentage, category):
+    """SQL expression for the price after a discount, per shoe type.
+
+    Compiled from the max_discount and discount_multiplier policies on the
+    model classes, so the bulk repricing and calculate_discount() agree.
+    """
+    from models.product import SHOE_TYPES, Shoe
+
+    def expression(cls):
+        capped = percentage if cls.max_discount is None else f'MIN({percentage}, {float(cls.max_discount)})'
+        return f'{price} * (1 - {capped} / 100.0) * {float(cls.discount_multiplier)}'
 
-        if row:
-            return dict(row)
-        return None
\ No newline at end of file
+    cases = ' '.join(f"WHEN '{name}' THEN {expression(cls)}" for name, cls in SHOE_TYPES.items())
+    return f'CASE {category} {cases} ELSE {expression(Shoe)} END'
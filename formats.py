@@ -0,0 +1,94 @@
+"""Response bodies in JSON or MessagePack, picked by the Accept header.
+
+Clients that send `Accept: application/msgpack` (or application/x-msgpack,
+application/vnd.msgpack) get MessagePack when the optional `msgpack` package
+is installed; everyone else, browsers included, gets JSON as before.
+
+Product lists in MessagePack are a table instead of a list of objects, so
+every key is sent once per response rather than once per shoe:
+
+    {"columns": ["id", "name", ...], "variant_columns": ["id", "size", ...],
+     "rows": [[1, "Air Max", ...], ...]}
+
+A row holds its shoe's values in PRODUCT_COLUMNS order, nil where the shoe
+type has no such field, and its variants as rows of VARIANT_COLUMNS. New
+fields are only ever appended, so clients may decode by position.
+"""
+
+from operator import itemgetter
+
+from flask import current_app, make_response, request
+
+try:
+    import msgpack
+except ImportError:  # optional dependency
+    msgpack = None
+
+JSON = 'application/json'
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack', 'application/vnd.msgpack')
+
+PRODUCT_COLUMNS = (
+    'id', 'name', 'brand', 'price', 'effective_price', 'stock', 'version', 'created_at',
+    'size', 'color', 'category', 'image', 'attributes', 'sizes',
+    'sport_type', 'style', 'material', 'variants',
+)
+VARIANT_COLUMNS = ('id', 'size', 'color', 'stock')
+
+# every column but variants, with None for the fields a shoe type lacks
+_BLANK_ROW = dict.fromkeys(PRODUCT_COLUMNS[:-1])
+_row_values = itemgetter(*PRODUCT_COLUMNS[:-1])
+_variant_values = itemgetter(*VARIANT_COLUMNS)
+
+
+def available_formats():
+    """Response mimetypes this server can produce, JSON first"""
+    return (JSON,) + MSGPACK_TYPES if msgpack else (JSON,)
+
+
+def choose_format():
+    """The mimetype to answer the current request with"""
+    return request.accept_mimetypes.best_match(available_formats(), default=JSON)
+
+
+def product_table(products):
+    """Column layout of a list of Shoe.to_dict() dicts"""
+    rows = [[*_row_values({**_BLANK_ROW, **product}),
+             [_variant_values(variant) for variant in product.get('variants') or ()]]
+            for product in products]
+    return {'columns': PRODUCT_COLUMNS, 'variant_columns': VARIANT_COLUMNS, 'rows': rows}
+
+
+def encode(data, mimetype):
+    """data as bytes of the given mimetype"""
+    if mimetype in MSGPACK_TYPES:
+        return msgpack.packb(data, use_bin_type=True)
+    return current_app.json.dumps(data).encode()
+
+
+def product_list(shoes, mimetype):
+    """Shoes laid out for the format: dicts for JSON, a table for MessagePack"""
+    products = [shoe.to_dict() for shoe in shoes]
+    return product_table(products) if mimetype in MSGPACK_TYPES else products
+
+
+def encode_products(shoes, mimetype):
+    """A list of shoes: JSON objects, or a MessagePack table"""
+    return encode(product_list(shoes, mimetype), mimetype)
+
+
+def respond(data, status=200, mimetype=None):
+    """Like jsonify(data), in the format the client asked for"""
+    mimetype = mimetype or choose_format()
+    response = make_response(encode(data, mimetype), status)
+    response.mimetype = mimetype
+    response.vary.add('Accept')
+    return response
+
+
+def respond_products(shoes, status=200):
+    """A response with a list of shoes, laid out for its format"""
+    mimetype = choose_format()
+    response = make_response(encode_products(shoes, mimetype), status)
+    response.mimetype = mimetype
+    response.vary.add('Accept')
+    return response
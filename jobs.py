@@ -0,0 +1,210 @@
+"""Lightweight background job queue stored in the store's SQLite database.
+
+No broker: jobs are rows in the `jobs` table. Worker threads, started by
+the web app, or `flask --app Main run-jobs` processes claim them with a
+single atomic UPDATE ... RETURNING. Handlers are registered by name:
+
+    @job_handler('seed_products')
+    def seed(payload):
+        ...
+
+A failed job is retried with exponential backoff until max_attempts, then
+left as 'failed' with its error for the admin jobs endpoint.
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+
+# job kind -> function(payload) returning a JSON-serializable result
+HANDLERS = {}
+
+STATUSES = ('queued', 'running', 'done', 'failed')
+
+
+def job_handler(kind):
+    """Decorator registering a function as the handler for a job kind"""
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+
+class JobQueue:
+    """Enqueue, claim and finish jobs through a DatabaseManager"""
+
+    def __init__(self, db, store=None):
+        self.db = db
+        # the store location (shards.py) whose database this queue lives in
+        self.store = store
+
+    def enqueue(self, kind, payload=None, priority=0, max_attempts=3, delay=0):
+        """Add a job and return its id"""
+        if kind not in HANDLERS:
+            raise ValueError(f'Unknown job kind: {kind}')
+        now = time.time()
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO jobs (kind, payload, priority, max_attempts, run_after, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (kind, json.dumps(payload), int(priority), int(max_attempts), now + delay, now, now))
+        job_id = cursor.lastrowid
+        conn.commit()
+        conn.close()
+        return job_id
+
+    def enqueue_unique(self, kind, payload=None, priority=0, delay=0):
+        """Enqueue unless a job of this kind is already queued or running.
+
+        Used for recurring maintenance jobs that re-schedule themselves, so
+        restarting several workers doesn't pile up duplicates. Returns the
+        id of the new or the existing job.
+        """
+        conn = self.db.get_connection()
+        row = conn.execute("SELECT id FROM jobs WHERE kind = ? AND status IN ('queued', 'running')",
+                           (kind,)).fetchone()
+        conn.close()
+        if row:
+            return row[0]
+        return self.enqueue(kind, payload, priority=priority, delay=delay)
+
+    def claim(self, worker_id):
+        """Atomically take the highest-priority due job, or return None"""
+        now = time.time()
+        conn = self.db.get_connection()
+        row = conn.execute('''
+            UPDATE jobs SET status = 'running', attempts = attempts + 1,
+                            locked_by = ?, updated_at = ?
+            WHERE id = (SELECT id FROM jobs
+                        WHERE status = 'queued' AND run_after <= ?
+                        ORDER BY priority DESC, run_after, id LIMIT 1)
+            RETURNING *
+        ''', (worker_id, now, now)).fetchone()
+        conn.commit()
+        conn.close()
+        return self._to_dict(row) if row else None
+
+    def complete(self, job_id, result=None):
+        self._finish(job_id, 'done', result=json.dumps(result))
+
+    def fail(self, job, error):
+        """Requeue with backoff, or mark failed once attempts are used up"""
+        if job['attempts'] < job['max_attempts']:
+            self._finish(job['id'], 'queued', error=error, delay=2 ** job['attempts'])
+        else:
+            self._finish(job['id'], 'failed', error=error)
+
+    def _finish(self, job_id, status, result=None, error=None, delay=0):
+        now = time.time()
+        conn = self.db.get_connection()
+        conn.execute('''
+            UPDATE jobs SET status = ?, result = ?, error = ?, locked_by = NULL,
+                            run_after = ?, updated_at = ?
+            WHERE id = ?
+        ''', (status, result, error, now + delay, now, job_id))
+        conn.commit()
+        conn.close()
+
+    def requeue_stale(self, timeout):
+        """Put back 'running' jobs whose worker died mid-job"""
+        conn = self.db.get_connection()
+        cursor = conn.execute('''
+            UPDATE jobs SET status = 'queued', locked_by = NULL
+            WHERE status = 'running' AND updated_at < ?
+        ''', (time.time() - timeout,))
+        count = cursor.rowcount
+        conn.commit()
+        conn.close()
+        return count
+
+    def get(self, job_id):
+        conn = self.db.get_connection()
+        row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        conn.close()
+        return self._to_dict(row) if row else None
+
+    def recent(self, status=None, limit=50):
+        """Most recently updated jobs, optionally for one status"""
+        conn = self.db.get_connection()
+        if status:
+            rows = conn.execute('SELECT * FROM jobs WHERE status = ? ORDER BY updated_at DESC LIMIT ?',
+                                (status, limit)).fetchall()
+        else:
+            rows = conn.execute('SELECT * FROM jobs ORDER BY updated_at DESC LIMIT ?',
+                                (limit,)).fetchall()
+        conn.close()
+        return [self._to_dict(row) for row in rows]
+
+    def counts(self):
+        """Number of jobs per status"""
+        conn = self.db.get_connection()
+        rows = conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        conn.close()
+        counts = dict.fromkeys(STATUSES, 0)
+        counts.update({row[0]: row[1] for row in rows})
+        return counts
+
+    def run_one(self, app, worker_id):
+        """Claim and run a single job inside an app context; False if idle"""
+        job = self.claim(worker_id)
+        if not job:
+            return False
+        try:
+            with app.app_context():
+                if self.store is not None:
+                    from flask import g
+                    # handlers reach the database through the current store
+                    g.store = self.store
+                result = HANDLERS[job['kind']](job['payload'])
+        except Exception:
+            self.fail(job, traceback.format_exc(limit=5))
+        else:
+            self.complete(job['id'], result)
+        return True
+
+    @staticmethod
+    def _to_dict(row):
+        job = dict(row)
+        for field in ('payload', 'result'):
+            if job.get(field) is not None:
+                job[field] = json.loads(job[field])
+        return job
+
+
+class JobWorkers:
+    """Daemon threads polling the queue for one app"""
+
+    def __init__(self, app, queue, count, poll_interval=1.0):
+        self.app = app
+        self.queue = queue
+        self.count = count
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for number in range(self.count):
+            worker_id = f'{socket.gethostname()}:{os.getpid()}:{number}'
+            thread = threading.Thread(target=self._loop, args=(worker_id,),
+                                      name=f'job-worker-{number}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _loop(self, worker_id):
+        while not self._stop.is_set():
+            try:
+                busy = self.queue.run_one(self.app, worker_id)
+            except Exception:
+                # e.g. database locked for longer than the timeout; try again later
+                busy = False
+            if not busy:
+                self._stop.wait(self.poll_interval)
@@ -0,0 +1,166 @@
+"""Live stock and price updates for the storefront, over Server-Sent Events.
+
+One ChangeBroadcaster per store watches the catalog change log (migration
+17). Every LIVE_UPDATES_POLL_INTERVAL seconds it asks PRAGMA data_version
+whether anything was committed, and only then reads the products changed
+since its last poll, with their stock and prices, in one query. The result becomes
+one event in a shared buffer, and every connected client wakes up on the
+same condition and writes it out, so 10k open streams still cost one
+database poll per interval.
+
+Events are "products" events whose data is a list of
+{"id", "stock", "price", "effective_price", "variants": [[id, stock], ...]}
+or {"id", "deleted": true}, and whose id is the catalog version they bring
+the client up to. A client resumes from ?since=<version> or, when the
+browser reconnects, Last-Event-ID. If that is older than the buffer it gets
+a "reset" event and should catch up through /api/shoes/changes.
+
+Each open stream holds a worker thread (or greenlet), so serve it with a
+server that can keep many of them open, such as gunicorn with gevent.
+"""
+
+import collections
+import json
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+# products read per poll; a bigger backlog is read over the next polls
+POLL_LIMIT = 500
+
+CHANGES_QUERY = '''
+    SELECT c.version, c.product_id, c.deleted, p.stock, p.price, p.effective_price,
+           (SELECT json_group_array(json_array(v.id, v.stock))
+            FROM product_variants v WHERE v.product_id = c.product_id) AS variants
+    FROM catalog_changes c LEFT JOIN products p ON p.id = c.product_id
+    WHERE c.version > ?
+    ORDER BY c.version
+    LIMIT ?
+'''
+
+
+def sse(data, event=None, event_id=None):
+    """One Server-Sent Events message"""
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    if event:
+        lines.append(f'event: {event}')
+    lines.append(f'data: {data}')
+    return '\n'.join(lines) + '\n\n'
+
+
+class ChangeBroadcaster:
+    """Polls one store's change log for all of its live clients"""
+
+    def __init__(self, db, interval=0.5, buffer_size=1000):
+        self.db = db
+        self.interval = interval
+        # (version before, version after, event data), oldest first
+        self._events = collections.deque(maxlen=buffer_size)
+        self.version = None
+        self.clients = 0
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _start(self):
+        # called with the condition held, by the first client
+        conn = sqlite3.connect(self.db.db_name, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        self.version = conn.execute('SELECT version FROM catalog_version WHERE id = 1').fetchone()[0]
+        self._thread = threading.Thread(target=self._run, args=(conn,), name='live-updates', daemon=True)
+        self._thread.start()
+
+    def _run(self, conn):
+        data_version = None
+        try:
+            while not self._stop.wait(self.interval):
+                if not self.clients:
+                    continue
+                try:
+                    current = conn.execute('PRAGMA data_version').fetchone()[0]
+                    if current != data_version:
+                        # a full batch means there is more; look again next time
+                        data_version = None if self._poll(conn) == POLL_LIMIT else current
+                except sqlite3.Error as e:
+                    logger.warning('Live updates poll of %s failed: %s', self.db.db_name, e)
+        finally:
+            conn.close()
+
+    def _poll(self, conn):
+        rows = conn.execute(CHANGES_QUERY, (self.version, POLL_LIMIT)).fetchall()
+        if not rows:
+            return 0
+        changes = []
+        for row in rows:
+            if row['deleted'] or row['stock'] is None:
+                changes.append({'id': row['product_id'], 'deleted': True})
+            else:
+                changes.append({
+                    'id': row['product_id'],
+                    'stock': row['stock'],
+                    'price': row['price'],
+                    'effective_price': row['effective_price'],
+                    'variants': json.loads(row['variants']),
+                })
+        with self._condition:
+            self._events.append((self.version, rows[-1]['version'], json.dumps(changes)))
+            self.version = rows[-1]['version']
+            self._condition.notify_all()
+        return len(rows)
+
+    def _missed(self, seen):
+        """Buffered events after version seen, or None if some were dropped"""
+        if seen > self.version:
+            return None
+        missed = []
+        for event in reversed(self._events):
+            if event[1] <= seen:
+                break
+            missed.append(event)
+        else:
+            # went past the oldest event without reaching seen
+            if self._events and self._events[0][0] > seen:
+                return None
+            if not self._events and seen < self.version:
+                return None
+        missed.reverse()
+        return missed
+
+    def stream(self, since=None, heartbeat=15):
+        """SSE text for one client, from catalog version since (default: now)"""
+        with self._condition:
+            if self._thread is None:
+                self._start()
+            self.clients += 1
+            seen = self.version if since is None else since
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                with self._condition:
+                    missed = self._missed(seen)
+                    if missed == []:
+                        self._condition.wait(heartbeat)
+                        missed = self._missed(seen)
+                    current = self.version
+                if missed is None:
+                    yield sse(json.dumps({'version': current}), 'reset', current)
+                    seen = current
+                elif missed:
+                    for _, version, data in missed:
+                        yield sse(data, 'products', version)
+                    seen = missed[-1][1]
+                else:
+                    # keeps proxies from closing an idle stream, and finds dead clients
+                    yield ': ping\n\n'
+        finally:
+            with self._condition:
+                self.clients -= 1
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,130 @@
+"""Product image storage and thumbnail generation.
+
+Images are stored content-addressed under MEDIA_ROOT:
+
+    <root>/<digest[:2]>/<digest>/original.<ext>
+    <root>/<digest[:2]>/<digest>/w<width>.webp
+    <root>/<digest[:2]>/<digest>/w<width>.jpg
+
+and served from /media/<digest>/<file>. A file's name changes whenever its
+content does, so everything under /media/ can be cached as immutable.
+Resizing needs the optional Pillow package; without it only originals are
+kept and the variant URLs fall back to the original.
+"""
+
+import hashlib
+import os
+import urllib.request
+
+try:
+    from PIL import Image
+except ImportError:  # optional dependency
+    Image = None
+
+# content types we accept -> file extension of the stored original
+IMAGE_TYPES = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/webp': '.webp',
+    'image/gif': '.gif',
+}
+
+VARIANT_FORMATS = (('webp', 'WEBP'), ('jpg', 'JPEG'))
+
+
+class MediaError(ValueError):
+    """Raised for uploads or downloads that can't be stored"""
+
+
+class MediaStore:
+    """Content-addressed image files on local disk"""
+
+    def __init__(self, root, widths=(200, 400, 800), max_bytes=10 * 1024 * 1024):
+        self.root = str(root)
+        self.widths = tuple(widths)
+        self.max_bytes = max_bytes
+
+    def directory(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def save(self, data, content_type):
+        """Store an original image and return its digest (idempotent)"""
+        ext = IMAGE_TYPES.get((content_type or '').split(';')[0].strip().lower())
+        if not ext:
+            raise MediaError(f'Unsupported image type: {content_type}')
+        if len(data) > self.max_bytes:
+            raise MediaError('Image is too large')
+
+        digest = hashlib.sha256(data).hexdigest()
+        directory = self.directory(digest)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, 'original' + ext)
+        if not os.path.exists(path):
+            # write then rename so readers never see a half-written file
+            tmp = path + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return digest
+
+    def fetch(self, url, timeout=15):
+        """Download a remote image into the store and return its digest"""
+        if not url.startswith(('http://', 'https://')):
+            raise MediaError('Only http(s) image URLs can be fetched')
+        request = urllib.request.Request(url, headers={'User-Agent': 'DMoneyShoeWorld/1.0'})
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                data = response.read(self.max_bytes + 1)
+                content_type = response.headers.get('Content-Type')
+        except OSError as e:
+            raise MediaError(f'Could not fetch image: {e}')
+        return self.save(data, content_type)
+
+    def original(self, digest):
+        """File name of the stored original, or None"""
+        directory = self.directory(digest)
+        if os.path.isdir(directory):
+            for name in os.listdir(directory):
+                if name.startswith('original.') and not name.endswith('.tmp'):
+                    return name
+        return None
+
+    def url(self, digest):
+        """Public URL of the original image"""
+        return f'/media/{digest}/{self.original(digest)}'
+
+    def variants_ready(self, digest):
+        directory = self.directory(digest)
+        return all(os.path.exists(os.path.join(directory, f'w{width}.{ext}'))
+                   for width in self.widths for ext, _ in VARIANT_FORMATS)
+
+    def thumbnail_job(self, digest):
+        """Arguments for generate_variants(), picklable for a process pool"""
+        return (os.path.join(self.directory(digest), self.original(digest)),
+                self.directory(digest), self.widths)
+
+
+def generate_variants(original_path, directory, widths):
+    """Write resized WebP and JPEG copies of an image (runs in a worker process).
+
+    Returns the file names written; empty when Pillow isn't installed.
+    """
+    if Image is None:
+        return []
+
+    written = []
+    with Image.open(original_path) as image:
+        image.load()
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        for width in widths:
+            # never upscale; small originals are just re-encoded
+            height = round(image.height * min(width, image.width) / image.width)
+            resized = image.resize((min(width, image.width), height), Image.LANCZOS)
+            for ext, fmt in VARIANT_FORMATS:
+                name = f'w{width}.{ext}'
+                tmp = os.path.join(directory, name + '.tmp')
+                resized.save(tmp, fmt, quality=80, optimize=True)
+                os.replace(tmp, os.path.join(directory, name))
+                written.append(name)
+    return written
@@ -0,0 +1,659 @@
+"""Numbered schema migrations for the store database.
+
+The version a database is at lives in PRAGMA user_version. Every migration
+is a list of steps and each step runs in its own short transaction, so a long
+index build or backfill never holds the write lock for the whole upgrade.
+Steps are idempotent, which lets an interrupted upgrade simply be re-run.
+"""
+
+import time
+from contextlib import contextmanager
+
+
+class Step:
+    """One unit of work inside a migration"""
+
+    # cost of the step relative to fetching the same rows into Python once,
+    # measured on a 200k-row products table; subclasses round the measured
+    # value up so --dry-run errs on the long side
+    scan_factor = 0
+
+    def __init__(self, table=None):
+        self.table = table
+
+    def run(self, conn):
+        raise NotImplementedError
+
+    def describe(self):
+        raise NotImplementedError
+
+    def estimate(self, conn, row_cost):
+        """Estimate how many seconds this step takes on the current data"""
+        if not self.table or not table_exists(conn, self.table):
+            return 0.0
+        rows = conn.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+        return rows * row_cost(self.table) * self.scan_factor
+
+
+class SQL(Step):
+    """Run a plain SQL statement (CREATE TABLE IF NOT EXISTS, triggers, ...)"""
+
+    def __init__(self, statement, table=None, transactional=True):
+        super().__init__(table)
+        self.statement = statement
+        self.transactional = transactional
+
+    def run(self, conn):
+        if self.transactional:
+            with transaction(conn):
+                conn.execute(self.statement)
+        else:
+            # PRAGMA journal_mode and friends refuse to run inside a transaction
+            conn.execute(self.statement)
+
+    def describe(self):
+        return ' '.join(self.statement.split())[:70]
+
+
+class AddColumn(Step):
+    """ALTER TABLE ... ADD COLUMN, skipped when the column is already there"""
+
+    def __init__(self, table, column, declaration):
+        super().__init__(table)
+        self.column = column
+        self.declaration = declaration
+
+    def run(self, conn):
+        if self.column in column_names(conn, self.table):
+            return
+        with transaction(conn):
+            conn.execute(f'ALTER TABLE {self.table} ADD COLUMN {self.column} {self.declaration}')
+
+    def describe(self):
+        return f'add column {self.table}.{self.column}'
+
+
+class CreateIndex(Step):
+    """Build one index in its own transaction.
+
+    SQLite has no concurrent index build; with the database in WAL mode readers
+    keep going while the index is written, and writers only wait for this one
+    index rather than for the whole migration.
+    """
+
+    # measured 0.21; sorting grows faster than linearly on bigger tables
+    scan_factor = 0.25
+
+    def __init__(self, name, table, columns, unique=False, where=None):
+        super().__init__(table)
+        self.name = name
+        self.columns = columns
+        self.unique = unique
+        self.where = where
+
+    def run(self, conn):
+        unique = 'UNIQUE ' if self.unique else ''
+        where = f' WHERE {self.where}' if self.where else ''
+        with transaction(conn):
+            conn.execute(f'CREATE {unique}INDEX IF NOT EXISTS {self.name} '
+                         f'ON {self.table} ({self.columns}){where}')
+
+    def describe(self):
+        return f'index {self.name} on {self.table}({self.columns})'
+
+
+class Backfill(Step):
+    """UPDATE a table in rowid-range chunks, committing after every chunk.
+
+    `assignments` is the SET clause and `where` selects rows that still need
+    the backfill, so re-running after an interruption only touches the rest.
+    """
+
+    # measured 1.22 with no pause; every chunk commits, which costs more on
+    # a slow disk than on the one it was measured on
+    scan_factor = 1.5
+
+    def __init__(self, table, assignments, where, batch_size=500, pause=0.0):
+        super().__init__(table)
+        self.assignments = assignments
+        self.where = where
+        self.batch_size = batch_size
+        self.pause = pause
+
+    def run(self, conn):
+        low, high = conn.execute(f'SELECT MIN(rowid), MAX(rowid) FROM {self.table}').fetchone()
+        if low is None:
+            return
+        for start in range(low, high + 1, self.batch_size):
+            with transaction(conn):
+                conn.execute(f'UPDATE {self.table} SET {self.assignments} '
+                             f'WHERE rowid >= ? AND rowid < ? AND ({self.where})',
+                             (start, start + self.batch_size))
+            if self.pause:
+                # give other writers a chance at the lock between chunks
+                time.sleep(self.pause)
+
+    def describe(self):
+        return f'backfill {self.table} SET {self.assignments} in chunks of {self.batch_size}'
+
+
+class Migration:
+    """A numbered schema change made of ordered steps"""
+
+    def __init__(self, version, description, steps):
+        self.version = version
+        self.description = description
+        self.steps = steps
+
+    def __repr__(self):
+        return f"Migration({self.version}, '{self.description}')"
+
+
+def catalog_change_trigger(name, event, table, product_id, created='0', deleted='0', on_conflict=''):
+    """Trigger that bumps the catalog version and logs the product in catalog_changes.
+
+    Both happen in the one trigger, so the logged version is the one this
+    change produced. on_conflict adds to the SET clause for a product that
+    is already in the log.
+    """
+    return SQL(f'''
+        CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON {table}
+        BEGIN
+            UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+            INSERT INTO catalog_changes (product_id, version, created_version, deleted, changed_at)
+            SELECT {product_id}, version, {created}, {deleted}, CAST(strftime('%s', 'now') AS INTEGER)
+            FROM catalog_version WHERE id = 1
+            ON CONFLICT(product_id) DO UPDATE SET
+                version = excluded.version, changed_at = excluded.changed_at{on_conflict};
+        END
+        ''')
+
+
+MIGRATIONS = [
+    Migration(1, 'initial schema', [
+        SQL('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE NOT NULL,
+                password_hash TEXT NOT NULL,
+                email TEXT,
+                role TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            '''),
+        SQL('''
+            CREATE TABLE IF NOT EXISTS products (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                brand TEXT NOT NULL,
+                price REAL NOT NULL,
+                size TEXT NOT NULL,
+                stock INTEGER NOT NULL,
+                color TEXT,
+                category TEXT NOT NULL,
+                attributes TEXT,
+                image TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            '''),
+        SQL('''
+            CREATE TABLE IF NOT EXISTS orders(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                total REAL NOT NULL,
+                status TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY(user_id) REFERENCES users(id)
+                )
+            '''),
+    ]),
+    Migration(2, 'WAL journal and catalog indexes', [
+        SQL('PRAGMA journal_mode = WAL', transactional=False),
+        CreateIndex('idx_products_category', 'products', 'category'),
+        CreateIndex('idx_products_brand', 'products', 'brand'),
+    ]),
+    Migration(3, 'typed shoe attribute columns', [
+        AddColumn('products', 'sport_type', 'TEXT COLLATE NOCASE'),
+        AddColumn('products', 'style', 'TEXT COLLATE NOCASE'),
+        AddColumn('products', 'material', 'TEXT COLLATE NOCASE'),
+        # Older rows copied size/color/category/image into the JSON as well;
+        # every one of them has a "category" key, rows written since do not.
+        Backfill('products',
+                 "sport_type = json_extract(attributes, '$.sport_type'), "
+                 "style = json_extract(attributes, '$.style'), "
+                 "material = json_extract(attributes, '$.material'), "
+                 "attributes = NULLIF(json_remove(attributes, '$.size', '$.color', '$.category', "
+                 "'$.image', '$.sport_type', '$.style', '$.material'), '{}')",
+                 "attributes IS NOT NULL AND json_extract(attributes, '$.category') IS NOT NULL"),
+        CreateIndex('idx_products_sport_type', 'products', 'sport_type', where='sport_type IS NOT NULL'),
+        CreateIndex('idx_products_style', 'products', 'style', where='style IS NOT NULL'),
+        CreateIndex('idx_products_material', 'products', 'material', where='material IS NOT NULL'),
+    ]),
+    Migration(4, 'catalog version counter', [
+        SQL('''
+            CREATE TABLE IF NOT EXISTS catalog_version (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version INTEGER NOT NULL
+                )
+            '''),
+        SQL('INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 1)'),
+        # any change to products bumps the version, whichever code path made it
+        SQL('''
+            CREATE TRIGGER IF NOT EXISTS products_version_insert AFTER INSERT ON products
+            BEGIN UPDATE catalog_version SET version = version + 1 WHERE id = 1; END
+            '''),
+        SQL('''
+            CREATE TRIGGER IF NOT EXISTS products_version_update AFTER UPDATE ON products
+            BEGIN UPDATE catalog_version SET version = version + 1 WHERE id = 1; END
+            '''),
+        SQL('''
+            CREATE TRIGGER IF NOT EXISTS products_version_delete AFTER DELETE ON products
+            BEGIN UPDATE catalog_version SET version = version + 1 WHERE id = 1; END
+            '''),
+    ]),
+    Migration(5, 'background job queue', [
+        SQL('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                payload TEXT,
+                status TEXT NOT NULL DEFAULT 'queued',
+                priority INTEGER NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL DEFAULT 3,
+                run_after REAL NOT NULL,
+                locked_by TEXT,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+                )
+            '''),
+        # only queued jobs are in here, so claiming the next one stays O(log n)
+        CreateIndex('idx_jobs_queue', 'jobs', 'priority DESC, run_after, id', where="status = 'queued'"),
+        CreateIndex('idx_jobs_status', 'jobs', 'status, updated_at'),
+    ]),
+    Migration(6, 'reorder points and stock snapshots', [
+        # reorder_override is set per product; reorder_point is the effective
+        # value (override, else category rule, else the default)
+        AddColumn('products', 'reorder_override', 'INTEGER'),
+        AddColumn('products', 'reorder_point', 'INTEGER NOT NULL DEFAULT 5'),
+        SQL('''
+            CREATE TABLE IF NOT EXISTS reorder_rules (
+                category TEXT PRIMARY KEY,
+                reorder_point INTEGER NOT NULL,
+                reorder_quantity INTEGER NOT NULL
+                )
+            '''),
+        # holds only the products at or under their reorder point, so the
+        # reorder report reads k rows instead of scanning the catalog
+        CreateIndex('idx_products_low_stock', 'products', 'stock', where='stock <= reorder_point'),
+        SQL('''
+            CREATE TABLE IF NOT EXISTS stock_snapshots (
+                snapshot_date TEXT NOT NULL,
+                product_id INTEGER NOT NULL,
+                stock INTEGER NOT NULL,
+                reorder_point INTEGER NOT NULL,
+                PRIMARY KEY (product_id, snapshot_date)
+                ) WITHOUT ROWID
+            '''),
+    ]),
+    Migration(7, 'stock movement ledger', [
+        SQL('''
+            CREATE TABLE IF NOT EXISTS stock_movements (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                product_id INTEGER NOT NULL,
+                kind TEXT NOT NULL CHECK (kind IN ('receipt', 'sale', 'return', 'adjustment')),
+                quantity INTEGER NOT NULL,
+                reference TEXT,
+                created_by INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY(product_id) REFERENCES products(id)
+                )
+            '''),
+        CreateIndex('idx_stock_movements_product', 'stock_movements', 'product_id, id'),
+        SQL('''
+            CREATE TRIGGER IF NOT EXISTS stock_movements_append_only
+            BEFORE UPDATE ON stock_movements
+            BEGIN SELECT RAISE(ABORT, 'stock_movements is append-only'); END
+            '''),
+        # compacted history: net quantity of every movement up to through_id
+        SQL('''
+            CREATE TABLE IF NOT EXISTS stock_balances (
+                product_id INTEGER PRIMARY KEY,
+                quantity INTEGER NOT NULL,
+                through_id INTEGER NOT NULL,
+                movements INTEGER NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            '''),
+        # existing stock becomes the opening balance of every product
+        SQL('''
+            INSERT OR IGNORE INTO stock_balances (product_id, quantity, through_id)
+            SELECT id, stock, 0 FROM products
+            '''),
+    ]),
+    Migration(8, 'size/color variants', [
+        # the unique index doubles as the per-style lookup: one range scan on
+        # product_id returns every size and color of a style
+        SQL('''
+            CREATE TABLE IF NOT EXISTS product_variants (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                product_id INTEGER NOT NULL,
+                size TEXT NOT NULL,
+                color TEXT NOT NULL DEFAULT '',
+                stock INTEGER NOT NULL DEFAULT 0 CHECK (stock >= 0),
+                UNIQUE (product_id, size, color),
+                FOREIGN KEY(product_id) REFERENCES products(id)
+                )
+            '''),
+        # every existing product becomes a style with its one size/color
+        SQL('''
+            INSERT OR IGNORE INTO product_variants (product_id, size, color, stock)
+            SELECT id, size, COALESCE(color, ''), stock FROM products
+            ''', table='products'),
+        AddColumn('stock_movements', 'variant_id', 'INTEGER'),
+        SQL('''
+            CREATE TRIGGER IF NOT EXISTS product_variants_version_insert AFTER INSERT ON product_variants
+            BEGIN UPDATE catalog_version SET version = version + 1 WHERE id = 1; END
+            '''),
+        SQL('''
+            CREATE TRIGGER IF NOT EXISTS product_variants_version_update AFTER UPDATE ON product_variants
+            BEGIN UPDATE catalog_version SET version = version + 1 WHERE id = 1; END
+            '''),
+        SQL('''
+            CREATE TRIGGER IF NOT EXISTS product_variants_version_delete AFTER DELETE ON product_variants
+            BEGIN UPDATE catalog_version SET version = version + 1 WHERE id = 1; END
+            '''),
+    ]),
+    Migration(9, 'product row versions', [
+        AddColumn('products', 'version', 'INTEGER NOT NULL DEFAULT 1'),
+        # compare-and-swap updates bump version themselves; every other write
+        # (ledger, image updates, ...) gets it bumped here so a stale edit
+        # can't silently overwrite it
+        SQL('''
+            CREATE TRIGGER IF NOT EXISTS products_row_version AFTER UPDATE ON products
+            WHEN NEW.version = OLD.version
+            BEGIN UPDATE products SET version = OLD.version + 1 WHERE id = NEW.id; END
+            '''),
+    ]),
+    Migration(10, 'promotions and effective prices', [
+        # a promotion applies to products matching every target it sets;
+        # product_scoped ones only to the products listed for them
+        SQL('''
+            CREATE TABLE IF NOT EXISTS promotions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                percentage REAL NOT NULL CHECK (percentage > 0 AND percentage <= 100),
+                category TEXT,
+                brand TEXT,
+                product_scoped INTEGER NOT NULL DEFAULT 0,
+                active INTEGER NOT NULL DEFAULT 1,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            '''),
+        SQL('''
+            CREATE TABLE IF NOT EXISTS promotion_products (
+                promotion_id INTEGER NOT NULL,
+                product_id INTEGER NOT NULL,
+                PRIMARY KEY (promotion_id, product_id)
+                ) WITHOUT ROWID
+            '''),
+        AddColumn('products', 'effective_price', 'REAL'),
+        # repricing isn't an edit, so only edited columns bump the row version
+        SQL('DROP TRIGGER IF EXISTS products_row_version'),
+        SQL('''
+            CREATE TRIGGER IF NOT EXISTS products_row_version
+            AFTER UPDATE OF name, brand, price, size, stock, color, category, attributes, image,
+                            sport_type, style, material ON products
+            WHEN NEW.version = OLD.version
+            BEGIN UPDATE products SET version = OLD.version + 1 WHERE id = NEW.id; END
+            '''),
+        Backfill('products', 'effective_price = price', 'effective_price IS NULL'),
+    ]),
+    Migration(11, 'case-insensitive usernames and email lookups', [
+        # fails if two existing accounts differ only in case; rename one first
+        CreateIndex('idx_users_username_nocase', 'users', 'username COLLATE NOCASE', unique=True),
+        CreateIndex('idx_users_email', 'users', 'email COLLATE NOCASE', where='email IS NOT NULL'),
+    ]),
+    Migration(12, 'login sessions with refresh tokens', [
+        SQL('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                refresh_hash TEXT NOT NULL UNIQUE,
+                previous_hash TEXT,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                revoked_at REAL,
+                FOREIGN KEY(user_id) REFERENCES users(id)
+                )
+            '''),
+        CreateIndex('idx_sessions_previous_hash', 'sessions', 'previous_hash', where='previous_hash IS NOT NULL'),
+        CreateIndex('idx_sessions_user', 'sessions', 'user_id', where='revoked_at IS NULL'),
+        # what every process polls for its revocation set
+        CreateIndex('idx_sessions_revoked', 'sessions', 'revoked_at', where='revoked_at IS NOT NULL'),
+    ]),
+    Migration(13, 'order items and order history indexes', [
+        SQL('''
+            CREATE TABLE IF NOT EXISTS order_items (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                order_id INTEGER NOT NULL,
+                product_id INTEGER NOT NULL,
+                variant_id INTEGER,
+                product_name TEXT NOT NULL,
+                quantity INTEGER NOT NULL CHECK (quantity > 0),
+                price REAL NOT NULL,
+                FOREIGN KEY(order_id) REFERENCES orders(id),
+                FOREIGN KEY(product_id) REFERENCES products(id)
+                )
+            '''),
+        CreateIndex('idx_order_items_order', 'order_items', 'order_id'),
+        # history pages are answered from these indexes alone (they carry
+        # every column the listing shows), newest first, with id breaking
+        # ties between orders placed in the same second
+        CreateIndex('idx_orders_user_created', 'orders', 'user_id, created_at DESC, id DESC, status, total'),
+        CreateIndex('idx_orders_status_created', 'orders', 'status, created_at DESC, id DESC, user_id, total'),
+        CreateIndex('idx_orders_created', 'orders', 'created_at DESC, id DESC, user_id, status, total'),
+    ]),
+    Migration(14, 'event outbox for order status changes', [
+        # written in the same transaction as the change it records; readers
+        # page through it by id
+        SQL('''
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                topic TEXT NOT NULL,
+                key TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            '''),
+        CreateIndex('idx_outbox_topic', 'outbox', 'topic, id'),
+        SQL('''
+            CREATE TABLE IF NOT EXISTS outbox_offsets (
+                consumer TEXT PRIMARY KEY,
+                last_id INTEGER NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                ) WITHOUT ROWID
+            '''),
+    ]),
+    Migration(15, 'loyalty points ledger and cached balances', [
+        SQL('''
+            CREATE TABLE IF NOT EXISTS loyalty_points (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                points INTEGER NOT NULL,
+                remaining INTEGER NOT NULL DEFAULT 0,
+                expires_at TIMESTAMP,
+                order_id INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY(user_id) REFERENCES users(id)
+                )
+            '''),
+        # the balance checkout reads; always the sum of the user's ledger
+        AddColumn('users', 'loyalty_points', 'INTEGER NOT NULL DEFAULT 0'),
+        CreateIndex('idx_loyalty_user', 'loyalty_points', 'user_id, id'),
+        # earned lots that still have points, soonest to expire first
+        CreateIndex('idx_loyalty_open_lots', 'loyalty_points', 'user_id, expires_at', where='remaining > 0'),
+        CreateIndex('idx_loyalty_expiring', 'loyalty_points', 'expires_at', where='remaining > 0'),
+        # an order earns, redeems or refunds at most once
+        CreateIndex('idx_loyalty_order', 'loyalty_points', 'order_id, kind', unique=True,
+                    where='order_id IS NOT NULL'),
+    ]),
+    Migration(16, 'co-purchase counts and related products', [
+        # sparse and symmetric: (a, b) and (b, a) are both stored, so every
+        # neighbour of a product is one primary key range
+        SQL('''
+            CREATE TABLE IF NOT EXISTS co_purchases (
+                product_id INTEGER NOT NULL,
+                other_id INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (product_id, other_id)
+                ) WITHOUT ROWID
+            '''),
+        # products whose counts changed since related_products was refreshed
+        SQL('''
+            CREATE TABLE IF NOT EXISTS related_stale (
+                product_id INTEGER PRIMARY KEY
+                ) WITHOUT ROWID
+            '''),
+        SQL('''
+            CREATE TABLE IF NOT EXISTS related_products (
+                product_id INTEGER NOT NULL,
+                rank INTEGER NOT NULL,
+                related_id INTEGER NOT NULL,
+                score INTEGER NOT NULL,
+                PRIMARY KEY (product_id, rank)
+                ) WITHOUT ROWID
+            '''),
+        # the same-brand/same-category fallback seeks to the nearest price
+        CreateIndex('idx_products_category_brand_price', 'products', 'category, brand, price'),
+        CreateIndex('idx_products_category_price', 'products', 'category, price'),
+    ]),
+    Migration(17, 'catalog change log for delta sync', [
+        # one row per product: the last catalog version that changed it, the
+        # version that created it (0: before the log) and whether it is gone
+        SQL('''
+            CREATE TABLE IF NOT EXISTS catalog_changes (
+                product_id INTEGER PRIMARY KEY,
+                version INTEGER NOT NULL,
+                created_version INTEGER NOT NULL,
+                deleted INTEGER NOT NULL DEFAULT 0,
+                changed_at INTEGER NOT NULL
+                )
+            '''),
+        CreateIndex('idx_catalog_changes_version', 'catalog_changes', 'version'),
+        # changes after this version are all in the log; older ones were
+        # never logged or have been compacted away
+        AddColumn('catalog_version', 'changes_since', 'INTEGER NOT NULL DEFAULT 0'),
+        SQL('UPDATE catalog_version SET changes_since = version WHERE id = 1 AND changes_since = 0'),
+        # the new triggers go in before the old ones go, so no write ever
+        # misses its version bump
+        catalog_change_trigger('products_change_insert', 'INSERT', 'products', 'NEW.id', created='version',
+                               on_conflict=', created_version = excluded.created_version, deleted = 0'),
+        catalog_change_trigger('products_change_update', 'UPDATE', 'products', 'NEW.id'),
+        catalog_change_trigger('products_change_delete', 'DELETE', 'products', 'OLD.id', deleted='1',
+                               on_conflict=', deleted = 1'),
+        catalog_change_trigger('product_variants_change_insert', 'INSERT', 'product_variants', 'NEW.product_id'),
+        catalog_change_trigger('product_variants_change_update', 'UPDATE', 'product_variants', 'NEW.product_id'),
+        catalog_change_trigger('product_variants_change_delete', 'DELETE', 'product_variants', 'OLD.product_id'),
+        SQL('DROP TRIGGER IF EXISTS products_version_insert'),
+        SQL('DROP TRIGGER IF EXISTS products_version_update'),
+        SQL('DROP TRIGGER IF EXISTS products_version_delete'),
+        SQL('DROP TRIGGER IF EXISTS product_variants_version_insert'),
+        SQL('DROP TRIGGER IF EXISTS product_variants_version_update'),
+        SQL('DROP TRIGGER IF EXISTS product_variants_version_delete'),
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+@contextmanager
+def transaction(conn):
+    """Run a block inside BEGIN IMMEDIATE ... COMMIT (ROLLBACK on error)"""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+def table_exists(conn, table):
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                       (table,)).fetchone()
+    return row is not None
+
+
+def column_names(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+
+def current_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def pending(conn):
+    """Migrations newer than the database's user_version"""
+    version = current_version(conn)
+    return [m for m in MIGRATIONS if m.version > version]
+
+
+def _row_cost_sampler(conn, sample_size=2000):
+    """Per-table seconds-per-row, measured by reading a sample of real rows"""
+    costs = {}
+
+    def row_cost(table):
+        if table not in costs:
+            start = time.perf_counter()
+            rows = conn.execute(f'SELECT * FROM {table} LIMIT {sample_size}').fetchall()
+            elapsed = time.perf_counter() - start
+            costs[table] = elapsed / len(rows) if rows else 0.0
+        return costs[table]
+
+    return row_cost
+
+
+def plan(conn):
+    """Dry run: describe pending steps with an estimated duration for each.
+
+    Estimates scale a measured per-row read cost by how expensive the step is
+    relative to a scan, so they track the real data size of this database.
+    """
+    row_cost = _row_cost_sampler(conn)
+    report = []
+    for migration in pending(conn):
+        steps = [(step.describe(), step.estimate(conn, row_cost)) for step in migration.steps]
+        report.append({
+            'version': migration.version,
+            'description': migration.description,
+            'steps': steps,
+            'estimated_seconds': sum(seconds for _, seconds in steps),
+        })
+    return report
+
+
+def migrate(conn, target=None, log=None):
+    """Apply pending migrations up to `target` (default: latest).
+
+    The connection is switched to autocommit so every step controls its own
+    transaction. Returns the list of versions applied.
+    """
+    conn.isolation_level = None
+    applied = []
+    for migration in pending(conn):
+        if target is not None and migration.version > target:
+            break
+        start = time.perf_counter()
+        for step in migration.steps:
+            step.run(conn)
+        conn.execute(f'PRAGMA user_version = {migration.version}')
+        applied.append(migration.version)
+        if log:
+            log(f'applied {migration.version} {migration.description} '
+                f'in {time.perf_counter() - start:.2f}s')
+    return applied
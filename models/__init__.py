@@ -4,13 +4,13 @@ Contains all entity classes for the application
 """
 
 from .user import User, Admin, Customer
-from .product import Product, Shoe, AthleticShoe, CasualShoe, FormalShoe
+from .product import Product, Shoe, ShoeVariant, AthleticShoe, CasualShoe, FormalShoe, shoe_from_dict
 from .order import Order, OrderItem
 from .cart import Cart
 
 __all__ = [
     'User', 'Admin', 'Customer',
-    'Product', 'Shoe', 'AthleticShoe', 'CasualShoe', 'FormalShoe',
+    'Product', 'Shoe', 'ShoeVariant', 'AthleticShoe', 'CasualShoe', 'FormalShoe', 'shoe_from_dict',
     'Order', 'OrderItem',
     'Cart'
 ]
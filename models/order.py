@@ -1,5 +1,20 @@
 from datetime import datetime
 
+ORDER_STATUSES = ('pending', 'processing', 'completed', 'cancelled')
+
+# status -> statuses an order may move to from there
+ORDER_TRANSITIONS = {
+    'pending': ('processing', 'cancelled'),
+    'processing': ('completed', 'cancelled'),
+    'completed': (),
+    'cancelled': (),
+}
+
+
+def statuses_leading_to(status):
+    """Statuses from which an order may move to status"""
+    return tuple(source for source, targets in ORDER_TRANSITIONS.items() if status in targets)
+
 
 class OrderItem:
     """
@@ -7,10 +22,11 @@ class OrderItem:
     Demonstrates encapsulation
     """
     
-    def __init__(self, product_id, product_name, quantity, price, item_id=None):
+    def __init__(self, product_id, product_name, quantity, price, item_id=None, variant_id=None):
         """Initialize order item"""
         self._id = item_id
         self._product_id = product_id
+        self._variant_id = variant_id
         self._product_name = product_name
         self._quantity = int(quantity)
         self._price = float(price)
@@ -23,6 +39,10 @@ class OrderItem:
     def product_id(self):
         return self._product_id
     
+    @property
+    def variant_id(self):
+        return self._variant_id
+    
     @property
     def product_name(self):
         return self._product_name
@@ -44,6 +64,7 @@ class OrderItem:
         return {
             'id': self._id,
             'product_id': self._product_id,
+            'variant_id': self._variant_id,
             'product_name': self._product_name,
             'quantity': self._quantity,
             'price': self._price,
@@ -116,12 +137,17 @@ class Order:
     
     def update_status(self, new_status):
         """Update order status"""
-        valid_statuses = ['pending', 'processing', 'completed', 'cancelled']
-        if new_status not in valid_statuses:
-            raise ValueError(f"Status must be one of {valid_statuses}")
+        if new_status not in ORDER_STATUSES:
+            raise ValueError(f"Status must be one of {list(ORDER_STATUSES)}")
+        if not self.can_transition(new_status):
+            raise ValueError(f"Cannot move a {self._status} order to {new_status}")
         self._status = new_status
         self._updated_at = datetime.now()
     
+    def can_transition(self, new_status):
+        """Check the status state machine"""
+        return new_status in ORDER_TRANSITIONS.get(self._status, ())
+    
     def get_item_count(self):
         """Get total number of items"""
         return sum(item.quantity for item in self._items)
@@ -160,7 +186,8 @@ class Order:
                     product_name=item_data.get('product_name'),
                     quantity=item_data.get('quantity'),
                     price=item_data.get('price'),
-                    item_id=item_data.get('id')
+                    item_id=item_data.get('id'),
+                    variant_id=item_data.get('variant_id')
                 )
                 order._items.append(item)
         
@@ -5,6 +5,13 @@ import json
 
 class Product:
     """base class for all products"""
+
+    # discount policy, also compiled into the bulk effective-price SQL:
+    # the largest percentage honored (None = no cap) and a multiplier
+    # applied to the discounted price
+    max_discount = None
+    discount_multiplier = 1.0
+
     def __init__(self, name, brand, price, stock=0, product_id=None):
         self._id = product_id
         self._name = name
@@ -12,6 +19,10 @@ class Product:
         self._price = float(price)
         self._stock = int(stock)
         self._created_at = datetime.now()
+        # row version from the database, used for optimistic concurrency
+        self.version = None
+        # price after the best active promotion, precomputed in the database
+        self.effective_price = None
 
     @property
     def id(self):
@@ -57,6 +68,10 @@ class Product:
         self._stock += quantity
         return self._stock
     
+    def calculate_discount(self, percentage):
+        """Price after a percentage discount"""
+        return self._price * (1 - percentage / 100)
+
     def shoe_in_stock(self):
         """Check if the product is in stock"""
         return self._stock > 0
@@ -84,6 +99,8 @@ class Product:
             'brand': self._brand,
             'price': self._price,
             'stock': self._stock,
+            'effective_price': self._price if self.effective_price is None else self.effective_price,
+            'version': self.version,
             'created_at': self._created_at.isoformat() if self._created_at else None
         }
     
@@ -101,16 +118,87 @@ class Product:
     def __repr__(self):
         return f"<Product id={self._id} name={self._name} brand={self._brand} price=${self._price} stock={self._stock}>"
     
+class ShoeVariant:
+    """One size/color of a shoe style, with its own stock.
+
+    A variant without a color has color '', as product_variants stores it.
+    """
+
+    def __init__(self, size, color='', stock=0, variant_id=None):
+        self._id = variant_id
+        self._size = str(size)
+        self._color = color
+        self._stock = int(stock)
+        if self._stock < 0:
+            raise ValueError("Stock cannot be negative")
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def color(self):
+        return self._color
+
+    @property
+    def stock(self):
+        return self._stock
+
+    def to_dict(self):
+        return {
+            'id': self._id,
+            'size': self._size,
+            'color': self._color,
+            'stock': self._stock
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            size=data['size'],
+            color=data.get('color') or '',
+            stock=int(data.get('stock', 0)),
+            variant_id=data.get('id')
+        )
+
+    def __repr__(self):
+        return f"ShoeVariant(size={self._size}, color='{self._color}', stock={self._stock})"
+
+
+def size_sort_key(size):
+    """Numeric sizes in numeric order ('9.5' before '10'), anything else after"""
+    try:
+        return (0, float(size), '')
+    except ValueError:
+        return (1, 0.0, size)
+
+
 class Shoe(Product):
-    """Shoe class inheriting the Product base class"""
+    """Shoe class inheriting the Product base class.
+
+    A shoe is one style; its sizes and colors are ShoeVariants, each with
+    their own stock. stock is the total over all variants. Passing just size,
+    color and stock creates a style with that single variant.
+    """
+
+    # get_attributes() stays Product's: size, color, category and image are
+    # real columns and the variants have their own table, so only the extra
+    # fields of the subclasses go into the attributes JSON
 
     def __init__(self, name, brand, price, size, stock=0, color='Black', 
-                 category='casual',product_id=None, image=None):
+                 category='casual',product_id=None, image=None, variants=None):
+        if variants:
+            stock = sum(variant.stock for variant in variants)
         super().__init__(name, brand, price, stock, product_id)
         self._size = size
         self._color = color
         self._category = category
         self._image = image
+        self._variants = list(variants) if variants else [ShoeVariant(size, color, stock)]
 
     @property
     def size(self):
@@ -127,6 +215,23 @@ class Shoe(Product):
     @property
     def image(self):
         return self._image
+
+    @property
+    def variants(self):
+        return list(self._variants)
+
+    @property
+    def sizes(self):
+        """Sizes with stock in any color, in size order"""
+        in_stock = {variant.size for variant in self._variants if variant.stock > 0}
+        return sorted(in_stock, key=size_sort_key)
+
+    def get_variant(self, size, color=None):
+        """The variant for a size (and color), or None"""
+        for variant in self._variants:
+            if variant.size == str(size) and (color is None or variant.color == color):
+                return variant
+        return None
     
     def get_display_info(self):
         """Override the base method to include shoe-specific info"""
@@ -136,19 +241,11 @@ class Shoe(Product):
             'color': self._color,
             'category': self._category,
             'image': self._image,
+            'sizes': self.sizes,
             'type': 'Shoe'
             })
         return info
     
-    def get_attributes(self):
-        """Get shoe-specific attributes as a dictionary"""
-        return {
-            'size': self._size,
-            'color': self._color,
-            'category': self._category,
-            'image': self._image
-        }
-    
     def to_dict(self):
         """Convert shoe to dictionary for JSON serialization"""
         data = super().to_dict()
@@ -157,14 +254,26 @@ class Shoe(Product):
             'color': self._color,
             'category': self._category,
             'image': self._image ,
-            'attributes': json.dumps(self.get_attributes())
+            'attributes': json.dumps(self.get_attributes()),
+            'sizes': self.sizes,
+            'variants': [variant.to_dict() for variant in self._variants]
              })
         return data
+
+    @staticmethod
+    def variants_from_dict(data):
+        """ShoeVariants from data['variants'] (a list or its JSON), or None"""
+        variants = data.get('variants')
+        if isinstance(variants, str):
+            variants = json.loads(variants)
+        if not variants:
+            return None
+        return [ShoeVariant.from_dict(variant) for variant in variants]
     
     @classmethod
     def from_dict(cls, data):
         """Create shoe Object from dictionary"""
-        attributes = data.get('attributes', {})
+        attributes = data.get('attributes') or {}
         if isinstance(attributes, str):
             attributes = json.loads(attributes)
 
@@ -177,7 +286,8 @@ class Shoe(Product):
             color=data.get('color', attributes.get('color', 'Black')),
             category=data.get('category', attributes.get('category', 'casual')),
             product_id=data.get('id'),
-            image=data.get('image')
+            image=data.get('image'),
+            variants=cls.variants_from_dict(data)
         )
         return shoe
     
@@ -186,11 +296,13 @@ class Shoe(Product):
 
 class AthleticShoe(Shoe):
     """Athletic Shoe class - specialized shoe type"""
+
+    discount_multiplier = 0.95
     
     def __init__(self, name, brand, price, size, stock=0, color='Black', 
-                 sport_type='running', product_id=None, image=None):
+                 sport_type='running', product_id=None, image=None, variants=None):
         """Initialize athletic shoe with sport type"""
-        super().__init__(name, brand, price, size, stock, color, 'athletic', product_id, image)
+        super().__init__(name, brand, price, size, stock, color, 'athletic', product_id, image, variants)
         self._sport_type = sport_type
     
     @property
@@ -210,7 +322,7 @@ class AthleticShoe(Shoe):
     def calculate_discount(self, percentage):
         """Athletic shoes get additional 5% discount"""
         base_discount = super().calculate_discount(percentage)
-        return base_discount * 0.95
+        return base_discount * self.discount_multiplier
     
     def get_attributes(self):
         """Override to include sport type"""
@@ -221,13 +333,14 @@ class AthleticShoe(Shoe):
     def to_dict(self):
         """Override to include athletic-specific fields"""
         data = super().to_dict()
+        data['sport_type'] = self._sport_type
         data['attributes'] = json.dumps(self.get_attributes())
         return data
     
     @classmethod
     def from_dict(cls, data):
         """Create AthleticShoe from dictionary"""
-        attributes = data.get('attributes', {})
+        attributes = data.get('attributes') or {}
         if isinstance(attributes, str):
             attributes = json.loads(attributes)
         
@@ -238,8 +351,10 @@ class AthleticShoe(Shoe):
             size=data.get('size', attributes.get('size', '10')),
             stock=data.get('stock', 0),
             color=data.get('color', attributes.get('color', 'Black')),
-            sport_type=attributes.get('sport_type', 'running'),
-            product_id=data.get('id')
+            sport_type=data.get('sport_type') or attributes.get('sport_type', 'running'),
+            product_id=data.get('id'),
+            image=data.get('image'),
+            variants=cls.variants_from_dict(data)
         )
         return shoe
     
@@ -251,9 +366,9 @@ class CasualShoe(Shoe):
     """Casual Shoe class - specialized shoe type"""
     
     def __init__(self, name, brand, price, size, stock=0, color='Black', 
-                 style='sneaker', product_id=None, image=None):
+                 style='sneaker', product_id=None, image=None, variants=None):
         """Initialize casual shoe with style"""
-        super().__init__(name, brand, price, size, stock, color, 'casual', product_id, image)
+        super().__init__(name, brand, price, size, stock, color, 'casual', product_id, image, variants)
         self._style = style
     
     @property
@@ -283,13 +398,14 @@ class CasualShoe(Shoe):
     def to_dict(self):
         """Override to include casual-specific fields"""
         data = super().to_dict()
+        data['style'] = self._style
         data['attributes'] = json.dumps(self.get_attributes())
         return data
     
     @classmethod
     def from_dict(cls, data):
         """Create CasualShoe from dictionary"""
-        attributes = data.get('attributes', {})
+        attributes = data.get('attributes') or {}
         if isinstance(attributes, str):
             attributes = json.loads(attributes)
         
@@ -300,8 +416,10 @@ class CasualShoe(Shoe):
             size=data.get('size', attributes.get('size', '10')),
             stock=data.get('stock', 0),
             color=data.get('color', attributes.get('color', 'Black')),
-            style=attributes.get('style', 'sneaker'),
-            product_id=data.get('id')
+            style=data.get('style') or attributes.get('style', 'sneaker'),
+            product_id=data.get('id'),
+            image=data.get('image'),
+            variants=cls.variants_from_dict(data)
         )
         return shoe
     
@@ -311,11 +429,13 @@ class CasualShoe(Shoe):
 
 class FormalShoe(Shoe):
     """Formal Shoe class - specialized shoe type"""
+
+    max_discount = 10
     
     def __init__(self, name, brand, price, size, stock=0, color='Black', 
-                 material='leather', product_id=None, image=None):
+                 material='leather', product_id=None, image=None, variants=None):
         """Initialize formal shoe with material"""
-        super().__init__(name, brand, price, size, stock, color, 'formal', product_id, image)
+        super().__init__(name, brand, price, size, stock, color, 'formal', product_id, image, variants)
         self._material = material
     
     @property
@@ -334,7 +454,7 @@ class FormalShoe(Shoe):
     
     def calculate_discount(self, percentage):
         """Formal shoes have limited discount (max 10%)"""
-        max_discount = min(percentage, 10)
+        max_discount = min(percentage, self.max_discount)
         return super().calculate_discount(max_discount)
     
     def get_attributes(self):
@@ -346,13 +466,14 @@ class FormalShoe(Shoe):
     def to_dict(self):
         """Override to include formal-specific fields"""
         data = super().to_dict()
+        data['material'] = self._material
         data['attributes'] = json.dumps(self.get_attributes())
         return data
     
     @classmethod
     def from_dict(cls, data):
         """Create FormalShoe from dictionary"""
-        attributes = data.get('attributes', {})
+        attributes = data.get('attributes') or {}
         if isinstance(attributes, str):
             attributes = json.loads(attributes)
         
@@ -363,14 +484,28 @@ class FormalShoe(Shoe):
             size=data.get('size', attributes.get('size', '10')),
             stock=data.get('stock', 0),
             color=data.get('color', attributes.get('color', 'Black')),
-            material=attributes.get('material', 'leather'),
-            product_id=data.get('id')
+            material=data.get('material') or attributes.get('material', 'leather'),
+            product_id=data.get('id'),
+            image=data.get('image'),
+            variants=cls.variants_from_dict(data)
         )
         return shoe
     
     def __repr__(self):
         return f"FormalShoe(name='{self._name}', material='{self._material}', size={self._size})"
 
-    
 
-    
\ No newline at end of file
+# category column value -> model class, used when loading rows from the database
+SHOE_TYPES = {
+    'athletic': AthleticShoe,
+    'casual': CasualShoe,
+    'formal': FormalShoe,
+}
+
+
+def shoe_from_dict(data):
+    """Create the Shoe subclass matching data['category'] (plain Shoe if unknown)"""
+    shoe = SHOE_TYPES.get(data.get('category'), Shoe).from_dict(data)
+    shoe.version = data.get('version')
+    shoe.effective_price = data.get('effective_price')
+    return shoe
@@ -0,0 +1,219 @@
+"""Rate limiting and load shedding.
+
+Token buckets live in their own small SQLite file, next to the store
+database, so every worker process shares them without adding writes to the
+store's lock. A bucket is refilled and charged in one UPSERT, which makes
+the check atomic across processes.
+
+Views opt in with decorators:
+
+    @shed_under_load
+    @rate_limited('login', 'ip', 'username', failures_only=True)
+    def login(): ...
+
+RATE_LIMITS maps a scope to {key kind: (capacity, refill seconds)}. A
+request over any of its buckets gets 429 with Retry-After, and the tokens
+it took from its other buckets are given back. With failures_only, a
+request that succeeds gets its tokens back too, so only failed attempts
+(bad passwords) use up the bucket. Under overload, views marked with
+shed_under_load get 503 with Retry-After right away, so the capacity that
+is left goes to the catalog.
+"""
+
+import itertools
+import math
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, g, jsonify, make_response, request
+
+
+class TokenBuckets:
+    """Token buckets stored in a SQLite file shared by all workers.
+
+    A bucket left alone for idle_after seconds (the longest refill period)
+    is full again, which is the same as having no row, so every
+    prune_every takes such rows are deleted. Otherwise every username ever
+    tried at the login would keep its row forever.
+    """
+
+    def __init__(self, path, idle_after=3600, prune_every=1000):
+        self.path = path
+        self.idle_after = idle_after
+        self.prune_every = prune_every
+        self._calls = itertools.count(1)
+        self._local = threading.local()
+
+    def _connection(self):
+        # one long-lived connection per thread; opening one per check would
+        # cost more than the check itself
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # losing the last few refills in a crash is harmless
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    allowed INTEGER NOT NULL
+                    ) WITHOUT ROWID
+            ''')
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, capacity, period):
+        """Take a token from a bucket; returns seconds to wait, 0 if allowed.
+
+        The bucket holds up to capacity tokens and refills completely over
+        period seconds.
+        """
+        rate = capacity / period
+        now = time.time()
+        tokens, allowed = self._connection().execute('''
+            INSERT INTO buckets (key, tokens, updated_at, allowed) VALUES (:key, :capacity - 1, :now, 1)
+            ON CONFLICT(key) DO UPDATE SET
+                allowed = MIN(:capacity, tokens + (:now - updated_at) * :rate) >= 1,
+                tokens = MIN(:capacity, tokens + (:now - updated_at) * :rate)
+                         - (MIN(:capacity, tokens + (:now - updated_at) * :rate) >= 1),
+                updated_at = :now
+            RETURNING tokens, allowed
+        ''', {'key': key, 'capacity': capacity, 'now': now, 'rate': rate}).fetchone()
+        if next(self._calls) % self.prune_every == 0:
+            self.prune(now)
+        return 0 if allowed else (1 - tokens) / rate
+
+    def prune(self, now=None):
+        """Delete buckets that have refilled completely; returns how many"""
+        cutoff = (now or time.time()) - self.idle_after
+        return self._connection().execute('DELETE FROM buckets WHERE updated_at < ?', (cutoff,)).rowcount
+
+    def refund(self, key, capacity):
+        """Give back a token taken from a bucket"""
+        self._connection().execute('UPDATE buckets SET tokens = MIN(?, tokens + 1) WHERE key = ?',
+                                   (capacity, key))
+
+    def clear(self):
+        self._connection().execute('DELETE FROM buckets')
+
+
+class LoadShedder:
+    """Tracks how long requests wait and run, and says when to shed.
+
+    Queue time comes from an X-Request-Start header set by the proxy (nginx
+    `t=${msec}`, or milliseconds/microseconds since the epoch). Without one,
+    an EWMA of in-process latency stands in for it. Either passing
+    LOAD_SHED_LATENCY means overloaded.
+    """
+
+    def __init__(self, threshold, alpha=0.2):
+        self.threshold = threshold
+        self.alpha = alpha
+        self.latency = 0.0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.extensions['load_shedder'] = self
+        app.before_request(self._before)
+        app.teardown_request(self._teardown)
+
+    def _before(self):
+        g.request_started = time.time()
+        g.queue_delay = queue_delay(request.headers.get('X-Request-Start'), g.request_started)
+
+    def _teardown(self, exc=None):
+        started = g.pop('request_started', None)
+        if started is None:
+            return
+        elapsed = time.time() - started + (g.get('queue_delay') or 0)
+        with self._lock:
+            self.latency += self.alpha * (elapsed - self.latency)
+
+    def overloaded(self):
+        return max(g.get('queue_delay') or 0, self.latency) > self.threshold
+
+
+def queue_delay(header, now):
+    """Seconds since the proxy saw the request, from X-Request-Start; None if absent"""
+    if not header:
+        return None
+    try:
+        started = float(header.strip().removeprefix('t='))
+    except ValueError:
+        return None
+    if started > 1e14:
+        started /= 1e6  # microseconds
+    elif started > 1e11:
+        started /= 1e3  # milliseconds
+    return max(0.0, now - started)
+
+
+def retry_response(message, status, seconds):
+    response = jsonify({'message': message})
+    response.status_code = status
+    response.headers['Retry-After'] = str(max(1, math.ceil(seconds)))
+    return response
+
+
+def request_keys(kinds):
+    """Bucket key values for the request: client ip, username from the body"""
+    values = {}
+    for kind in kinds:
+        if kind == 'ip':
+            values[kind] = request.remote_addr or 'unknown'
+        elif kind == 'username':
+            username = (request.get_json(silent=True) or {}).get('username')
+            if isinstance(username, str) and username:
+                values[kind] = username.lower()
+    return values
+
+
+def rate_limited(scope, *kinds, failures_only=False):
+    """Limit a view per ip and/or username with the buckets in RATE_LIMITS[scope].
+
+    With failures_only, responses under 400 give their tokens back.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            config = current_app.config
+            if not config['RATE_LIMIT_ENABLED']:
+                return f(*args, **kwargs)
+            buckets = current_app.extensions['rate_limiter']
+            limits = config['RATE_LIMITS'][scope]
+            wait = 0
+            taken = []
+            for kind, value in request_keys(kinds).items():
+                capacity, period = limits[kind]
+                key = f'{scope}:{kind}:{value}'
+                bucket_wait = buckets.take(key, capacity, period)
+                if not bucket_wait:
+                    taken.append((key, capacity))
+                wait = max(wait, bucket_wait)
+            if wait:
+                # a rejected request doesn't count against the buckets that let it through
+                for key, capacity in taken:
+                    buckets.refund(key, capacity)
+                return retry_response('Too many requests, slow down', 429, wait)
+            response = make_response(f(*args, **kwargs))
+            if failures_only and response.status_code < 400:
+                for key, capacity in taken:
+                    buckets.refund(key, capacity)
+            return response
+        return decorated
+    return decorator
+
+
+def shed_under_load(f):
+    """Answer 503 instead of running the view while the server is overloaded"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if current_app.extensions['load_shedder'].overloaded():
+            return retry_response('Server busy, try again shortly', 503,
+                                  current_app.config['LOAD_SHED_RETRY_AFTER'])
+        return f(*args, **kwargs)
+    return decorated
@@ -0,0 +1,207 @@
+"""Read-only copies of a store database for catalog browsing and reports.
+
+With REPLICAS > 0 every store keeps that many copies of its database, made
+with SQLite's online backup API, and DatabaseManager reads the catalog
+listing, catalog version, related products, low stock, stock trends and
+sales summaries from them (get_read_connection). Checkout, stock changes
+and everything else that writes stays on the primary file, so long reads
+never hold a WAL snapshot there and the two don't compete for its pages.
+
+A background thread refreshes the copies every REPLICA_REFRESH_INTERVAL
+seconds if the primary changed, or as soon as REPLICA_REFRESH_WRITES write
+transactions were committed through this process. A refresh copies into a
+new file and then switches to it; connections still reading the old file
+finish there, so readers never wait on a refresh. Copies are per process,
+in REPLICA_DIR (a temporary directory by default).
+
+Replicas lag the primary by up to one refresh. An admin who has just
+changed something reads from the primary for REPLICA_READ_YOUR_WRITES
+seconds (a cookie), so a new shoe shows up in their own listing right away.
+"""
+
+import itertools
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from flask import current_app, g, request
+
+from backups import copy_database
+from db_manager import ConnectionPool, read_primary
+
+logger = logging.getLogger(__name__)
+
+# cookie holding the time until which a client reads from the primary
+PRIMARY_COOKIE = 'read_primary_until'
+
+
+class ReplicaSet:
+    """count read-only copies of one DatabaseManager's file, kept fresh"""
+
+    def __init__(self, db, count=1, directory=None, interval=30.0, writes=1000, pool_size=8, pages=-1):
+        self.db = db
+        self.count = count
+        self.interval = interval
+        self.writes = writes
+        self.pool_size = pool_size or 1
+        self.pages = pages
+        self.directory = directory or tempfile.mkdtemp(prefix='replicas-')
+        os.makedirs(self.directory, exist_ok=True)
+        name = os.path.splitext(os.path.basename(db.db_name))[0]
+        self._prefix = os.path.join(self.directory, f'{name}-{os.getpid()}')
+        self._pools = [None] * count
+        self._turn = itertools.count()
+        self._generation = itertools.count(1)
+        self._leftovers = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._monitor = None
+        self._data_version = None
+        self._commits = 0
+        self.refreshed_at = 0.0
+        self.refreshes = 0
+
+    def get_connection(self):
+        """A connection to one of the copies (round robin), None before the first refresh"""
+        pool = self._pools[next(self._turn) % self.count]
+        if pool is None:
+            return None
+        conn = pool.connect()
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _primary_commits(self):
+        return self.db.pool.commits if self.db.pool is not None else 0
+
+    def _primary_data_version(self):
+        # changes whenever another connection (in any process) commits
+        if self._monitor is None:
+            self._monitor = sqlite3.connect(self.db.db_name, check_same_thread=False)
+        return self._monitor.execute('PRAGMA data_version').fetchone()[0]
+
+    def due(self):
+        if self._primary_commits() - self._commits >= self.writes:
+            return True
+        return (time.time() - self.refreshed_at >= self.interval
+                and self._primary_data_version() != self._data_version)
+
+    def refresh(self):
+        """Copy the primary into every replica; returns how long it took"""
+        with self._lock:
+            started = time.time()
+            # read before copying: a commit in between only means one extra refresh
+            self._commits = self._primary_commits()
+            self._data_version = self._primary_data_version()
+            source = sqlite3.connect(self.db.db_name)
+            try:
+                for slot in range(self.count):
+                    path = f'{self._prefix}-{slot}-{next(self._generation)}.db'
+                    copy_database(source, path, self.pages)
+                    old, self._pools[slot] = self._pools[slot], ConnectionPool(path, self.pool_size, read_only=True)
+                    if old is not None:
+                        old.retire()
+                        self._leftovers.append(old.path)
+            finally:
+                source.close()
+            self._remove_leftovers()
+            self.refreshed_at = time.time()
+            self.refreshes += 1
+            return self.refreshed_at - started
+
+    def _remove_leftovers(self):
+        # on Windows a file still open by a reader can't be removed yet
+        kept = []
+        for path in self._leftovers:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                kept.append(path)
+        self._leftovers = kept
+
+    def start(self, tick=1.0):
+        """Make the first copies now and keep them fresh in a daemon thread"""
+        self.refresh()
+        self._thread = threading.Thread(target=self._run, args=(tick,), name='replica-refresh', daemon=True)
+        self._thread.start()
+
+    def _run(self, tick):
+        while not self._stop.wait(tick):
+            try:
+                if self.due():
+                    self.refresh()
+            except sqlite3.Error as e:
+                # the old copies keep serving; try again on the next tick
+                logger.warning('Replica refresh of %s failed: %s', self.db.db_name, e)
+
+    def stop(self):
+        """Stop refreshing and delete the copies"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            for slot, pool in enumerate(self._pools):
+                if pool is not None:
+                    pool.retire()
+                    self._leftovers.append(pool.path)
+                self._pools[slot] = None
+            self._remove_leftovers()
+            if self._monitor is not None:
+                self._monitor.close()
+                self._monitor = None
+
+
+def start_replicas(app):
+    """Give every store database its ReplicaSet (when REPLICAS > 0)"""
+    config = app.config
+    if config['REPLICAS'] <= 0:
+        return []
+    replica_sets = []
+    for location in app.extensions['shards'].stores.values():
+        directory = os.path.join(config['REPLICA_DIR'], location.id) if config['REPLICA_DIR'] else None
+        replicas = ReplicaSet(location.db, config['REPLICAS'], directory, config['REPLICA_REFRESH_INTERVAL'],
+                              config['REPLICA_REFRESH_WRITES'], config['DB_POOL_SIZE'])
+        replicas.start()
+        location.db.replicas = replicas
+        replica_sets.append(replicas)
+    app.extensions['replicas'] = replica_sets
+    return replica_sets
+
+
+def init_app(app):
+    app.before_request(_choose_source)
+    app.after_request(_remember_write)
+    app.teardown_request(_reset_source)
+
+
+def mark_write():
+    """Send this client's reads to the primary for a while (call after a write)"""
+    g.wrote = True
+
+
+def _choose_source():
+    try:
+        until = float(request.cookies.get(PRIMARY_COOKIE, 0))
+    except ValueError:
+        until = 0
+    if until > time.time():
+        g.read_primary_token = read_primary.set(True)
+
+
+def _remember_write(response):
+    if g.get('wrote') and response.status_code < 400 and current_app.config['REPLICAS'] > 0:
+        seconds = current_app.config['REPLICA_READ_YOUR_WRITES']
+        response.set_cookie(PRIMARY_COOKIE, f'{time.time() + seconds:.0f}', max_age=seconds,
+                            httponly=True, samesite='Lax')
+    return response
+
+
+def _reset_source(exc=None):
+    token = g.pop('read_primary_token', None)
+    if token is not None:
+        read_primary.reset(token)
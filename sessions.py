@@ -0,0 +1,249 @@
+"""Login sessions: short-lived access tokens, rotating refresh tokens.
+
+Logging in opens a row in `sessions` and returns two tokens:
+
+* an access token, an HS256 JWT valid for ACCESS_TOKEN_TTL seconds that
+  carries the user's id, name, role and session id (sid). Checking it
+  needs no database query at all;
+* a refresh token, a random string stored only as a SHA-256 hash, that
+  buys a new access token (and a new refresh token) until the session
+  expires or is revoked. Presenting an already-rotated refresh token
+  revokes the session, since it means the token was copied.
+
+Revoking a session (logout, or an admin revoking a user) has to stop its
+access tokens too. Every process keeps a RevocationSet of recently revoked
+session ids and pulls new revocations from the database at most every
+REVOCATION_SYNC_INTERVAL seconds, so revocation takes effect within
+seconds without a query per request.
+"""
+
+import hashlib
+import secrets
+import threading
+import time
+import uuid
+
+
+class TokenError(Exception):
+    """Raised for missing, expired, malformed or revoked tokens"""
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings"""
+
+    def __init__(self, bits=1 << 16, hashes=4):
+        self.bits = bits
+        self.hashes = hashes
+        self._array = bytearray(bits // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=4 * self.hashes).digest()
+        for i in range(self.hashes):
+            yield int.from_bytes(digest[4 * i:4 * i + 4], 'little') % self.bits
+
+    def add(self, item):
+        for position in self._positions(item):
+            self._array[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self._array[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+
+class RevocationSet:
+    """Revoked session ids, kept in memory and refreshed from the database.
+
+    Lookups hit the Bloom filter first, so the usual "not revoked" answer is
+    a few bit tests; the exact set settles the rare false positives. Only
+    sessions revoked within the access token lifetime are kept, older ones
+    have no live access tokens left. Both structures are rebuilt when the
+    window moves on, which keeps the filter from filling up.
+    """
+
+    def __init__(self, db, window, sync_interval):
+        self.db = db
+        self.window = window
+        self.sync_interval = sync_interval
+        self._bloom = BloomFilter()
+        self._exact = set()
+        self._synced_at = 0.0
+        self._rebuilt_at = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, session_id):
+        """Record a revocation made by this process right away"""
+        with self._lock:
+            self._bloom.add(str(session_id))
+            self._exact.add(session_id)
+
+    def is_revoked(self, session_id):
+        self._maybe_sync()
+        return str(session_id) in self._bloom and session_id in self._exact
+
+    def _maybe_sync(self):
+        now = time.time()
+        if now - self._synced_at < self.sync_interval:
+            return
+        # one thread syncs; the others carry on with the current set
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            if now - self._rebuilt_at > self.window:
+                since = now - self.window
+                self._bloom = BloomFilter()
+                self._exact = set()
+                self._rebuilt_at = now
+            else:
+                # a little overlap covers revocations committed out of order
+                since = self._synced_at - 1
+            conn = self.db.get_connection()
+            rows = conn.execute('SELECT id FROM sessions WHERE revoked_at >= ?', (since,)).fetchall()
+            conn.close()
+            for row in rows:
+                self._bloom.add(str(row[0]))
+                self._exact.add(row[0])
+            self._synced_at = now
+        finally:
+            self._lock.release()
+
+
+def hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class SessionManager:
+    """Issue, refresh, check and revoke tokens for one app"""
+
+    def __init__(self, db, secret_key, access_ttl=900, refresh_ttl=14 * 86400, sync_interval=2.0, store=None,
+                 unscoped=False):
+        self.db = db
+        self.secret_key = secret_key
+        # with several store databases, a token only works at the store that issued it
+        self.store = store
+        # also accept tokens without a store claim, issued before there were
+        # stores; their sessions live in the default store's database
+        self.unscoped = unscoped
+        self.access_ttl = access_ttl
+        self.refresh_ttl = refresh_ttl
+        self.revoked = RevocationSet(db, access_ttl, sync_interval)
+
+    def _access_token(self, user, session_id, now):
+        import jwt
+
+        claims = {
+            'user_id': user['id'],
+            'username': user['username'],
+            'role': user['role'],
+            'sid': session_id,
+            'jti': uuid.uuid4().hex,
+            'type': 'access',
+            'iat': int(now),
+            'exp': int(now + self.access_ttl)
+        }
+        if self.store is not None:
+            claims['store'] = self.store
+        return jwt.encode(claims, self.secret_key, algorithm='HS256')
+
+    def _tokens(self, user, session_id, refresh_token, now):
+        return {
+            'access_token': self._access_token(user, session_id, now),
+            'refresh_token': refresh_token,
+            'token_type': 'Bearer',
+            'expires_in': self.access_ttl
+        }
+
+    def open(self, user):
+        """Start a session for an authenticated user dict; returns the tokens"""
+        now = time.time()
+        refresh_token = secrets.token_urlsafe(32)
+        conn = self.db.get_connection()
+        session_id = conn.execute('''
+            INSERT INTO sessions (user_id, refresh_hash, created_at, last_used_at, expires_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user['id'], hash_token(refresh_token), now, now, now + self.refresh_ttl)).lastrowid
+        conn.commit()
+        conn.close()
+        return self._tokens(user, session_id, refresh_token, now)
+
+    def refresh(self, refresh_token):
+        """Rotate a refresh token; returns new tokens or raises TokenError"""
+        now = time.time()
+        token_hash = hash_token(refresh_token)
+        new_token = secrets.token_urlsafe(32)
+        conn = self.db.get_connection()
+        try:
+            row = conn.execute('''
+                UPDATE sessions SET previous_hash = refresh_hash, refresh_hash = ?, last_used_at = ?
+                WHERE refresh_hash = ? AND revoked_at IS NULL AND expires_at > ?
+                RETURNING id, user_id
+            ''', (hash_token(new_token), now, token_hash, now)).fetchone()
+            if row is None:
+                reused = conn.execute('''
+                    UPDATE sessions SET revoked_at = ?
+                    WHERE previous_hash = ? AND revoked_at IS NULL
+                    RETURNING id
+                ''', (now, token_hash)).fetchone()
+                conn.commit()
+                if reused:
+                    # an old refresh token came back: whoever holds it isn't the owner
+                    self.revoked.add(reused[0])
+                raise TokenError('Refresh token is invalid or expired')
+            user = conn.execute('SELECT id, username, role FROM users WHERE id = ?',
+                                (row['user_id'],)).fetchone()
+            conn.commit()
+        finally:
+            conn.close()
+        if user is None:
+            raise TokenError('User no longer exists')
+        return self._tokens(dict(user), row['id'], new_token, now)
+
+    def verify(self, token):
+        """Claims of a valid access token, or raises TokenError (no DB query)"""
+        import jwt
+
+        try:
+            claims = jwt.decode(token, self.secret_key, algorithms=['HS256'])
+        except jwt.PyJWTError as e:
+            raise TokenError(str(e))
+        if claims.get('type') != 'access' or 'sid' not in claims:
+            raise TokenError('Not an access token')
+        if claims.get('store', self.store if self.unscoped else None) != self.store:
+            raise TokenError('Token was issued by another store')
+        if self.revoked.is_revoked(claims['sid']):
+            raise TokenError('Session has been revoked')
+        return claims
+
+    def revoke(self, session_id):
+        """End one session; False if it was unknown or already revoked"""
+        conn = self.db.get_connection()
+        revoked = conn.execute('UPDATE sessions SET revoked_at = ? WHERE id = ? AND revoked_at IS NULL',
+                               (time.time(), session_id)).rowcount
+        conn.commit()
+        conn.close()
+        if revoked:
+            self.revoked.add(session_id)
+        return bool(revoked)
+
+    def revoke_user(self, user_id):
+        """End every open session of a user; returns how many"""
+        conn = self.db.get_connection()
+        rows = conn.execute('''
+            UPDATE sessions SET revoked_at = ?
+            WHERE user_id = ? AND revoked_at IS NULL
+            RETURNING id
+        ''', (time.time(), user_id)).fetchall()
+        conn.commit()
+        conn.close()
+        for row in rows:
+            self.revoked.add(row[0])
+        return len(rows)
+
+    def purge_expired(self, older_than=86400):
+        """Delete sessions that expired or were revoked over a day ago"""
+        cutoff = time.time() - older_than
+        conn = self.db.get_connection()
+        count = conn.execute('DELETE FROM sessions WHERE expires_at < ? OR revoked_at < ?',
+                             (cutoff, cutoff)).rowcount
+        conn.commit()
+        conn.close()
+        return count
@@ -0,0 +1,239 @@
+"""Store locations, each with its own database file.
+
+Every store keeps its catalog, stock, orders, customers and job queue in a
+separate SQLite file, so a busy store never waits on another store's write
+lock. STORES maps store ids to files; left empty there is one store,
+DEFAULT_STORE, in DATABASE_NAME, which is how a single shop runs.
+
+A request picks its store with an X-Store-ID header or ?store=, otherwise it
+gets DEFAULT_STORE. The per-store objects (database, job queue, sessions,
+catalog cache, live updates) are reached through current_store();
+app.extensions['db'] and friends are proxies to it, so views and job
+handlers don't change.
+
+Cross-store admin reports use ShardRouter.fan_out(), which runs a function
+against every store in parallel threads, and merge the results.
+"""
+
+import contextvars
+import csv
+import heapq
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, g, has_app_context, jsonify, request
+
+
+class Store:
+    """Everything that belongs to one store location"""
+
+    def __init__(self, store_id, db, jobs, sessions, catalog_cache, live):
+        self.id = store_id
+        self.db = db
+        self.jobs = jobs
+        self.sessions = sessions
+        self.catalog_cache = catalog_cache
+        self.live = live
+
+
+def store_databases(config):
+    """store id -> database path from the app config"""
+    return dict(config['STORES']) or {config['DEFAULT_STORE']: config['DATABASE_NAME']}
+
+
+class ShardRouter:
+    """Routes each request (or job) to its store's database"""
+
+    def __init__(self, config):
+        from catalog_cache import CatalogCache
+        from db_manager import DatabaseManager
+        from jobs import JobQueue
+        from live import ChangeBroadcaster
+        from sessions import SessionManager
+
+        self.default = config['DEFAULT_STORE']
+        self.stores = {}
+        for store_id, path in store_databases(config).items():
+            db = DatabaseManager(path, pool_size=config['DB_POOL_SIZE'])
+            self.stores[store_id] = Store(
+                store_id, db, JobQueue(db, store_id),
+                SessionManager(db, config['SECRET_KEY'], config['ACCESS_TOKEN_TTL'],
+                               config['REFRESH_TOKEN_TTL'], config['REVOCATION_SYNC_INTERVAL'], store_id,
+                               unscoped=store_id == self.default),
+                CatalogCache(),
+                ChangeBroadcaster(db, config['LIVE_UPDATES_POLL_INTERVAL'], config['LIVE_UPDATES_BUFFER']))
+        if self.default not in self.stores:
+            raise ValueError(f'DEFAULT_STORE {self.default!r} is not in STORES')
+
+    def init_app(self, app):
+        app.extensions['shards'] = self
+        app.before_request(select_store)
+        if len(self.stores) > 1:
+            app.after_request(vary_on_store)
+
+    def get(self, store_id):
+        """A Store by id; KeyError if there is no such store"""
+        return self.stores[store_id]
+
+    def current(self):
+        """The store of the current request or job, else the default one"""
+        store_id = g.get('store') if has_app_context() else None
+        return self.stores[store_id or self.default]
+
+    def fan_out(self, func, store_ids=None, max_workers=None):
+        """Run func(store) for every store (or those in store_ids) in parallel.
+
+        Each call gets its own thread and talks to its own database, so a
+        report over N stores takes about as long as the slowest one. The
+        threads run in a copy of the caller's context, so context variables
+        such as read_primary carry over. Returns {store id: result}; an
+        exception in any store is raised.
+        """
+        stores = [self.stores[store_id] for store_id in (store_ids or self.stores)]
+        with ThreadPoolExecutor(max_workers=max_workers or len(stores),
+                                thread_name_prefix='store-fan-out') as pool:
+            # one copy per call: a context can't be entered by two threads at once
+            futures = {store.id: pool.submit(contextvars.copy_context().run, func, store) for store in stores}
+            return {store_id: future.result() for store_id, future in futures.items()}
+
+    def close(self):
+        for store in self.stores.values():
+            store.live.stop()
+            if store.db.replicas is not None:
+                store.db.replicas.stop()
+            if store.db.pool is not None:
+                store.db.pool.close_all()
+
+
+def current_store():
+    return current_app.extensions['shards'].current()
+
+
+def select_store():
+    """before_request: pick the store from X-Store-ID or ?store="""
+    store_id = request.headers.get('X-Store-ID') or request.args.get('store')
+    if store_id is None:
+        return None
+    if store_id not in current_app.extensions['shards'].stores:
+        return jsonify({'message': f'Unknown store: {store_id}'}), 404
+    g.store = store_id
+    return None
+
+
+def vary_on_store(response):
+    # the same URL answers differently per store
+    response.vary.add('X-Store-ID')
+    return response
+
+
+def merge_sorted(results, key, reverse=False, limit=None):
+    """Merge per-store lists that are each sorted by key into one list.
+
+    Every row gets a 'store' field saying where it came from.
+    """
+    tagged = [[dict(row, store=store_id) for row in rows] for store_id, rows in results.items()]
+    merged = heapq.merge(*tagged, key=key, reverse=reverse)
+    return [row for _, row in zip(range(limit), merged)] if limit is not None else list(merged)
+
+
+def sum_by_key(results):
+    """Add up per-store {key: {field: number}} dicts"""
+    totals = {}
+    for rows in results.values():
+        for key, fields in rows.items():
+            total = totals.setdefault(key, dict.fromkeys(fields, 0))
+            for field, value in fields.items():
+                total[field] = total.get(field, 0) + (value or 0)
+    return totals
+
+
+### SPLITTING ###
+
+# customer-owned rows, and how to tell which user they belong to
+USER_TABLES = {
+    'sessions': 'user_id',
+    'loyalty_points': 'user_id',
+    'orders': 'user_id',
+}
+
+
+def read_user_stores(path):
+    """user id -> store id from a CSV with user_id,store columns"""
+    with open(path, newline='') as f:
+        return {int(row['user_id']): row['store'] for row in csv.DictReader(f)}
+
+
+def split_database(source, targets, user_stores=None, stock_store=None, log=None):
+    """Split one store database into a database per store.
+
+    targets maps store id -> new database path. Each store starts as a
+    consistent copy of source (SQLite's backup API, safe while the app is
+    running), and then keeps:
+
+    * every admin account, and the customers user_stores assigns to it
+      (customers not in the mapping go to stock_store), together with their
+      sessions, loyalty points and orders;
+    * the whole catalog and its promotions, but only stock_store (default:
+      the first target) keeps the stock levels and their ledger, the
+      others start with zero on hand;
+    * the jobs queue and event outbox entries that still apply.
+
+    Ids are kept, so anything a store had before the split keeps its id.
+    Recommendations are recounted from each store's own orders.
+    """
+    from db_manager import DatabaseManager
+
+    user_stores = user_stores or {}
+    stock_store = stock_store or next(iter(targets))
+    if stock_store not in targets:
+        raise ValueError(f'Unknown stock store: {stock_store}')
+    unknown = set(user_stores.values()) - set(targets)
+    if unknown:
+        raise ValueError(f'Users assigned to unknown stores: {sorted(unknown)}')
+    for path in targets.values():
+        if os.path.exists(path):
+            raise ValueError(f'{path} already exists')
+
+    DatabaseManager(source).ensure_schema()
+    source_conn = sqlite3.connect(source)
+    try:
+        for store_id, path in targets.items():
+            conn = sqlite3.connect(path)
+            source_conn.backup(conn)
+            conn.isolation_level = None
+            conn.execute('BEGIN')
+            moved = [(user_id,) for user_id, role in conn.execute('SELECT id, role FROM users')
+                     if role != 'admin' and user_stores.get(user_id, stock_store) != store_id]
+            conn.execute('CREATE TEMP TABLE moved_users (id INTEGER PRIMARY KEY)')
+            conn.executemany('INSERT INTO moved_users (id) VALUES (?)', moved)
+
+            conn.execute('DELETE FROM order_items WHERE order_id IN '
+                         '(SELECT id FROM orders WHERE user_id IN (SELECT id FROM moved_users))')
+            for table, column in USER_TABLES.items():
+                conn.execute(f'DELETE FROM {table} WHERE {column} IN (SELECT id FROM moved_users)')
+            conn.execute('DELETE FROM users WHERE id IN (SELECT id FROM moved_users)')
+            conn.execute('''
+                DELETE FROM outbox WHERE topic LIKE 'order.%'
+                  AND CAST(key AS INTEGER) NOT IN (SELECT id FROM orders)
+            ''')
+            if store_id != stock_store:
+                conn.execute('DELETE FROM stock_movements')
+                conn.execute('DELETE FROM stock_balances')
+                conn.execute('DELETE FROM stock_snapshots')
+                conn.execute('UPDATE product_variants SET stock = 0')
+                conn.execute('UPDATE products SET stock = 0')
+                conn.execute('DELETE FROM jobs')
+            conn.execute('COMMIT')
+            counts = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                      for table in ('users', 'orders', 'products')}
+            conn.close()
+
+            db = DatabaseManager(path)
+            db.rebuild_co_purchases()
+            db.refresh_related_products()
+            if log:
+                log(f"{store_id}: {path} ({counts['users']} users, {counts['orders']} orders, "
+                    f"{counts['products']} products)")
+    finally:
+        source_conn.close()
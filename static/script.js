@@ -1,8 +1,12 @@
 // Global state
 let currentUser = null;
 let authToken = null;
+let refreshToken = null;
 let cart = [];
 let allShoes = [];
+let currentCategory = 'all';
+let liveUpdates = null;
+let catalogReload = null;
 
 // API Base URL (relative to current origin, not hardcoded)
 const API_BASE = '';
@@ -92,10 +96,12 @@ async function login() {
         
         if (response.ok) {
             authToken = data.token;
+            refreshToken = data.refresh_token;
             currentUser = data.user;
             
             // Save to localStorage
             localStorage.setItem('authToken', authToken);
+            localStorage.setItem('refreshToken', refreshToken);
             localStorage.setItem('currentUser', JSON.stringify(currentUser));
             
             showMessage(messageDiv, 'Login successful!', 'success');
@@ -153,32 +159,211 @@ async function register() {
 
 // Logout Function
 function logout() {
+    if (authToken) {
+        // end the session server-side too; the UI doesn't wait for it
+        fetch(`${API_BASE}/api/logout`, {
+            method: 'POST',
+            headers: { 'Authorization': `Bearer ${authToken}` }
+        }).catch(() => {});
+    }
     authToken = null;
+    refreshToken = null;
     currentUser = null;
     cart = [];
     
     localStorage.removeItem('authToken');
+    localStorage.removeItem('refreshToken');
     localStorage.removeItem('currentUser');
     
     updateUIForLoggedOutUser();
     showSection('hero');
 }
 
-// Load shoes from API
+// Trade the refresh token for a new access token; false if the session is over
+async function refreshSession() {
+    if (!refreshToken) return false;
+    const response = await fetch(`${API_BASE}/api/token/refresh`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ refresh_token: refreshToken })
+    });
+    if (!response.ok) return false;
+    const data = await response.json();
+    authToken = data.token;
+    refreshToken = data.refresh_token;
+    localStorage.setItem('authToken', authToken);
+    localStorage.setItem('refreshToken', refreshToken);
+    return true;
+}
+
+// fetch() with the access token, refreshing it once when it has expired
+async function authFetch(url, options = {}) {
+    const send = () => fetch(url, {
+        ...options,
+        headers: { ...(options.headers || {}), 'Authorization': `Bearer ${authToken}` }
+    });
+    let response = await send();
+    if (response.status === 401 && await refreshSession()) {
+        response = await send();
+    }
+    return response;
+}
+
+// Load shoes: the inlined page, else the stored copy plus what changed
+// since, else the whole catalog
 async function loadShoes() {
+    // First visit: use the page of products embedded in the HTML, no round trip
+    const initial = takeInitialCatalog();
+    if (initial) {
+        allShoes = initial.shoes;
+        renderShoes(visibleShoes());
+        if (initial.complete) {
+            catalogStore.save(initial.version, allShoes);
+            startLiveUpdates(initial.version);
+            return;
+        }
+    }
+
     try {
+        const stored = await catalogStore.load();
+        if (stored) {
+            const response = await fetch(`${API_BASE}/api/shoes/changes?since=${stored.version}`);
+            const changes = await response.json();
+            if (response.ok && !changes.reset) {
+                allShoes = applyCatalogChanges(stored.shoes, changes);
+                renderShoes(visibleShoes());
+                if (changes.version !== stored.version) {
+                    catalogStore.save(changes.version, allShoes);
+                }
+                startLiveUpdates(changes.version);
+                return;
+            }
+        }
+
         const response = await fetch(`${API_BASE}/shoes`);
         const shoes = await response.json();
         
         allShoes = shoes;
-        renderShoes(shoes);
+        renderShoes(visibleShoes());
+        const version = response.headers.get('X-Catalog-Version');
+        if (version) catalogStore.save(Number(version), shoes);
+        startLiveUpdates(version && Number(version));
     } catch (error) {
         console.error('Error loading shoes:', error);
         showEmptyState('products-grid', '❌', 'Failed to load products');
     }
 }
 
-// Render shoes in grid
+// Merge a /api/shoes/changes answer into a list of shoes (kept in id order)
+function applyCatalogChanges(shoes, changes) {
+    const byId = new Map(shoes.map(shoe => [shoe.id, shoe]));
+    changes.deleted.forEach(id => byId.delete(id));
+    [...changes.inserted, ...changes.updated].forEach(shoe => byId.set(shoe.id, shoe));
+    return [...byId.values()].sort((a, b) => a.id - b.id);
+}
+
+// Catch up through loadShoes(), one reload at a time
+function reloadCatalog() {
+    if (!catalogReload) {
+        catalogReload = loadShoes().finally(() => { catalogReload = null; });
+    }
+    return catalogReload;
+}
+
+// Stock and price changes pushed by the server as they commit (Server-Sent
+// Events), starting after catalog version `version`
+function startLiveUpdates(version) {
+    if (liveUpdates || !('EventSource' in window)) return;
+    const since = version ? `?since=${version}` : '';
+    liveUpdates = new EventSource(`${API_BASE}/api/shoes/live${since}`);
+    liveUpdates.addEventListener('products', event => applyLiveChanges(JSON.parse(event.data)));
+    // we were away longer than the server remembers: catch up through the change log
+    liveUpdates.addEventListener('reset', () => reloadCatalog());
+}
+
+// Patch new stock levels and prices into allShoes and the visible cards.
+// The IndexedDB copy is left alone: these events don't carry the other
+// fields, so it catches up through /api/shoes/changes on the next visit.
+function applyLiveChanges(changes) {
+    const byId = new Map(allShoes.map(shoe => [shoe.id, shoe]));
+    let unknown = false;
+    changes.forEach(change => {
+        const shoe = byId.get(change.id);
+        if (change.deleted) {
+            byId.delete(change.id);
+        } else if (!shoe) {
+            unknown = true;
+        } else {
+            const variantStock = new Map(change.variants);
+            byId.set(change.id, {
+                ...shoe,
+                stock: change.stock,
+                price: change.price,
+                effective_price: change.effective_price ?? change.price,
+                variants: shoe.variants && shoe.variants.map(variant =>
+                    variantStock.has(variant.id) ? { ...variant, stock: variantStock.get(variant.id) } : variant)
+            });
+        }
+    });
+    allShoes = [...byId.values()];
+    renderShoes(visibleShoes());
+    // a shoe added after we loaded: fetch it with the rest of what changed
+    if (unknown) reloadCatalog();
+}
+
+// The last catalog we saw and its version, kept in IndexedDB between visits.
+// Everything here fails soft: without IndexedDB we just load the catalog.
+const catalogStore = {
+    db: null,
+
+    open() {
+        if (!this.db) {
+            this.db = new Promise(resolve => {
+                if (!('indexedDB' in window)) return resolve(null);
+                const request = indexedDB.open('shoe-store', 1);
+                request.onupgradeneeded = () => request.result.createObjectStore('catalog');
+                request.onsuccess = () => resolve(request.result);
+                request.onerror = () => resolve(null);
+            });
+        }
+        return this.db;
+    },
+
+    async load() {
+        const db = await this.open();
+        if (!db) return null;
+        return new Promise(resolve => {
+            const request = db.transaction('catalog').objectStore('catalog').get('shoes');
+            request.onsuccess = () => resolve(request.result || null);
+            request.onerror = () => resolve(null);
+        });
+    },
+
+    async save(version, shoes) {
+        const db = await this.open();
+        if (!db || !version) return;
+        db.transaction('catalog', 'readwrite').objectStore('catalog').put({ version, shoes }, 'shoes');
+    }
+};
+
+// Read (once) the catalog page the server inlined into index.html
+function takeInitialCatalog() {
+    const script = document.getElementById('initial-catalog');
+    if (!script) return null;
+    script.remove();
+    try {
+        return JSON.parse(script.textContent);
+    } catch (error) {
+        console.error('Bad inline catalog:', error);
+        return null;
+    }
+}
+
+// Render shoes in grid. Cards are patched in place: a card whose markup is
+// unchanged stays as it is (image, loaded recommendations), a changed one is
+// swapped for a new one, and the grid is only reordered when it has to be.
+const cardMarkup = new WeakMap();
+
 function renderShoes(shoes) {
     const grid = document.getElementById('products-grid');
     
@@ -187,43 +372,150 @@ function renderShoes(shoes) {
         return;
     }
     
-    grid.innerHTML = shoes.map(shoe => {
-        const icon = getCategoryIcon(shoe.category);
-        const inStock = shoe.stock > 0;
-        const imageUrl = shoe.image || 'https://images.unsplash.com/photo-1542291026-7eec264c27ff?w=400';
-        const cartItem = cart.find(item => item.id === shoe.id);
+    const current = new Map([...grid.querySelectorAll('.product-card')].map(card => [card.dataset.shoeId, card]));
+    const cards = shoes.map(shoe => {
+        const html = productCardHtml(shoe);
+        const card = current.get(String(shoe.id));
+        if (card && cardMarkup.get(card) === html) return card;
         
-        let buttonHtml;
-        if (!inStock) {
-            buttonHtml = `<button class="add-to-cart-btn" disabled>Out of Stock</button>`;
-        } else if (cartItem) {
-            buttonHtml = `
-                <div style="display: flex; gap: 8px; align-items: center;">
-                    <button class="qty-btn" onclick="decreaseQuantity(${shoe.id})">−</button>
-                    <span style="min-width: 30px; text-align: center; font-weight: 600;">${cartItem.quantity}</span>
-                    <button class="qty-btn" onclick="increaseQuantity(${shoe.id})">+</button>
-                </div>
-            `;
-        } else {
-            buttonHtml = `<button class="add-to-cart-btn" onclick="addToCart(${shoe.id})">Add to Cart</button>`;
+        const template = document.createElement('template');
+        template.innerHTML = html.trim();
+        const fresh = template.content.firstElementChild;
+        cardMarkup.set(fresh, html);
+        if (card) {
+            // keep the recommendations line (and its place in the observer)
+            fresh.querySelector('.product-related').replaceWith(card.querySelector('.product-related'));
         }
-        
-        return `
-            <div class="product-card" data-category="${shoe.category}">
-                <div class="product-image" style="background-image: url('${imageUrl}')"></div>
-                <h3 class="product-name">${shoe.name}</h3>
-                <p class="product-brand">${shoe.brand}</p>
-                <div class="product-details">
-                    <span class="detail-badge">Size: ${shoe.size}</span>
-                    <span class="detail-badge">${shoe.color}</span>
-                    <span class="detail-badge">${shoe.category}</span>
-                </div>
-                <div class="product-price">$${parseFloat(shoe.price).toFixed(2)}</div>
-                <p class="product-stock">${inStock ? `${shoe.stock} in stock` : 'Out of stock'}</p>
-                ${buttonHtml}
+        return fresh;
+    });
+    
+    const children = grid.children;
+    if (cards.length !== children.length || cards.some((card, i) => card !== children[i])) {
+        grid.replaceChildren(...cards);
+    }
+    observeRelated(grid);
+}
+
+// Markup of one product card
+function productCardHtml(shoe) {
+    const inStock = shoe.stock > 0;
+    const cartItem = cart.find(item => item.id === shoe.id);
+    
+    let buttonHtml;
+    if (!inStock) {
+        buttonHtml = `<button class="add-to-cart-btn" disabled>Out of Stock</button>`;
+    } else if (cartItem) {
+        buttonHtml = `
+            <div style="display: flex; gap: 8px; align-items: center;">
+                <button class="qty-btn" onclick="decreaseQuantity(${shoe.id})">−</button>
+                <span style="min-width: 30px; text-align: center; font-weight: 600;">${cartItem.quantity}</span>
+                <button class="qty-btn" onclick="increaseQuantity(${shoe.id})">+</button>
             </div>
         `;
-    }).join('');
+    } else {
+        buttonHtml = `<button class="add-to-cart-btn" onclick="addToCart(${shoe.id})">Add to Cart</button>`;
+    }
+    
+    return `
+        <div class="product-card" data-category="${shoe.category}" data-shoe-id="${shoe.id}">
+            ${productImageHtml(shoe)}
+            <h3 class="product-name">${shoe.name}</h3>
+            <p class="product-brand">${shoe.brand}</p>
+            <div class="product-details">
+                <span class="detail-badge">${sizeLabel(shoe)}</span>
+                <span class="detail-badge">${shoe.color}</span>
+                <span class="detail-badge">${shoe.category}</span>
+            </div>
+            ${priceHtml(shoe)}
+            <p class="product-stock">${inStock ? `${shoe.stock} in stock` : 'Out of stock'}</p>
+            <p class="product-related" data-shoe-id="${shoe.id}"></p>
+            ${buttonHtml}
+        </div>
+    `;
+}
+
+// Recommendations are fetched per card only once it scrolls into view
+const relatedCache = new Map();
+const relatedObserver = 'IntersectionObserver' in window
+    ? new IntersectionObserver(entries => {
+        entries.filter(entry => entry.isIntersecting).forEach(entry => {
+            relatedObserver.unobserve(entry.target);
+            loadRelated(entry.target);
+        });
+    }, { rootMargin: '200px' })
+    : null;
+
+function observeRelated(grid) {
+    grid.querySelectorAll('.product-related:not([data-loaded])').forEach(element => {
+        if (relatedObserver) {
+            relatedObserver.observe(element);
+        } else {
+            loadRelated(element);
+        }
+    });
+}
+
+// "Customers also bought: ..." line under a product card
+async function loadRelated(element) {
+    const shoeId = element.dataset.shoeId;
+    try {
+        if (!relatedCache.has(shoeId)) {
+            const response = await fetch(`${API_BASE}/api/shoes/${shoeId}/related?limit=3`);
+            relatedCache.set(shoeId, response.ok ? await response.json() : []);
+        }
+        const related = relatedCache.get(shoeId);
+        element.dataset.loaded = 'true';
+        if (related.length) {
+            element.textContent = `Customers also bought: ${related.map(shoe => shoe.name).join(', ')}`;
+        }
+    } catch (error) {
+        console.error('Error loading recommendations:', error);
+    }
+}
+
+// Price, with the list price struck through while a promotion applies
+function priceHtml(shoe) {
+    const price = parseFloat(shoe.price);
+    const effective = parseFloat(shoe.effective_price ?? shoe.price);
+    if (effective >= price) {
+        return `<div class="product-price">$${price.toFixed(2)}</div>`;
+    }
+    return `
+        <div class="product-price">
+            <span class="original-price">$${price.toFixed(2)}</span>
+            $${effective.toFixed(2)}
+        </div>
+    `;
+}
+
+// "Size: 10" for single-size styles, "Sizes: 8, 9, 10" for styles with several in stock
+function sizeLabel(shoe) {
+    const sizes = shoe.sizes && shoe.sizes.length ? shoe.sizes : [shoe.size];
+    if (sizes.length === 1) {
+        return `Size: ${sizes[0]}`;
+    }
+    return `Sizes: ${sizes.join(', ')}`;
+}
+
+// Widths generated by the server for images in the local /media/ store
+const MEDIA_WIDTHS = [200, 400, 800];
+
+// Product image markup; local images get WebP/JPEG srcsets of resized copies
+function productImageHtml(shoe) {
+    const imageUrl = shoe.image || 'https://images.unsplash.com/photo-1542291026-7eec264c27ff?w=400';
+    
+    if (!imageUrl.startsWith('/media/')) {
+        return `<img class="product-image" src="${imageUrl}" alt="${shoe.name}" loading="lazy">`;
+    }
+    
+    const base = imageUrl.slice(0, imageUrl.lastIndexOf('/') + 1);
+    const srcset = ext => MEDIA_WIDTHS.map(w => `${base}w${w}.${ext} ${w}w`).join(', ');
+    const sizes = '(max-width: 768px) 100vw, 320px';
+    return `
+                <picture>
+                    <source type="image/webp" srcset="${srcset('webp')}" sizes="${sizes}">
+                    <img class="product-image" src="${base}w400.jpg" srcset="${srcset('jpg')}" sizes="${sizes}" alt="${shoe.name}" loading="lazy">
+                </picture>`;
 }
 
 // Filter shoes by category
@@ -235,12 +527,16 @@ function filterShoes(category) {
     event.target.classList.add('active');
     
     // Filter and render
-    if (category === 'all') {
-        renderShoes(allShoes);
-    } else {
-        const filtered = allShoes.filter(shoe => shoe.category === category);
-        renderShoes(filtered);
+    currentCategory = category;
+    renderShoes(visibleShoes());
+}
+
+// The shoes in the selected category
+function visibleShoes() {
+    if (currentCategory === 'all') {
+        return allShoes;
     }
+    return allShoes.filter(shoe => shoe.category === currentCategory);
 }
 
 // Add shoe to cart
@@ -259,12 +555,12 @@ function addToCart(shoeId) {
     if (existing) {
         existing.quantity += 1;
     } else {
-        cart.push({ ...shoe, quantity: 1 });
+        cart.push({ ...shoe, price: shoe.effective_price ?? shoe.price, quantity: 1 });
     }
     
     updateCartCount();
     renderCart();
-    renderShoes(allShoes);
+    renderShoes(visibleShoes());
 }
 
 // Increase quantity
@@ -274,7 +570,7 @@ function increaseQuantity(shoeId) {
         cartItem.quantity += 1;
         updateCartCount();
         renderCart();
-        renderShoes(allShoes);
+        renderShoes(visibleShoes());
     }
 }
 
@@ -290,7 +586,7 @@ function decreaseQuantity(shoeId) {
         }
         updateCartCount();
         renderCart();
-        renderShoes(allShoes);
+        renderShoes(visibleShoes());
     }
 }
 
@@ -345,7 +641,7 @@ function increaseQuantityInCart(shoeId) {
         cartItem.quantity += 1;
         updateCartCount();
         renderCart();
-        renderShoes(allShoes);
+        renderShoes(visibleShoes());
     }
 }
 
@@ -357,7 +653,7 @@ function decreaseQuantityInCart(shoeId) {
             cartItem.quantity -= 1;
             updateCartCount();
             renderCart();
-            renderShoes(allShoes);
+            renderShoes(visibleShoes());
         }
     }
 }
@@ -427,11 +723,10 @@ async function addShoe() {
     }
     
     try {
-        const response = await fetch(`${API_BASE}/shoes`, {
+        const response = await authFetch(`${API_BASE}/shoes`, {
             method: 'POST',
             headers: {
-                'Content-Type': 'application/json',
-                'Authorization': `Bearer ${authToken}`
+                'Content-Type': 'application/json'
             },
             body: JSON.stringify(shoeData)
         });
@@ -500,6 +795,7 @@ function loadAuthState() {
     
     if (savedToken && savedUser) {
         authToken = savedToken;
+        refreshToken = localStorage.getItem('refreshToken');
         currentUser = JSON.parse(savedUser);
         updateUIForLoggedInUser();
     }
@@ -0,0 +1,158 @@
+"""User accounts: lookups, registration and bulk imports.
+
+Usernames are unique regardless of case (a COLLATE NOCASE unique index), so
+'Alice' and 'alice' are the same account. Every query reads only the
+columns it needs, and username -> id lookups go through a small in-process
+cache; usernames never change, so a cached id can't go stale.
+"""
+
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# columns safe to hand to request handlers (no password hash)
+PUBLIC_COLUMNS = 'id, username, email, role, loyalty_points, created_at'
+
+
+class UsernameCache:
+    """Thread-safe LRU map of lower-cased username -> user id"""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, username):
+        key = username.lower()
+        with self._lock:
+            user_id = self._entries.get(key)
+            if user_id is not None:
+                self._entries.move_to_end(key)
+            return user_id
+
+    def put(self, username, user_id):
+        with self._lock:
+            self._entries[username.lower()] = user_id
+            self._entries.move_to_end(username.lower())
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class UserRepository:
+    """User queries through a DatabaseManager"""
+
+    def __init__(self, db, cache_size=10000):
+        self.db = db
+        self.ids = UsernameCache(cache_size)
+
+    def _lookup(self, columns, username):
+        """One row of columns for a username, by cached id when we have it.
+
+        Either way it's a single indexed query; a miss also fills the cache.
+        columns must include id.
+        """
+        user_id = self.ids.get(username)
+        conn = self.db.get_connection()
+        if user_id is not None:
+            row = conn.execute(f'SELECT {columns} FROM users WHERE id = ?', (user_id,)).fetchone()
+        else:
+            row = conn.execute(f'SELECT {columns} FROM users WHERE username = ? COLLATE NOCASE',
+                               (username,)).fetchone()
+        conn.close()
+        if row is not None and user_id is None:
+            # misses aren't cached: the name may be registered a moment later
+            self.ids.put(username, row['id'])
+        return row
+
+    def id_for(self, username):
+        """Id of the account with this username (any case), or None"""
+        user_id = self.ids.get(username)
+        if user_id is not None:
+            return user_id
+        row = self._lookup('id', username)
+        return row['id'] if row else None
+
+    def exists(self, username):
+        return self.id_for(username) is not None
+
+    def get(self, user_id):
+        """Public fields of a user by id, or None"""
+        conn = self.db.get_connection()
+        row = conn.execute(f'SELECT {PUBLIC_COLUMNS} FROM users WHERE id = ?', (user_id,)).fetchone()
+        conn.close()
+        return dict(row) if row else None
+
+    def get_by_username(self, username):
+        row = self._lookup(PUBLIC_COLUMNS, username)
+        return dict(row) if row else None
+
+    def get_by_email(self, email):
+        """Public fields of the first account with this email (any case)"""
+        conn = self.db.get_connection()
+        row = conn.execute(f'SELECT {PUBLIC_COLUMNS} FROM users WHERE email = ? COLLATE NOCASE '
+                           'ORDER BY id LIMIT 1', (email,)).fetchone()
+        conn.close()
+        return dict(row) if row else None
+
+    def authenticate(self, username, password):
+        """Public fields of the user if the password matches, else None"""
+        from models.user import User
+
+        row = self._lookup('id, username, password_hash, role', username)
+        if row and User.from_dict(dict(row)).verify_password(password):
+            user = dict(row)
+            del user['password_hash']
+            return user
+        return None
+
+    def create(self, user):
+        """Insert a user; returns the new id, or None if the username is taken"""
+        if self.exists(user.username):
+            return None
+        conn = self.db.get_connection()
+        try:
+            user_id = conn.execute('''
+                INSERT INTO users (username, password_hash, email, role)
+                VALUES (?, ?, ?, ?)
+            ''', (user.username, user.password_hash, user.email, user.role)).lastrowid
+            conn.commit()
+        except sqlite3.IntegrityError:
+            # registered by a concurrent request since the check above
+            return None
+        finally:
+            conn.close()
+        self.ids.put(user.username, user_id)
+        return user_id
+
+    def create_many(self, users):
+        """Insert many users in one transaction, skipping taken usernames.
+
+        Meant for onboarding imports; callers with very large files pass
+        chunks of a few thousand. Returns (created count, skipped usernames).
+        """
+        conn = self.db.get_connection()
+        created = 0
+        skipped = []
+        try:
+            for user in users:
+                row = conn.execute('''
+                    INSERT INTO users (username, password_hash, email, role)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT DO NOTHING
+                    RETURNING id
+                ''', (user.username, user.password_hash, user.email, user.role)).fetchone()
+                if row is None:
+                    skipped.append(user.username)
+                else:
+                    created += 1
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return created, skipped